@@ -1,10 +1,16 @@
+import ctypes
+
 from mesh import Mesh
 from shaders import *
-from texture import Texture
+from texture import texture_cache
 
-from FurTextureGen import createFurTextures
+from FurTextureGen import FurTexture
 from matutils import poseMatrix
-from shaders import FurShader
+from profiler import profiler
+from simplify import build_lods
+from transform import TransformNode
+from vertexformat import COMPACT, index_type, set_attribute_pointers
+from shaders import shader_cache
 
 
 class BaseModel:
@@ -14,9 +20,22 @@ class BaseModel:
     """
 
     def __init__(self, scene, num_of_layers, fur_density, M=poseMatrix(), mesh=Mesh(), color=None,
-                 primitive=GL_TRIANGLES, visible=True):
+                 primitive=GL_TRIANGLES, visible=True, fur_seed=None, instanced=False, lod=False, lod_pixels=1.,
+                 vertex_format=COMPACT, lods=None, fur_coverage=None, images=None):
         """
         Initialises the model data
+        :param mesh: a Mesh, or a list of meshes, eg. one per material of an OBJ file, which are all drawn together
+        :param fur_seed: [optional] seed for the random fur strands, so that the same fur is generated every time
+        :param instanced: [optional] if True, all fur layers are drawn with a single instanced draw call
+        :param lod: [optional] if True, simplified levels of detail of the mesh are built when it is loaded, and each
+        frame draws the coarsest one whose error is smaller than lod_pixels pixels on the screen
+        :param lod_pixels: [optional] the error allowed on the screen for the skin, in pixels
+        :param vertex_format: [optional] how the vertex attributes are quantized and packed, see vertexformat.py.
+        Use vertexformat.FULL_PRECISION to keep them as float32.
+        :param lods: [optional] the levels of detail of each mesh, as returned by build_lods(), if they were already
+        built, eg. by the asset loader
+        :param fur_coverage: [optional] the fur coverage computed for fur_seed by FurTextureGen.furCoverage()
+        :param images: [optional] dict of the decoded textures of the materials, by name, eg. by the asset loader
         """
         print('+ Initializing {}'.format(self.__class__.__name__))
 
@@ -32,13 +51,53 @@ class BaseModel:
         # store the object's color (deprecated now that we have per-vertex colors)
         self.color = color
 
-        # store the shader program for rendering this model
+        # store the shader program for rendering this model, and the one used to draw all layers at once
         self.shader = None
+        self.instanced_shader = None
+
+        # if this flag is set, all layers are drawn in a single instanced draw call instead of a loop
+        self.instanced = instanced
+
+        # mesh data. All meshes are stored in the same buffers and drawn with the same calls, the first one
+        # is kept as self.mesh for the code which only deals with one mesh.
+        self.meshes = list(mesh) if isinstance(mesh, (list, tuple)) else [mesh]
+        self.mesh = self.meshes[0]
+
+        # the distinct materials of the meshes, each vertex stores the index of the material of its mesh
+        self.materials = []
+        for submesh in self.meshes:
+            if not any(submesh.material is material for material in self.materials):
+                self.materials.append(submesh.material)
+        self.skins = None
+
+        # levels of detail of each mesh as (mesh, error in model units), from the full mesh to the coarsest one.
+        # Only triangle meshes with indices are simplified.
+        self.lods = build_mesh_lods(self.meshes, lod) if lods is None else lods
+        self.lod_pixels = lod_pixels
+
+        # the levels are chosen from the size of the model on the screen, measured at the center of its bounds
+        if self.mesh.vertices is not None:
+            lower = np.min([submesh.vertices.min(axis=0) for submesh in self.meshes], axis=0)
+            upper = np.max([submesh.vertices.max(axis=0) for submesh in self.meshes], axis=0)
+            self.center = np.append(0.5 * (lower + upper), 1.)
+
+        # the outer layers only show sparse strands, so they allow an error this many times larger
+        self.lod_shell_scale = 3.
 
-        # mesh data
-        self.mesh = mesh
-        if self.mesh.textures == 1:
-            self.mesh.textures.append(Texture('fur.bmp'))
+        # (byte offset, number of indices) of each level of each mesh in the index buffer
+        self.lod_ranges = []
+
+        # the levels of each mesh drawn for each layer, reused while the PVM matrix is the same
+        self.lod_levels = None
+        self.lod_key = None
+
+        # the arguments of the multi-draw calls for each combination of levels
+        self.multi_draws = {}
+
+        # the indirect draw commands of the instanced runs of layers, and the levels they were written for
+        self.indirect_buffer = None
+        self.indirect_runs = None
+        self.indirect_levels = None
 
         # dict of VBOs
         self.vbos = {}
@@ -46,8 +105,9 @@ class BaseModel:
         # dict of attributes
         self.attributes = {}
 
-        # store the position of the model in the scene, ...
-        self.M = M
+        # store the position of the model in the scene, in a node of the transform graph which caches
+        # its world matrix
+        self.node = TransformNode(M)
 
         # We use a Vertex Array Object to pack all buffers for rendering in the GPU (see lecture on OpenGL)
         self.vao = glGenVertexArrays(1)
@@ -55,12 +115,27 @@ class BaseModel:
         # this buffer will be used to store indices, if using shared vertex representation
         self.index_buffer = None
 
+        # the attributes of each vertex are packed in a single buffer, in this format
+        self.vertex_format = vertex_format
+
+        # the type of the indices, 16 bits when there are few enough vertices
+        self.index_type = GL_UNSIGNED_INT
+        self.index_size = 4
+
+        # number of bytes stored on the GPU for this model
+        self.gpu_bytes = 0
+
+        # the textures already decoded, they are only kept until bind() uploads them
+        self.images = images
+
         # Initialises the values to be used later
         self.num_of_layers = num_of_layers
         self.fur_density = fur_density
+        self.fur_seed = fur_seed
 
-        # Calls the createFurTextures function using the fur_density which was first initialised.
-        self.furTex = createFurTextures(size=128, num_of_layers=self.num_of_layers, fur_density=fur_density)
+        # Creates the fur texture using the fur_density which was first initialised.
+        self.furTex = FurTexture(size=128, num_of_layers=self.num_of_layers, fur_density=fur_density, seed=fur_seed,
+                                 coverage=fur_coverage)
 
         # and we check which primitives we need to use for drawing
         if self.mesh.faces.shape[1] == 3:
@@ -71,44 +146,52 @@ class BaseModel:
 
         self.bind()
 
-    def initialise_vbo(self, vbo_name, data):
-        print('Initialising VBO for attribute {}'.format(vbo_name))
+    @property
+    def M(self):
+        return self.node.M
 
-        if data is None:
-            print('(W) Warning in {}.bind_attribute(): Data array for attribute {} is None!'.format(
-                self.__class__.__name__, vbo_name))
-            return
-
-        # bind the location of the attribute in the GLSL program to the next index
-        # the name of the location must correspond to a 'in' variable in the GLSL vertex shader code
-        self.attributes[vbo_name] = len(self.vbos)
+    @M.setter
+    def M(self, M):
+        self.node.M = M
 
-        # create a buffer object...
-        self.vbos[vbo_name] = glGenBuffers(1)
-        # and bind it
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbos[vbo_name])
-
-        # enable the attribute
-        glEnableVertexAttribArray(self.attributes[vbo_name])
+    def initialise_vertex_buffer(self, arrays):
+        """
+        Packs the attributes of the vertices in a single interleaved VBO, quantized with the vertex format of the
+        model, and links each attribute to the next shader location.
+        :param arrays: the list of (attribute name, data array) in the order of their locations
+        """
+        for name, data in arrays:
+            if data is None:
+                print('(W) Warning in {}.bind_attribute(): Data array for attribute {} is None!'.format(
+                    self.__class__.__name__, name))
+        arrays = [(name, data) for name, data in arrays if data is not None]
+
+        data, layout = self.vertex_format.pack(arrays)
+        for name, components, gl_type, normalized, offset in layout:
+            self.attributes[name] = len(self.attributes)
+
+        self.vbos['vertices'] = glGenBuffers(1)
+        glBindBuffer(GL_ARRAY_BUFFER, self.vbos['vertices'])
+        glBufferData(GL_ARRAY_BUFFER, data, GL_STATIC_DRAW)
+        set_attribute_pointers(layout, data.shape[1], self.attributes)
+        self.gpu_bytes += data.nbytes
 
-        # Associate the bound buffer to the corresponding input location in the shader
-        # Each instance of the vertex shader will get one row of the array
-        # so this can be processed in parallel!
-        glVertexAttribPointer(index=self.attributes[vbo_name], size=data.shape[1], type=GL_FLOAT, normalized=False,
-                              stride=0, pointer=None)
+        print('Initialised interleaved VBO for attributes {}, {} bytes per vertex ({} with float32 attributes)'.format(
+            ', '.join(name for name, _ in arrays), data.shape[1], 4 * sum(array.shape[1] for _, array in arrays)))
 
-        # ... and we set the data in the buffer as the vertex array
-        glBufferData(GL_ARRAY_BUFFER, data, GL_STATIC_DRAW)
+    def shader_defines(self):
+        """
+        :return: the defines of the shader which decodes the vertex format of this model
+        """
+        return self.vertex_format.defines()
 
     def bind_shader(self):
         """
         If a new shader is bound, we need to re-link it to ensure attributes are correctly linked.
         """
         if self.shader is None:
-            self.shader = FurShader()
-
-            # binds all attributes to the shader.
-            self.shader.compile(self.attributes)
+            # binds all attributes to the shader, which is shared by all models with the same attributes.
+            self.shader = shader_cache.get(self.attributes, defines=self.shader_defines())
 
     def bind(self):
         """
@@ -122,27 +205,188 @@ class BaseModel:
         if self.mesh.vertices is None:
             print('(W) Warning in {}.bind(): No vertex array!'.format(self.__class__.__name__))
 
-        # initialise vertex position VBO and link to shader program attribute
-        self.initialise_vbo('position', self.mesh.vertices)
-        self.initialise_vbo('normal', self.mesh.normals)
-        self.initialise_vbo('texCoord', self.mesh.textureCoords)
+        # all meshes and their levels of detail are stored one after the other in the same buffers
+        vertices, normals, textureCoords, materials, faces = self.lod_arrays()
+
+        # initialise the vertex VBO and link its attributes to the shader program
+        attributes = [('position', vertices), ('normal', normals), ('texCoord', textureCoords)]
+        if materials is not None:
+            attributes.append(('material', materials))
+        self.initialise_vertex_buffer(attributes)
+
+        # the textures of all materials are bound together, in the layers of a texture array shared by all models
+        # with the same materials
+        # Its bytes are counted once by the texture cache, not by each model.
+        self.skins = texture_cache.material_array(self.materials, images=self.images)
+        self.images = None
+
+        # indirect draws need OpenGL 4.3, instanced meshes are otherwise drawn one call each
+        self.indirect = bool(glMultiDrawElementsIndirect)
 
         # if indices are provided, put them in a buffer too
-        if self.mesh.faces is not None:
+        if faces is not None:
             self.index_buffer = glGenBuffers(1)
             glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
-            glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.mesh.faces, GL_STATIC_DRAW)
+            glBufferData(GL_ELEMENT_ARRAY_BUFFER, faces, GL_STATIC_DRAW)
+            self.gpu_bytes += faces.nbytes
 
         # finally we unbind the VAO and VBO when we're done to avoid side effects
         glBindVertexArray(0)
         glBindBuffer(GL_ARRAY_BUFFER, 0)
 
-    def draw(self, fur_length, fur_density, num_of_layers, Mp=poseMatrix()):
+    def lod_arrays(self):
+        """
+        Concatenates the vertex arrays of the levels of detail of all meshes, and their indices which are offset to
+        point to the vertices of their level. Sets the range of each level of each mesh in the index buffer.
+        :return: the vertices, normals, texture coordinates, material indices and faces to store in the buffers
+        """
+        if self.mesh.faces is None:
+            # meshes without indices are drawn on their own, from their vertex order
+            return self.mesh.vertices, self.mesh.normals, self.mesh.textureCoords, None, None
+
+        levels = [level for lods in self.lods for level, _ in lods]
+        bases = np.cumsum([0] + [level.vertices.shape[0] for level in levels[:-1]])
+        dtype, self.index_type = index_type(sum(level.vertices.shape[0] for level in levels))
+        faces = np.concatenate([level.faces + base for level, base in zip(levels, bases)]).astype(dtype)
+        self.index_size = faces.itemsize
+
+        counts = [level.faces.size for level in levels]
+        offsets = np.cumsum([0] + counts[:-1]) * faces.itemsize
+        ranges = iter([(int(offset), count) for offset, count in zip(offsets, counts)])
+        self.lod_ranges = [[next(ranges) for _ in lods] for lods in self.lods]
+
+        # the index of the material of each vertex, the same for all vertices of a mesh
+        slots = [next(i for i, material in enumerate(self.materials) if material is submesh.material)
+                 for submesh in self.meshes]
+        materials = np.concatenate([np.full((level.vertices.shape[0], 1), slot, dtype='f')
+                                    for lods, slot in zip(self.lods, slots) for level, _ in lods])
+
+        def concatenate(arrays):
+            if all(array is None for array in arrays):
+                return None
+            # a mesh without texture coordinates samples the corner of its texture
+            return np.concatenate([np.zeros((level.vertices.shape[0], 2), dtype='f') if array is None else array
+                                   for array, level in zip(arrays, levels)])
+
+        return (np.concatenate([level.vertices for level in levels]),
+                np.concatenate([level.normals for level in levels]),
+                concatenate([level.textureCoords for level in levels]), materials, faces)
+
+    def select_lods(self, world, pvm, num_of_layers):
+        """
+        Picks the level of detail of each mesh for each layer from the size of its error on the screen. The error in
+        model units is scaled by the model and view matrices, and projected at the depth of the center of the model.
+        :param world: the model matrix
+        :param pvm: the projection * model * view matrix
+        :param num_of_layers: the number of layers drawn
+        :return: the (layers, meshes) levels drawn, the coarsest ones whose error is below lod_pixels pixels,
+        up to 1 + lod_shell_scale times more for the outermost layer
+        """
+        levels = np.zeros((num_of_layers, len(self.meshes)), dtype=int)
+        w = np.dot(pvm[3], self.center)
+        if w <= 0:
+            # the center is behind the camera, the closest parts of the mesh may be very large on the screen
+            return levels
+
+        # largest scaling of the model and view matrices, then pixels per eye space unit at that depth
+        scale = np.linalg.norm(np.matmul(world, self.scene.camera.V)[:3, :3], 2)
+        pixels = scale * abs(self.scene.P[1, 1]) * 0.5 * self.scene.window_size[1] / w
+
+        thresholds = self.lod_pixels * (1 + self.lod_shell_scale * np.arange(num_of_layers) / num_of_layers)
+        for i, lods in enumerate(self.lods):
+            errors = np.array([error for _, error in lods]) * pixels
+            levels[:, i] = np.searchsorted(errors, thresholds, side='right') - 1
+        return levels
+
+    def layer_levels(self, num_of_layers, Mp=None):
+        """
+        :return: the (layers, meshes) levels of detail of the num_of_layers layers drawn in this frame, the same array
+        until the model, the camera, the projection or the number of layers changed
+        """
+        if all(len(lods) == 1 for lods in self.lods):
+            if self.lod_key != num_of_layers:
+                self.lod_levels = np.zeros((num_of_layers, len(self.meshes)), dtype=int)
+                self.lod_key = num_of_layers
+            return self.lod_levels
+
+        if Mp is None:
+            world = self.node.world()
+            pvm = self.node.pvm(self.scene.P, self.scene.projection_version, self.scene.camera)
+        else:
+            world = np.matmul(Mp, self.node.world())
+            pvm = np.matmul(self.scene.P, np.matmul(world, self.scene.camera.V))
+
+        # the PVM matrix is the same object until something moves
+        key = (id(pvm), num_of_layers, self.lod_pixels, self.scene.window_size)
+        if Mp is not None or self.lod_key != key:
+            self.lod_levels = self.select_lods(world, pvm, num_of_layers)
+            self.lod_key = None if Mp is not None else key
+        return self.lod_levels
+
+    def multi_draw(self, levels):
+        """
+        :param levels: the level of each mesh
+        :return: the numbers of indices and the byte offsets in the index buffer of the meshes at these levels,
+        as glMultiDrawElements takes them
+        """
+        key = tuple(levels)
+        if key not in self.multi_draws:
+            ranges = [self.lod_ranges[i][level] for i, level in enumerate(levels)]
+            counts = np.array([count for _, count in ranges], dtype=np.int32)
+            offsets = (ctypes.c_void_p * len(ranges))(*[offset for offset, _ in ranges])
+            self.multi_draws[key] = counts, offsets
+        return self.multi_draws[key]
+
+    def instanced_runs(self, levels):
+        """
+        Splits the layers in runs drawn with the same levels, each drawn with a single instanced call, and writes
+        their draw commands to the indirect buffer when the levels changed.
+        :param levels: the (layers, meshes) levels, from layer_levels()
+        :return: the list of (first layer, number of layers, byte offset of the commands) of each run
+        """
+        if self.indirect_levels is levels:
+            return self.indirect_runs
+
+        runs = []
+        commands = []
+        first = 0
+        while first < levels.shape[0]:
+            last = first
+            while last + 1 < levels.shape[0] and np.array_equal(levels[last + 1], levels[first]):
+                last += 1
+
+            # one DrawElementsIndirectCommand for each mesh: count, instances, first index, base vertex and instance
+            runs.append((first, last - first + 1, len(commands) * 20))
+            for i, level in enumerate(levels[first]):
+                offset, count = self.lod_ranges[i][level]
+                commands.append([count, last - first + 1, offset // self.index_size, 0, 0])
+            first = last + 1
+
+        if self.indirect and self.mesh.faces is not None:
+            if self.indirect_buffer is None:
+                self.indirect_buffer = glGenBuffers(1)
+            glBindBuffer(GL_DRAW_INDIRECT_BUFFER, self.indirect_buffer)
+            glBufferData(GL_DRAW_INDIRECT_BUFFER, np.array(commands, dtype=np.uint32), GL_DYNAMIC_DRAW)
+
+        self.indirect_levels = levels
+        self.indirect_runs = runs
+        return runs
+
+    def draw(self, fur_length, fur_density, num_of_layers, Mp=None):
         """
         Draws the model using OpenGL functions.
-        :param Mp: The model matrix of the parent object, for composite objects.
+        :param num_of_layers: the number of shells drawn, which can be lower than the number of layers of the fur
+        texture to draw faster. The shells are spread over the same fur length, and each one samples the texture
+        layer at its height, so that the fur keeps the same length and profile.
+        :param Mp: [optional] The model matrix of the parent object. Composite objects should rather add their
+        components to their transform node, so that the world matrix is cached.
         """
         if self.visible:
+            # the same matrix is used for all layers, and reused between frames while the model does not move
+            if Mp is None:
+                M = self.node.world32()
+            else:
+                M = np.matmul(Mp, self.node.world())
 
             if self.mesh.vertices is None:
                 print('(W) Warning in {}.draw(): No vertex array!'.format(self.__class__.__name__))
@@ -151,30 +395,73 @@ class BaseModel:
             glBindVertexArray(self.vao)
 
             # Finds whether the current fur density on the model is the same as what it should be,
-            # if they are not the same, a new createFurTextures is called, so the updated texture is then shown.
+            # if they are not the same, the strands which differ are added to or removed from the fur texture.
             if self.fur_density != fur_density:
-                self.furTex = createFurTextures(size=128, num_of_layers=num_of_layers, fur_density=fur_density)
+                with profiler.phase('fur_texture', gpu=True):
+                    self.furTex.setDensity(fur_density)
                 self.fur_density = fur_density
 
             if self.shader is None:
-                self.shader = FurShader()
-                self.shader.compile(self.attributes)
+                self.shader = shader_cache.get(self.attributes, defines=self.shader_defines())
 
-            # This activates and binds TEXTURE1, which is the skin
-            if len(self.mesh.textures) > 0:
-                tex = self.mesh.textures[0]
-                glActiveTexture(GL_TEXTURE1)
-                tex.bind()
+            if self.instanced and self.instanced_shader is None:
+                self.instanced_shader = shader_cache.get(self.attributes, defines=dict(self.shader_defines(),
+                                                                                       INSTANCED=1))
 
-            # This activates and binds TEXTURE0, which is generated within furTex, which is generated from the
-            # createFurTextures function within the FurTextureGen.py file.
+            # This activates and binds TEXTURE1, which has the skin of every material in a layer
+            glActiveTexture(GL_TEXTURE1)
+            self.skins.bind()
+
+            # This activates and binds TEXTURE0, which is the fur texture generated in the FurTextureGen.py file.
             glActiveTexture(GL_TEXTURE0)
-            glBindTexture(GL_TEXTURE_2D, self.furTex)
+            self.furTex.bind()
+
+            with profiler.phase('lod_select'):
+                levels = self.layer_levels(num_of_layers, Mp)
+
+            # the fur texture layer of each shell is its index times this
+            layer_scale = self.num_of_layers / num_of_layers
+
+            if self.instanced:
+                # All layers are drawn at once: the shader uses the instance ID as the layer, so the
+                # uniforms only need to be bound once. With levels of detail, there is one call for each
+                # run of layers drawn with the same levels, which starts at first_layer.
+                runs = self.instanced_runs(levels)
+                if self.indirect_buffer is not None:
+                    glBindBuffer(GL_DRAW_INDIRECT_BUFFER, self.indirect_buffer)
+
+                for first, instances, commands in runs:
+                    with profiler.phase('shader_bind'):
+                        self.instanced_shader.bind(
+                            model=self,
+                            M=M,
+                            current_layer=first,
+                            UVScale=1,
+                            furFlowOffset=0,
+                            num_of_layers=num_of_layers,
+                            fur_length=fur_length,
+                            layer_scale=layer_scale
+                        )
+                    with profiler.phase('draw_calls', gpu=True):
+                        if self.mesh.faces is None:
+                            glDrawArraysInstanced(self.primitive, 0, self.mesh.vertices.shape[0], instances)
+                        elif self.indirect:
+                            # all meshes in a single call, with the commands written by instanced_runs()
+                            glMultiDrawElementsIndirect(self.primitive, self.index_type, ctypes.c_void_p(commands),
+                                                        len(self.meshes), 0)
+                        else:
+                            counts, offsets = self.multi_draw(levels[first])
+                            for count, offset in zip(counts, offsets):
+                                glDrawElementsInstanced(self.primitive, int(count), self.index_type,
+                                                        ctypes.c_void_p(offset), instances)
+
+                glBindVertexArray(0)
+                return
 
             # This loops through the layers to draw them all, this means that the fur is generated.
             num = 1
-            for current_layer in range(self.num_of_layers):
-                num -= 1 // self.num_of_layers
+            for current_layer in range(num_of_layers):
+                num -= 1 // num_of_layers
                 if num > 1:
                     num = 1
                 if num < 0:
@@ -182,30 +469,86 @@ class BaseModel:
 
                 # This binds the vertex data from the VBO shader.
                 # It essentially just gives the shader the information that it needs to work.
-                self.shader.bind(
-                    model=self,
-                    M=np.matmul(Mp, self.M),
-                    current_layer=current_layer,
-                    UVScale=num,
-                    furFlowOffset=0,
-                    num_of_layers=num_of_layers,
-                    fur_length=fur_length
-                )
-
-                if self.mesh.faces is not None:
-                    # draw the data in the buffer using the index array
-                    glDrawElements(self.primitive, self.mesh.faces.flatten().shape[0], GL_UNSIGNED_INT, None)
-                else:
-                    # draw the data in the buffer using the vertex array ordering only.
-                    glDrawArrays(self.primitive, 0, self.mesh.vertices.shape[0])
+                with profiler.phase('shader_bind'):
+                    self.shader.bind(
+                        model=self,
+                        M=M,
+                        current_layer=current_layer,
+                        UVScale=num,
+                        furFlowOffset=0,
+                        num_of_layers=num_of_layers,
+                        fur_length=fur_length,
+                        layer_scale=layer_scale
+                    )
+
+                with profiler.phase('draw_calls', gpu=True):
+                    if self.mesh.faces is not None:
+                        # draw all meshes in the buffer using the index array, at the levels of detail of this layer
+                        counts, offsets = self.multi_draw(levels[current_layer])
+                        glMultiDrawElements(self.primitive, counts, self.index_type, offsets, len(counts))
+                    else:
+                        # draw the data in the buffer using the vertex array ordering only.
+                        glDrawArrays(self.primitive, 0, self.mesh.vertices.shape[0])
 
             glBindVertexArray(0)
 
+    def total_gpu_bytes(self):
+        """
+        :return: the number of bytes used on the GPU by the buffers and textures of this model, without the
+        textures shared through the texture cache
+        """
+        return self.gpu_bytes + self.furTex.data.nbytes
+
+    def release(self):
+        """
+        Release all VBO objects and textures. The model cannot be drawn afterwards.
+        """
+        if self.vao is None:
+            return
+
+        for vbo in self.vbos.values():
+            glDeleteBuffers(1, [vbo])
+        self.vbos = {}
+
+        if self.index_buffer is not None:
+            glDeleteBuffers(1, [self.index_buffer])
+            self.index_buffer = None
+
+        if self.indirect_buffer is not None:
+            glDeleteBuffers(1, [self.indirect_buffer])
+            self.indirect_buffer = None
+
+        glDeleteVertexArrays(1, [self.vao])
+        self.vao = None
+
+        # shaders are shared with other models, and released with the shader cache
+        self.furTex.release()
+        if self.skins is not None:
+            texture_cache.release(self.skins)
+            self.skins = None
+        for submesh in self.meshes:
+            submesh.release_textures()
+
     def __del__(self):
         """
         Release all VBO objects when finished.
         """
-        for vbo in self.vbos.values():
-            glDeleteBuffers(1, int(vbo))
+        self.release()
 
-        glDeleteVertexArrays(1, int(self.vao))
+
+def build_mesh_lods(meshes, lod=True):
+    """
+    Builds the levels of detail of each mesh of a model. This needs no OpenGL context, so the asset loader calls it
+    in a worker thread.
+    :param lod: if False, each mesh only has its full resolution level
+    :return: the list of levels of each mesh, as (mesh, error in model units) from the full mesh to the coarsest one
+    """
+    lods = []
+    for mesh in meshes:
+        if lod and mesh.faces is not None and mesh.faces.shape[1] == 3:
+            lods.append(build_lods(mesh))
+            print('- {} levels of detail: {} faces'.format(
+                len(lods[-1]), ', '.join(str(level.faces.shape[0]) for level, _ in lods[-1])))
+        else:
+            lods.append([(mesh, 0.)])
+    return lods
@@ -3,33 +3,60 @@ import pygame
 # import the scene class
 from scene import Scene
 
-from blender import load_obj_file
+from assetloader import AssetLoader, prepare_model
 
 from BaseModel import BaseModel
 
+from governor import ShellGovernor
+
+from modelregistry import ModelRegistry
+
+from profiler import profiler
+
 from shaders import *
 
 
 class RabbitScene(Scene):
-    def __init__(self):
-        Scene.__init__(self)
+    def __init__(self, width=800, height=600, headless=False, model='models/bunny_world.obj',
+                 fur_seed=None, on_demand=True, max_fps=60, vsync=False, lod=False, target_fps=None,
+                 async_loading=None):
+        """
+        :param async_loading: if True, models are loaded in a background thread, and the previous model is drawn
+        until the new one is ready. By default models are loaded in the background in a window, and at once when
+        headless, so that the model is drawn as soon as the scene is created.
+        """
+        # nothing moves on its own, so frames are only drawn after an input, at most 60 per second
+        Scene.__init__(self, width, height, headless, on_demand, max_fps, vsync)
 
         # Initialising the starting variables
         self.fur_density = 30000
         self.fur_length = 0.1
         self.num_of_layers = 30
+        self.instanced = False
 
-        # Loads the object, starts with bunny, can be swapped by pressing 'R' and back to bunny with 'B'
-        object_to_view = load_obj_file('models/bunny_world.obj')
+        # if True, models are drawn with simplified levels of detail when they are small on the screen
+        self.lod = lod
 
-        # Creating the object
-        self.object_to_view = BaseModel(
-            scene=self,
-            M=np.matmul(translationMatrix([0, +1, 0]), scaleMatrix([2, 2, 2])),
-            mesh=object_to_view[0],
-            num_of_layers=self.num_of_layers,
-            fur_density=self.fur_density,
-        )
+        # with a target frame rate, fewer shells are drawn when the frames take too long. The G key turns the
+        # governor on and off, with this budget or 60 frames per second by default
+        self.target_ms = 1000. / (60 if target_fps is None else target_fps)
+        self.governor = None if target_fps is None else ShellGovernor(self.num_of_layers, self.target_ms)
+
+        # None gives a different fur every run, an int seed makes the fur reproducible
+        self.fur_seed = fur_seed
+
+        # Models stay on the GPU once loaded, so switching between them is instant.
+        self.registry = ModelRegistry()
+
+        # the model shown and its file, None until the first one is loaded, and the key of the model being loaded
+        self.object_to_view = None
+        self.model_file = None
+        self.loading = None
+        self.async_loading = not headless if async_loading is None else async_loading
+        self.loader = AssetLoader()
+
+        # Loads the object, starts with bunny, can be swapped by pressing 'R' and back to bunny with 'B'
+        self.switchModel(model)
 
     def keyboard(self, event):
         """
@@ -51,6 +78,27 @@ class RabbitScene(Scene):
             print('Decreasing fur density')
             self.fur_density -= 5000
 
+        # toggles drawing all fur layers in a single instanced draw call
+        elif event.key == pygame.K_i:
+            self.instanced = not self.instanced
+            if self.object_to_view is not None:
+                self.object_to_view.instanced = self.instanced
+            print('Instanced fur drawing: {}'.format(self.instanced))
+
+        # toggles the levels of detail, the model is loaded again with or without them
+        elif event.key == pygame.K_o:
+            self.lod = not self.lod
+            print('Levels of detail: {}'.format(self.lod))
+            # the model being loaded, if any, is loaded again with the new setting instead of the one shown
+            file_name = self.model_file if self.loading is None else self.loading[0]
+            if file_name is not None:
+                self.switchModel(file_name)
+
+        # toggles the shell governor, which holds the target frame rate by drawing fewer shells
+        elif event.key == pygame.K_g:
+            self.governor = ShellGovernor(self.num_of_layers, self.target_ms) if self.governor is None else None
+            print('Shell governor: {}'.format(self.governor is not None))
+
         # changes the model to be a bunny
         elif event.key == pygame.K_b:
             self.switchBunny()
@@ -59,27 +107,82 @@ class RabbitScene(Scene):
         elif event.key == pygame.K_r:
             self.switchRock()
 
-    # Function which creates a bunny object
+    # Function which shows the object from a file, loading it the first time
+    def switchModel(self, file_name):
+        key = (file_name, self.num_of_layers, self.lod)
+        num_of_layers, fur_density, fur_seed, lod = self.num_of_layers, self.fur_density, self.fur_seed, self.lod
+
+        def prepare():
+            return prepare_model(file_name, num_of_layers, fur_density, fur_seed, lod)
+
+        def create(assets):
+            return BaseModel(
+                scene=self,
+                M=np.matmul(translationMatrix([0, +1, 0]), scaleMatrix([2, 2, 2])),
+                num_of_layers=num_of_layers,
+                fur_density=fur_density,
+                instanced=self.instanced,
+                lod=lod,
+                **assets
+            )
+
+        if key in self.registry or not self.async_loading:
+            self.loading = None
+            self.showModel(self.registry.get(key, lambda: create(prepare())), file_name)
+            return
+
+        # the current model and its file stay on the screen until the new one is ready
+        self.loading = key
+        self.window.set_title('Loading {}'.format(file_name))
+        self.loader.load(key, prepare, lambda assets: self.finishLoading(key, create, assets),
+                         lambda error: self.failLoading(key))
+
+    # Function which uploads a model loaded in the background, and shows it unless another one was chosen since
+    def finishLoading(self, key, create, assets):
+        if key != self.loading:
+            return
+        self.loading = None
+        self.window.set_title('')
+        self.showModel(self.registry.get(key, lambda: create(assets)), key[0])
+        self.request_redraw()
+
+    # Function called when a background load failed, the current model stays on the screen
+    def failLoading(self, key):
+        if key != self.loading:
+            return
+        self.loading = None
+        self.window.set_title('')
+
+    def showModel(self, model, file_name):
+        self.object_to_view = model
+        self.model_file = file_name
+        self.object_to_view.instanced = self.instanced
+
+        # the new model may be cheaper, so the governor starts again from all shells
+        if self.governor is not None:
+            self.governor.reset(self.num_of_layers)
+
+    def update(self):
+        """
+        Uploads the models loaded in the background, and draws the last frame again with all the shells once
+        nothing else is drawn.
+        """
+        self.loader.poll()
+
+        if self.governor is not None and self.on_demand and not (self.needs_redraw or self.animating):
+            if self.governor.idle():
+                self.request_redraw()
+
+    def busy(self):
+        return self.loader.busy()
+
+    # Function which shows a bunny object
     def switchBunny(self):
-        object_to_view = load_obj_file('models/bunny_world.obj')
-        self.object_to_view = BaseModel(
-            scene=self,
-            M=np.matmul(translationMatrix([0, +1, 0]), scaleMatrix([2, 2, 2])),
-            mesh=object_to_view[0],
-            num_of_layers=self.num_of_layers,
-            fur_density=self.fur_density,
-        )
-
-    # Function which creates a rock object
+        self.switchModel('models/bunny_world.obj')
+
+    # Function which shows a rock object
     def switchRock(self):
-        object_to_view = load_obj_file('models/rock.obj')
-        self.object_to_view = BaseModel(
-            scene=self,
-            M=np.matmul(translationMatrix([0, +1, 0]), scaleMatrix([2, 2, 2])),
-            mesh=object_to_view[0],
-            num_of_layers=self.num_of_layers,
-            fur_density=self.fur_density,
-        )
+        self.switchModel('models/rock.obj')
 
     def draw(self):
         """
@@ -87,19 +190,34 @@ class RabbitScene(Scene):
         :return: None
         """
 
+        if self.governor is not None:
+            self.governor.begin_frame()
+
         # first we need to clear the scene, we also clear the depth buffer to handle occlusions
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
-        self.camera.update()
+        with profiler.phase('camera'):
+            self.camera.update()
 
-        # for the bunny (it consists of a single mesh).
-        self.object_to_view.draw(self.fur_length, self.fur_density, self.num_of_layers)
+        # the governor may draw fewer shells than the fur texture has layers
+        num_of_layers = self.num_of_layers if self.governor is None else self.governor.layers
+
+        # all meshes of the model, one per material of the file, are drawn together. Nothing is drawn while the
+        # first model is loading.
+        if self.object_to_view is not None:
+            with profiler.phase('model_draw'):
+                self.object_to_view.draw(self.fur_length, self.fur_density, num_of_layers)
 
         # once we are done drawing, we display the scene
         # Note that here we use double buffering to avoid artefacts:
         # we draw on a different buffer than the one we display,
         # and flip the two buffers once we are done drawing.
-        pygame.display.flip()
+        self.window.flip()
+
+        # the buffer swap waits for the GPU when it is behind, so the frame time includes the GPU work
+        # with a new number of shells, the frame is drawn again even if nothing else changes
+        if self.governor is not None and self.governor.end_frame():
+            self.request_redraw()
 
 
 if __name__ == '__main__':
@@ -108,3 +226,4 @@ if __name__ == '__main__':
 
     # starts drawing the scene
     scene.run()
+    scene.loader.shutdown()
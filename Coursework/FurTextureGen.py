@@ -1,4 +1,5 @@
-import random
+from collections import OrderedDict
+
 import numpy as np
 
 from OpenGL.GL import *
@@ -6,33 +7,219 @@ from OpenGL.GL import *
 
 '''
 This is the function which creates a texture and plots lots of random points on its surface.
-Creates the fur effect. 
+Creates the fur effect.
+
+The position of strand k on a layer is a hash of (seed, layer, k), so the strands for any density can be
+computed on their own: raising the density only adds the strands k in [old, new), and lowering it removes them.
 '''
 
 
-def createFurTextures(size, num_of_layers, fur_density):
+def strandCounts(num_of_layers, fur_density):
+    '''
+    Returns the number of strands plotted on each layer, decreasing linearly from fur_density on the
+    first layer to give the strands a tapered tip.
+    '''
+    return np.array([max(int(fur_density * (1 - layer / num_of_layers)), 0) for layer in range(num_of_layers)],
+                    dtype=np.int64)
+
+
+def seedKey(seed):
+    '''
+    Converts a seed (None, an int or a numpy Generator) to the integer key used to hash strand positions.
+    '''
+    if seed is None or isinstance(seed, np.random.Generator):
+        return int(np.random.default_rng(seed).integers(2 ** 62))
+    return int(seed)
+
+
+def strandPositions(size, key, first, last):
+    '''
+    Returns the flat index in the fur volume of strands first[layer] <= k < last[layer] for every layer.
+    Each index is a splitmix64 hash of (key, layer, k), which gives uniformly distributed positions.
+    '''
+    counts = np.maximum(np.asarray(last) - np.asarray(first), 0)
+    layers = np.repeat(np.arange(counts.shape[0]), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(first, counts)
+
+    with np.errstate(over='ignore'):
+        h = np.uint64(key & 0xFFFFFFFFFFFFFFFF) + (layers.astype(np.uint64) << np.uint64(40)) + k.astype(np.uint64)
+        h = h * np.uint64(0x9E3779B97F4A7C15)
+        h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        h = h ^ (h >> np.uint64(31))
+
+    x_rand = (h & np.uint64(0xFFFFFFFF)) % np.uint64(size)
+    y_rand = (h >> np.uint64(32)) % np.uint64(size)
+    return size * size * layers + (size * y_rand + x_rand).astype(np.int64)
+
+
+def furCoverage(size, num_of_layers, fur_density, key):
+    '''
+    Returns the number of strands covering each texel of the fur volume, as a flat uint16 array.
+    This needs no OpenGL context, so it can be computed by a worker thread before the FurTexture is created.
+    '''
+    counts = strandCounts(num_of_layers, fur_density)
+    positions = strandPositions(size, key, np.zeros_like(counts), counts)
+    return np.bincount(positions, minlength=size * size * num_of_layers).astype(np.uint16)
+
+
+def generateFurData(size, num_of_layers, fur_density, seed=None):
+    '''
+    Generates the fur volume as a flat size * size * num_of_layers array of bytes, where
+    strands are 255 and everything else is transparent black (0).
+    :param seed: an int seed or a numpy Generator, for reproducible fur. If None, the fur is different every time.
+    '''
+    # Generates an empty dataset, filled with 0's. This makes it transparent black.
+    data = np.zeros(shape=size * size * num_of_layers, dtype=GLubyte)
+
+    # Randomly selects lots of pixels on each layer, all layers at once.
+    counts = strandCounts(num_of_layers, fur_density)
+    data[strandPositions(size, seedKey(seed), np.zeros_like(counts), counts)] = 255
+
+    return data
+
+
+class FurTextureCache:
+    '''
+    Least recently used cache of fur volumes, keyed by (size, num_of_layers, fur_density, seed key).
+    Each entry stores the number of strands covering each texel, so that a FurTexture can switch back
+    to a recent setting without computing any strand.
+    '''
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, coverage):
+        self.entries[key] = coverage
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+# cache shared by all fur textures
+fur_cache = FurTextureCache()
+
+
+class FurTexture:
+    '''
+    Fur texture which can be edited in place: changing the density only adds or removes the strands
+    which differ, and only the texels which changed are uploaded again.
+    '''
+
+    def __init__(self, size, num_of_layers, fur_density, seed=None, cache=fur_cache, coverage=None):
+        '''
+        :param coverage: [optional] the coverage computed by furCoverage() with the key of this seed, eg. by
+        the asset loader, otherwise it is computed here
+        '''
+        self.size = size
+        self.num_of_layers = num_of_layers
+        self.fur_density = fur_density
+        self.key = seedKey(seed)
+        self.cache = cache
+
+        # number of strands covering each texel, a texel is part of the fur if at least one strand covers it
+        if coverage is None:
+            coverage = furCoverage(size, num_of_layers, fur_density, self.key)
+        self.coverage = coverage
+        self.data = np.where(self.coverage > 0, 255, 0).astype(GLubyte)
+
+        # all layers are stored in a single channel texture array, indexed by the layer in the fragment shader
+        self.textureid = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D_ARRAY, self.textureid)
+        glTexStorage3D(GL_TEXTURE_2D_ARRAY, 1, GL_R8, size, size, num_of_layers)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_S, GL_REPEAT)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_T, GL_REPEAT)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        self.upload()
+
+    def cacheKey(self, fur_density):
+        return self.size, self.num_of_layers, fur_density, self.key
+
+    def setDensity(self, fur_density):
+        '''
+        Changes the fur density, adding or removing strands, and uploads the texels which changed.
+        '''
+        if fur_density == self.fur_density:
+            return
+
+        if self.cache is not None:
+            self.cache.put(self.cacheKey(self.fur_density), self.coverage.copy())
+            coverage = self.cache.get(self.cacheKey(fur_density))
+        else:
+            coverage = None
+
+        if coverage is not None:
+            # recent setting, no strand needs to be computed
+            changed = np.flatnonzero((coverage > 0) != (self.coverage > 0))
+            self.coverage = coverage.copy()
+        else:
+            old = strandCounts(self.num_of_layers, self.fur_density)
+            new = strandCounts(self.num_of_layers, fur_density)
+
+            # strands in [old, new) are added when the density increases, and removed when it decreases
+            added = strandPositions(self.size, self.key, old, new)
+            removed = strandPositions(self.size, self.key, new, old)
+            n = self.coverage.shape[0]
+            coverage = self.coverage + (np.bincount(added, minlength=n) - np.bincount(removed, minlength=n))
+            changed = np.flatnonzero((coverage > 0) != (self.coverage > 0))
+            self.coverage = coverage.astype(np.uint16)
+
+        self.fur_density = fur_density
+        self.data[changed] = np.where(self.coverage[changed] > 0, 255, 0)
+        self.upload(changed)
+
+    def upload(self, changed=None):
+        '''
+        Uploads the fur data to the GPU.
+        :param changed: [optional] the flat indices of the data which changed, only the rows of each
+        layer which contain them are uploaded again.
+        '''
+        glBindTexture(GL_TEXTURE_2D_ARRAY, self.textureid)
+
+        # rows are a single byte per texel, so they may not be aligned to 4 bytes
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+
+        if changed is None or changed.shape[0] > self.data.shape[0] // 4:
+            # the whole stack in one call
+            glTexSubImage3D(GL_TEXTURE_2D_ARRAY, 0, 0, 0, 0, self.size, self.size, self.num_of_layers, GL_RED,
+                            GL_UNSIGNED_BYTE, self.data)
+            return
 
-    # Generates an empty dataset
-    data = np.empty(shape=size * size * num_of_layers, dtype=GLubyte)
+        # otherwise, the range of rows which changed on each layer
+        rows = changed // self.size
+        layers = rows // self.size
+        for layer in np.unique(layers):
+            first = rows[layers == layer].min()
+            last = rows[layers == layer].max() + 1
+            glTexSubImage3D(GL_TEXTURE_2D_ARRAY, 0, 0, first % self.size, layer, self.size, last - first, 1, GL_RED,
+                            GL_UNSIGNED_BYTE, self.data[first * self.size:last * self.size])
 
-    # Fills the entire dataframe with 0's. This makes it transparent black.
-    data.fill(0.0 * 255.0)
+    def bind(self):
+        glBindTexture(GL_TEXTURE_2D_ARRAY, self.textureid)
 
-    # Randomly selects lots of pixels, as the pixels are put the same across all layers, strands of hair are formed.
-    # When combined, the hairs look like fur.
-    for layer in range(num_of_layers):
-        length = layer / num_of_layers
-        length = 1 - length
-        i_density = fur_density * length
-        for i in range(int(i_density)):
-            x_rand = random.randint(0, size - 1)
-            y_rand = random.randint(0, size - 1)
-            data[size * size * layer + size * y_rand + x_rand] = 1.0 * 255.0
+    def release(self):
+        '''
+        Deletes the GL texture.
+        '''
+        if self.textureid is not None:
+            glDeleteTextures(1, [self.textureid])
+            self.textureid = None
 
-    # This binds the texture, then returns it.
-    texID = glGenTextures(1)
-    glBindTexture(GL_TEXTURE_2D, texID)
-    glTexStorage2D(GL_TEXTURE_2D, 1, GL_RGBA8, size, size)
-    glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, size, size, GL_RGBA, GL_UNSIGNED_BYTE, data)
 
-    return texID
\ No newline at end of file
+def createFurTextures(size, num_of_layers, fur_density, seed=None):
+    '''
+    Creates a GL_TEXTURE_2D_ARRAY with one layer of fur per shell, and returns its ID.
+    '''
+    return FurTexture(size, num_of_layers, fur_density, seed, cache=None).textureid
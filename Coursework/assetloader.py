@@ -0,0 +1,104 @@
+from concurrent import futures
+
+from BaseModel import build_mesh_lods
+from FurTextureGen import furCoverage, seedKey
+from blender import load_obj_file
+from texture import load_image
+
+'''
+Loads models in the background, so that the window keeps drawing while a model is loaded.
+The CPU work (parsing the OBJ file, computing normals, optimising the meshes, decoding the textures, building the
+levels of detail and the fur volume) runs in a worker thread. OpenGL calls must be made from the thread of the GL
+context, so the buffers and textures are created by poll(), which the scene calls from its loop once the work is done.
+
+numpy releases the GIL in most of the array work, so the main thread keeps drawing while a model is loaded. A single
+worker is used by default: the python loops of the loader hold the GIL, and more workers would slow down the frames.
+'''
+
+
+def prepare_model(file_name, num_of_layers, fur_density, fur_seed=None, lod=False, fur_size=128):
+    '''
+    Does all the work needed to create a model which does not need an OpenGL context.
+    :return: a dict of the arguments of BaseModel: mesh, lods, fur_seed, fur_coverage and images
+    '''
+    meshes = load_obj_file(file_name)
+
+    # the textures are decoded here, the GL thread then only uploads the pixels
+    images = {}
+    for mesh in meshes:
+        if mesh.material.texture is not None and mesh.material.texture not in images:
+            images[mesh.material.texture] = load_image(mesh.material.texture)
+
+    # a random seed is drawn here, so that the coverage and the texture use the same strands
+    key = seedKey(fur_seed)
+    return {
+        'mesh': meshes,
+        'lods': build_mesh_lods(meshes, lod),
+        'fur_seed': key,
+        'fur_coverage': furCoverage(fur_size, num_of_layers, fur_density, key),
+        'images': images,
+    }
+
+
+class AssetLoader:
+    '''
+    Runs the preparation of assets in worker threads, and finishes them on the thread which calls poll().
+    Each load has a key, a load which is already running is not started again.
+    '''
+
+    def __init__(self, max_workers=1):
+        self.executor = futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='assetloader')
+
+        # dict of {key: (future of the prepared data, function finishing the load, function called on error)}
+        self.pending = {}
+
+    def load(self, key, prepare, finish, error=None):
+        '''
+        Starts a load in the background.
+        :param prepare: function called without arguments in a worker thread, it must not make any OpenGL call
+        :param finish: function called with the result of prepare by poll(), eg. to upload it to the GPU
+        :param error: [optional] function called by poll() with the exception if prepare failed
+        '''
+        if key in self.pending:
+            return
+        print('(A) Loading {} in the background'.format(key))
+        self.pending[key] = (self.executor.submit(prepare), finish, error)
+
+    def busy(self):
+        return len(self.pending) > 0
+
+    def poll(self):
+        '''
+        Finishes the loads whose preparation is done, in the order they were started. Call this from the GL thread.
+        :return: the number of loads finished
+        '''
+        finished = 0
+        for key, (future, finish, error) in list(self.pending.items()):
+            if not future.done():
+                continue
+            del self.pending[key]
+            try:
+                data = future.result()
+            except Exception as exception:
+                print('(E) Error loading {}: {}'.format(key, exception))
+                if error is not None:
+                    error(exception)
+                continue
+            finish(data)
+            finished += 1
+        return finished
+
+    def wait(self):
+        '''
+        Waits for all the loads and finishes them.
+        '''
+        while self.pending:
+            futures.wait([future for future, _, _ in self.pending.values()])
+            self.poll()
+
+    def shutdown(self):
+        '''
+        Cancels the loads which have not started, the running ones are finished by their thread.
+        '''
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.pending.clear()
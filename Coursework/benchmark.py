@@ -0,0 +1,354 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+import numpy as np
+
+from FurTextureGen import generateFurData, strandCounts, strandPositions
+from blender import ObjStream, load_obj_file, process_line, fix_blender_textures
+from camera import Camera
+from furreference import clip_positions
+from matutils import *
+from mesh import Mesh
+from meshoptimize import optimize_mesh
+from simplify import build_lods
+from vertexformat import COMPACT
+
+'''
+Benchmarks for the CPU side of the asset pipeline, none of them needs a GL context. Run from the Coursework folder:
+    python benchmark.py --save baseline.json
+    python benchmark.py --compare baseline.json
+Each case is run on the bundled models and on synthetic meshes of 1k to 5M faces. The wall time is the best of
+several runs, and the peak memory is measured with tracemalloc in a separate run.
+'''
+
+# number of faces of the synthetic meshes
+SYNTHETIC_SIZES = [1000, 10000, 100000, 1000000, 5000000]
+
+# the line by line reader is only run on meshes up to this size, it takes minutes on the largest ones
+PROCESS_LINE_MAX_FACES = 100000
+
+# read_obj_file holds all lines of the file in memory, several GB for the largest meshes. load_obj_file streams
+# files larger than STREAM_MIN_BYTES instead, but takes minutes on the largest ones with the mesh optimisation
+LOAD_OBJ_MAX_FACES = 1000000
+
+# the CPU shell extrusion stores 30 layers of clip positions, 2 GB for the largest meshes
+SHELL_MAX_FACES = 1000000
+
+# the simplifier takes several seconds for 100k faces
+SIMPLIFY_MAX_FACES = 100000
+
+# the triangle reordering loops over the faces in python, several seconds for 1M faces
+OPTIMIZE_MAX_FACES = 1000000
+
+
+def calculate_normals_loop(vertices, faces):
+    '''
+    Reference implementation of Mesh.calculate_normals, one face at a time, used as a baseline.
+    '''
+    normals = np.zeros((vertices.shape[0], 3), dtype='f')
+    for f in range(faces.shape[0]):
+        a = vertices[faces[f, 1]] - vertices[faces[f, 0]]
+        b = vertices[faces[f, 2]] - vertices[faces[f, 0]]
+        face_normal = np.cross(a, b)
+        for j in range(3):
+            normals[faces[f, j], :] += face_normal
+    return normals / np.linalg.norm(normals, axis=1, keepdims=True)
+
+
+def generate_fur_loop(size, num_of_layers, fur_density):
+    '''
+    Reference implementation of FurTextureGen.generateFurData, one strand at a time, used as a baseline.
+    '''
+    data = np.zeros(shape=size * size * num_of_layers, dtype=np.uint8)
+    for layer in range(num_of_layers):
+        for i in range(int(fur_density * (1 - layer / num_of_layers))):
+            x_rand = random.randint(0, size - 1)
+            y_rand = random.randint(0, size - 1)
+            data[size * size * layer + size * y_rand + x_rand] = 255
+    return data
+
+
+def best_time(function, repeat=5):
+    '''
+    :return: the best wall time of a function over a number of runs, in seconds
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def bench_normals(mesh):
+    '''
+    Compares Mesh.calculate_normals against the face by face loop.
+    '''
+    loop = best_time(lambda: calculate_normals_loop(mesh.vertices, mesh.faces), repeat=1)
+    batched = best_time(mesh.calculate_normals)
+    print('calculate_normals: {} faces, loop {:.2f} ms, batched {:.2f} ms ({:.0f}x)'.format(
+        mesh.faces.shape[0], loop * 1e3, batched * 1e3, loop / batched))
+
+
+def bench_fur(size=128, num_of_layers=30, fur_density=30000):
+    '''
+    Compares generateFurData against the strand by strand loop.
+    '''
+    loop = best_time(lambda: generate_fur_loop(size, num_of_layers, fur_density), repeat=1)
+    batched = best_time(lambda: generateFurData(size, num_of_layers, fur_density, seed=0))
+    print('generateFurData: {} layers, density {}, loop {:.2f} ms, batched {:.2f} ms ({:.0f}x)'.format(
+        num_of_layers, fur_density, loop * 1e3, batched * 1e3, loop / batched))
+
+
+def synthetic_mesh(num_faces):
+    '''
+    Creates a torus of about num_faces triangles, with texture coordinates which wrap around it,
+    so that the vertices on the seams are used with two texture coordinates, as in Blender files.
+    :return: the vertices, texture coordinates and (m, 3, 2) faces with 1-based (vertex, texture) indices
+    '''
+    n = max(int(np.sqrt(num_faces / 2)), 3)
+    u, v = np.meshgrid(np.linspace(0., 2 * np.pi, n, endpoint=False), np.linspace(0., 2 * np.pi, n, endpoint=False))
+    vertices = np.stack([(2 + np.cos(v)) * np.cos(u), (2 + np.cos(v)) * np.sin(u), np.sin(v)], axis=-1)
+    textures = np.stack(np.meshgrid(np.linspace(0., 1., n + 1), np.linspace(0., 1., n + 1)), axis=-1)
+
+    # each grid cell is split in two triangles, positions wrap around the torus but texture coordinates do not
+    i, j = [a.ravel() for a in np.meshgrid(np.arange(n), np.arange(n), indexing='ij')]
+    corners = [(i, j), (i, j + 1), (i + 1, j + 1), (i, j), (i + 1, j + 1), (i + 1, j)]
+    vindex = np.stack([(a % n) * n + (b % n) for a, b in corners], axis=1).reshape(-1, 3)
+    tindex = np.stack([a * (n + 1) + b for a, b in corners], axis=1).reshape(-1, 3)
+    faces = np.stack([vindex, tindex], axis=-1).astype(np.uint32) + 1
+
+    return vertices.reshape(-1, 3).astype('f'), textures.reshape(-1, 2).astype('f'), faces
+
+
+def write_obj(file_name, vertices, textures, faces):
+    '''
+    Writes a mesh to an OBJ file, with v/vt faces.
+    '''
+    with open(file_name, 'w') as file:
+        np.savetxt(file, vertices, fmt='v %.6f %.6f %.6f')
+        np.savetxt(file, textures, fmt='vt %.6f %.6f')
+        np.savetxt(file, faces.reshape(-1, 6), fmt='f %d/%d %d/%d %d/%d')
+
+
+def measure(function, repeat=5):
+    '''
+    :return: the best wall time of a function over a number of runs in seconds, and its peak memory in bytes
+    '''
+    wall = best_time(function, repeat)
+
+    # tracemalloc slows down allocations, so the peak is measured in its own run
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return wall, peak
+
+
+def read_arrays(file_name):
+    '''
+    :return: the vertices, texture coordinates and (m, 3, 2) faces of a v/vt OBJ file, as read from the file
+    '''
+    with open(file_name) as file:
+        lines = file.read().splitlines()
+    vertices = np.array([line.split()[1:] for line in lines if line.startswith('v ')], dtype='f')
+    textures = np.array([line.split()[1:3] for line in lines if line.startswith('vt ')], dtype='f')
+    faces = np.array([[corner.split('/')[:2] for corner in line.split()[1:4]]
+                      for line in lines if line.startswith('f ')], dtype=np.uint32)
+    return vertices, textures, faces
+
+
+def mesh_cases(name, file_name, vertices, textures, faces):
+    '''
+    :return: the (name, function) cases run on a mesh and the OBJ file it was written to
+    '''
+    with redirect_stdout(io.StringIO()):
+        new_vertices, _, new_faces, _ = fix_blender_textures(textures, faces, vertices)
+        mesh = Mesh(vertices=new_vertices, faces=new_faces)
+
+    cases = [
+        ('fix_blender_textures/' + name, lambda: fix_blender_textures(textures, faces, vertices)),
+        ('calculate_normals/' + name, mesh.calculate_normals),
+        ('pack_vertices/' + name, lambda: COMPACT.pack([('position', mesh.vertices), ('normal', mesh.normals)])),
+    ]
+
+    # the streaming reader only keeps a chunk of lines in memory, so it runs on all sizes
+    cases.append(('stream_obj_file/' + name, lambda: list(ObjStream(file_name))))
+
+    # the file readers keep every line in memory as a python string, which does not fit for the largest meshes
+    if faces.shape[0] <= LOAD_OBJ_MAX_FACES:
+        cases.append(('load_obj_file/' + name, lambda: load_obj_file(file_name, cache=None)))
+    if faces.shape[0] <= SHELL_MAX_FACES:
+        with redirect_stdout(io.StringIO()):
+            mesh.calculate_normals()
+        V = Camera().V
+        P = frustumMatrix(-1., 1., -1., 1., 1.5, 50.)
+        cases.append(('clip_positions/' + name, lambda: clip_positions(mesh.vertices, mesh.normals, poseMatrix(),
+                                                                       V, P, 30, 0.1)))
+    if faces.shape[0] <= SIMPLIFY_MAX_FACES:
+        cases.append(('build_lods/' + name, lambda: build_lods(mesh)))
+    if faces.shape[0] <= OPTIMIZE_MAX_FACES:
+        # the mesh is optimised in place, so each run works on a copy
+        cases.append(('optimize_mesh/' + name, lambda: optimize_mesh(
+            Mesh(vertices=mesh.vertices.copy(), faces=mesh.faces.copy(), normals=mesh.normals), report=False)))
+    if faces.shape[0] <= PROCESS_LINE_MAX_FACES:
+        def read_lines():
+            with open(file_name) as file:
+                return [process_line(line) for line in file]
+        cases.append(('process_line/' + name, read_lines))
+    return cases
+
+
+def fur_cases():
+    '''
+    :return: the cases for the CPU side of the fur textures: the whole volume, and a density change
+    '''
+    cases = []
+    for size, num_of_layers, fur_density in [(128, 30, 30000), (256, 60, 120000)]:
+        counts = strandCounts(num_of_layers, fur_density)
+        more = strandCounts(num_of_layers, fur_density + 5000)
+        label = '{}x{}x{}'.format(size, size, num_of_layers)
+        cases.append(('generateFurData/' + label, lambda s=size, n=num_of_layers, d=fur_density:
+                      generateFurData(s, n, d, seed=0)))
+        cases.append(('fur_density_change/' + label, lambda s=size, c=counts, m=more:
+                      np.bincount(strandPositions(s, 0, c, m), minlength=s * s * len(c))))
+    return cases
+
+
+def matutils_cases(calls=10000):
+    '''
+    :return: the cases for the matrix builders, each one called a number of times
+    '''
+    camera = Camera()
+
+    def repeat(function):
+        def run():
+            for _ in range(calls):
+                function()
+        return run
+
+    return [
+        ('matutils/translationMatrix', repeat(lambda: translationMatrix([1., 2., 3.]))),
+        ('matutils/scaleMatrix', repeat(lambda: scaleMatrix([2., 2., 2.]))),
+        ('matutils/rotationMatrixY', repeat(lambda: rotationMatrixY(0.5))),
+        ('matutils/poseMatrix', repeat(lambda: poseMatrix([1., 2., 3.], 0.5, 2.))),
+        ('matutils/frustumMatrix', repeat(lambda: frustumMatrix(-1., 1., -1., 1., 1.5, 50.))),
+        ('Camera.update', repeat(camera.update)),
+    ]
+
+
+def run_suite(sizes, repeat=5):
+    '''
+    Runs all cases.
+    :param sizes: the number of faces of the synthetic meshes
+    :return: a dict of {case name: {'time': seconds, 'peak': bytes}}
+    '''
+    results = {}
+
+    def run(cases, repeat):
+        for name, function in cases:
+            with redirect_stdout(io.StringIO()):
+                wall, peak = measure(function, repeat)
+            results[name] = {'time': wall, 'peak': peak}
+            print('{:<40}{:>12.3f} ms{:>12.1f} MB'.format(name, wall * 1e3, peak / 2 ** 20))
+
+    run(fur_cases(), repeat)
+    run(matutils_cases(), repeat)
+
+    for file_name in ['models/bunny_world.obj', 'models/rock.obj']:
+        name = os.path.splitext(os.path.basename(file_name))[0]
+        run(mesh_cases(name, file_name, *read_arrays(file_name)), repeat)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for num_faces in sizes:
+            file_name = os.path.join(directory, 'synthetic_{}.obj'.format(num_faces))
+            vertices, textures, faces = synthetic_mesh(num_faces)
+            write_obj(file_name, vertices, textures, faces)
+            # large meshes take seconds per run, once is enough
+            run(mesh_cases('synthetic_{}'.format(num_faces), file_name, vertices, textures, faces),
+                repeat if num_faces <= 100000 else 1)
+            del vertices, textures, faces
+            os.remove(file_name)
+
+    return results
+
+
+def save_results(file_name, results):
+    with open(file_name, 'w') as file:
+        json.dump({
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.platform(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'results': results
+        }, file, indent=2)
+    print('Saved {} results to {}'.format(len(results), file_name))
+
+
+def compare_results(file_name, results, threshold=0.25, min_time=1e-3):
+    '''
+    Compares the results with a baseline, and prints the cases which got slower or use more memory.
+    :param threshold: the relative increase above which a case is flagged, 0.25 for 25%
+    :param min_time: time increases smaller than this, in seconds, are timing noise and never flagged
+    :return: the list of regressions, as (case name, measure, baseline value, new value)
+    '''
+    with open(file_name) as file:
+        baseline = json.load(file)['results']
+
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for key in ['time', 'peak']:
+            old, new = baseline[name][key], result[key]
+            if old > 0 and new > old * (1 + threshold) and (key != 'time' or new - old > min_time):
+                regressions.append((name, key, old, new))
+
+    for name, key, old, new in regressions:
+        if key == 'time':
+            print('(E) Regression in {}: {:.3f} ms -> {:.3f} ms'.format(name, old * 1e3, new * 1e3))
+        else:
+            print('(E) Regression in {}: {:.1f} MB -> {:.1f} MB peak'.format(name, old / 2 ** 20, new / 2 ** 20))
+    if not regressions:
+        print('No regression against {} (threshold {:.0f}%)'.format(file_name, threshold * 100))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the CPU side of the asset pipeline.')
+    parser.add_argument('--max-faces', type=int, default=SYNTHETIC_SIZES[-1],
+                        help='largest synthetic mesh, eg. 100000 for a quick run')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each case, the best time is kept')
+    parser.add_argument('--save', help='saves the results to this JSON file, to be used as a baseline')
+    parser.add_argument('--compare', help='flags the cases which regressed against this JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='relative increase flagged as a regression')
+    parser.add_argument('--reference', action='store_true',
+                        help='only compares the batched normals and fur with the original loops')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.reference:
+        bench_fur()
+        for file_name in ['models/bunny_world.obj', 'models/rock.obj']:
+            with redirect_stdout(io.StringIO()):
+                mesh = load_obj_file(file_name, cache=None)[0]
+            print('--- {}'.format(file_name))
+            bench_normals(mesh)
+        raise SystemExit(0)
+
+    results = run_suite([n for n in SYNTHETIC_SIZES if n <= args.max_faces], args.repeat)
+    if args.save is not None:
+        save_results(args.save, results)
+    if args.compare is not None and compare_results(args.compare, results, args.threshold):
+        raise SystemExit(1)
@@ -1,7 +1,13 @@
+import mmap
+import os
+import time
+
 import numpy as np
 
 from material import Material, MaterialLibrary
-from mesh import Mesh
+from mesh import Mesh, vertex_normals
+from meshcache import mesh_cache
+from meshoptimize import optimize_mesh
 
 '''
 Functions for reading models from blender. 
@@ -79,7 +85,7 @@ def process_line(line):
 
 
 def load_material_library(file_name):
-    library = MaterialLibrary()
+    library = MaterialLibrary(file_name)
     material = None
 
     print('-- Loading material library {}'.format(file_name))
@@ -118,120 +124,363 @@ def load_material_library(file_name):
     return library
 
 
-def load_obj_file(file_name):
+def _parse_floats(rows, width):
+    '''
+    Converts a list of whitespace separated number strings into a (len(rows), width) float array in a single
+    call to numpy. Rows with extra entries (eg. vertex colours, or a 3rd texture coordinate) are truncated and
+    short rows are padded with zeros, which requires the slower row by row path.
+    '''
+    if len(rows) == 0:
+        return np.zeros((0, width), dtype='f')
+
+    values = np.fromstring(' '.join(rows), dtype='f', sep=' ')
+    if values.shape[0] == width * len(rows):
+        return values.reshape(-1, width)
+
+    # irregular rows, we fall back to converting them one by one
+    array = np.zeros((len(rows), width), dtype='f')
+    for i, row in enumerate(rows):
+        fields = row.split()[:width]
+        array[i, :len(fields)] = [float(token) for token in fields]
+    return array
+
+
+def _parse_faces(rows, counts):
+    '''
+    Converts the face lines of an OBJ file into a (n, 3, 3) array of indices in one pass.
+    Each corner is stored as (vertex, texture, normal) index, using the 1-based (or negative, relative)
+    indices from the file, and 0 where the index is absent (eg. f v//n or f v).
+    Faces with more than 3 corners are converted to triangles as a fan around their first corner.
+    :param rows: the list of face lines, stripped of the leading 'f'
+    :param counts: the number of vertices, texture coordinates and normals read before each face line
+    :return: an int64 array of triangle corners, and for each triangle the index of its face line.
+    '''
+    text = '\n'.join(rows).replace('//', '/0/')
+    chars = np.frombuffer(text.encode('ascii'), dtype=np.uint8)
+
+    # find where each corner (token) starts, which line it is on and how many '/' it contains
+    newline = chars == ord('\n')
+    blank = newline | (chars == ord(' ')) | (chars == ord('\r'))
+    starts = ~blank
+    starts[1:] &= blank[:-1]
+    starts = np.flatnonzero(starts)
+    ntokens = starts.shape[0]
+    corners = np.bincount(np.searchsorted(np.flatnonzero(newline), starts), minlength=len(rows))
+    slashes = np.bincount(np.searchsorted(starts, np.flatnonzero(chars == ord('/')), side='right') - 1,
+                          minlength=ntokens)
+
+    # read all numbers at once, then scatter them to their (vertex, texture, normal) slot
+    numbers = np.fromstring(text.replace('/', ' '), dtype=np.int64, sep=' ')
+    if numbers.shape[0] != np.sum(slashes + 1):
+        raise ValueError('Could not read face indices, unexpected characters in face lines')
+    slot = np.arange(numbers.shape[0]) - np.repeat(np.cumsum(slashes + 1) - slashes - 1, slashes + 1)
+    indices = np.zeros((ntokens, 3), dtype=np.int64)
+    indices[np.repeat(np.arange(ntokens), slashes + 1), slot] = numbers
+
+    # negative indices are relative to the number of elements read so far
+    counts = np.repeat(counts, corners, axis=0)
+    indices = np.where(indices < 0, indices + counts + 1, indices)
+
+    # triangulate every face as a fan: (0, i, i+1) for i in 1..n-2
+    if np.any(corners < 3):
+        print('(E) Error, at least 3 entries expected for faces, skipping {} faces'.format(np.sum(corners < 3)))
+    triangles = np.maximum(corners - 2, 0)
+    first = np.cumsum(corners) - corners
+    face_of_triangle = np.repeat(np.arange(len(rows)), triangles)
+    fan = np.arange(triangles.sum()) - np.repeat(np.cumsum(triangles) - triangles, triangles) + 1
+    start = first[face_of_triangle]
+    triangle_corners = np.stack([start, start + fan, start + fan + 1], axis=1)
+
+    return indices[triangle_corners], face_of_triangle
+
+
+# the types of lines which are read, smoothing groups and object or group names are known but not used
+OBJ_LABELS = ['v ', 'vt', 'vn', 'f ', 'mt', 'us', 's ', 'o ', 'g ', '']
+
+
+def _label_lines(lines):
+    '''
+    Finds the type of each line from its first two characters, which are enough to tell the types apart.
+    Lines of an unknown type are ignored, with one error per type.
+    :param lines: the lines of the file, stripped of their leading whitespace
+    '''
+    labels = np.array([line[:2] for line in lines], dtype='U2')
+    unknown = ~np.isin(labels, OBJ_LABELS) & ~np.char.startswith(labels, '#')
+    for label in np.unique(labels[unknown]):
+        found = np.flatnonzero(labels == label)
+        print('(E) Unknown line, ignored {} line(s) like: {}'.format(found.shape[0], lines[found[0]]))
+    return labels
+
+
+# files larger than this are read in chunks by ObjStream, rather than all at once by read_obj_file
+STREAM_MIN_BYTES = 64 * 1024 * 1024
+
+
+def load_obj_file(file_name, cache=mesh_cache):
     '''
 	Function for loading a Blender3D object file. minimalistic, and partial,
 	but sufficient for this course. You do not really need to worry about it.
+	The processed meshes are kept in an on-disk cache, so that loading the same
+	file again does not need to parse it.
+	:param cache: the MeshCache to use, or None to always parse the file
 	'''
-    print('Loading mesh(es) from Blender file: {}'.format(file_name))
+    if cache is not None:
+        meshes = cache.load(file_name, load_material_library)
+        if meshes is not None:
+            return meshes
+
+    if os.path.getsize(file_name) >= STREAM_MIN_BYTES:
+        stream = ObjStream(file_name)
+        meshes = list(stream)
+        library = stream.library
+    else:
+        meshes, library = read_obj_file(file_name)
+
+    if cache is not None:
+        cache.store(file_name, meshes, library)
 
-    vlist = []  # list of vertices
-    tlist = []  # list of texture vectors
-    flist = []  # list of polygonal faces
-    mlist = []  # list of material names
+    return meshes
 
-    lnlist = []
-    mesh_id = 0
-    mesh_list = []
 
-    # current material object
-    material = None
+def read_obj_file(file_name):
+    '''
+	Parses a Blender3D object file. Lines are sorted by their label in bulk,
+	then each type is converted to a numpy array at once rather than one line
+	at a time.
+	:return: the list of meshes and the material library used by the file
+	'''
+    print('Loading mesh(es) from Blender file: {}'.format(file_name))
+    t0 = time.perf_counter()
 
     with open(file_name) as objfile:
-        line_nb = 0  # count line number for easier error locating
-
-        # loop over all lines in the file
-        for line in objfile:
-            # process the line
-            data = process_line(line)
-
-            line_nb += 1  # increment line
-
-            # skip empty lines
-            if data is None:
-                continue
-
-            elif data[0] == 'vertex':
-                vlist.append(data[1])
-
-            elif data[0] == 'normal':
-                vlist.append(data[1])
-
-            elif data[0] == 'vertex texture':
-                tlist.append(data[1])
-
-            elif data[0] == 'face':
-                if len(data[1]) == 3:
-                    flist.append(data[1])
-                    mesh_list.append(mesh_id)
-                    mlist.append(material)
-                    lnlist.append(line_nb)
-                else:
-                    # converts quads into pairs of  triangles
-                    face1 = [data[1][0], data[1][1], data[1][2]]
-                    flist.append(face1)
-                    mesh_list.append(mesh_id)
-                    mlist.append(material)
-                    lnlist.append(line_nb)
-
-                    face2 = [data[1][0], data[1][2], data[1][3]]
-                    flist.append(face2)
-                    mesh_list.append(mesh_id)
-                    mlist.append(material)
-                    lnlist.append(line_nb)
-
-            elif data[0] == 'material library':
-                library = load_material_library('models/{}'.format(data[1]))
-
-            # material indicate a new mesh in the file, so we store the previous one if not empty and start
-            # a new one.
-            elif data[0] == 'material':
-                material = library.names[data[1]]
-                mesh_id += 1
-                print('[l.{}] Loading mesh with material: {}'.format(line_nb, data[1]))
-
-    print('File read. Found {} vertices and {} faces.'.format(len(vlist), len(flist)))
-
-    return create_meshes_from_blender(vlist, flist, mlist, tlist, library, mesh_list, lnlist)
-
-
-def create_meshes_from_blender(vlist, flist, mlist, tlist, library, mesh_list, lnlist):
-    fstart = 0
-    mesh_id = 1
-    meshes = []
+        lines = [line.lstrip() for line in objfile.read().replace('\t', ' ').splitlines()]
+
+    labels = _label_lines(lines)
+    is_vertex = labels == 'v '
+    is_texture = labels == 'vt'
+    is_normal = labels == 'vn'
+    is_face = labels == 'f '
+    is_material = labels == 'us'
+
+    library = None
+    materials = [-1]  # material index for each mesh id, mesh 0 is used for faces before any usemtl
+    for line_nb in np.flatnonzero((labels == 'mt') | is_material):
+        fields = lines[line_nb].split()
+        if fields[0] == 'mtllib':
+            library = load_material_library(os.path.join(os.path.dirname(file_name), fields[1]))
+
+        # material indicate a new mesh in the file, so we store the previous one if not empty and start
+        # a new one.
+        elif fields[0] == 'usemtl':
+            materials.append(library.names[fields[1]])
+            print('[l.{}] Loading mesh with material: {}'.format(line_nb + 1, fields[1]))
+
+    varray = _parse_floats([lines[i][2:] for i in np.flatnonzero(is_vertex)], 3)
+    tarray = _parse_floats([lines[i][3:] for i in np.flatnonzero(is_texture)], 2)
+
+    # for each face: the line number, the mesh it belongs to, and how many elements were read before it
+    fidx = np.flatnonzero(is_face)
+    counts = np.stack([np.searchsorted(np.flatnonzero(mask), fidx) for mask in (is_vertex, is_texture, is_normal)],
+                      axis=1)
+    mesh_list = np.searchsorted(np.flatnonzero(is_material), fidx)
+    faces, face_line = _parse_faces([lines[i][2:] for i in fidx], counts)
+
+    # drop the texture and normal indices if the file does not provide them, so that
+    # the number of indices per corner matches the face format.
+    if not np.any(faces[:, :, 2]):
+        faces = faces[:, :, :2]
+        if not np.any(faces[:, :, 1]):
+            faces = faces[:, :, :1]
+
+    print('File read in {:.3f}s. Found {} vertices and {} faces.'.format(
+        time.perf_counter() - t0, varray.shape[0], faces.shape[0]))
+
+    mesh_list = mesh_list[face_line]
+    meshes = create_meshes_from_blender(varray, faces, np.array(materials)[mesh_list], tarray, library, mesh_list,
+                                        fidx[face_line] + 1)
+    return meshes, library
+
+
+class GrowableArray:
+    '''
+    Array of rows which doubles its capacity when it is full, so that rows can be appended without knowing how many
+    there will be, using at most twice the memory of the rows rather than a python object per value.
+    '''
+
+    def __init__(self, width, dtype, capacity=1024):
+        self.data = np.empty((capacity, width), dtype=dtype)
+        self.size = 0
 
-    # we start by putting all vertices in one array
-    varray = np.array(vlist, dtype='f')
+    def __len__(self):
+        return self.size
 
-    # and all texture vectors
-    tarray = np.array(tlist, dtype='f')
+    def extend(self, rows):
+        end = self.size + rows.shape[0]
+        if end > self.data.shape[0]:
+            grown = np.empty((max(end, 2 * self.data.shape[0]), self.data.shape[1]), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:end] = rows
+        self.size = end
 
-    material = mlist[fstart]
+    def array(self):
+        '''
+        :return: the rows appended so far, as a view which is only valid until the next call to extend()
+        '''
+        return self.data[:self.size]
 
-    for f in range(len(flist)):
-        if mesh_id != mesh_list[f]:  # new mesh is denoted by change in material
-            print('Creating new mesh %i, faces %i-%i, line %i, with material %i: %s' % (
-                mesh_id, fstart, f, lnlist[fstart], mlist[fstart], library.materials[mlist[fstart]].name))
-            try:
-                mesh = create_mesh(varray, tarray, flist, fstart, f, library, material)
-                meshes.append(mesh)
-            except Exception as e:
-                print('(W) could not load mesh!')
-                print(e)
-                raise
+    def clear(self):
+        self.size = 0
 
-            mesh_id = mesh_list[f]
 
-            # start the next mesh
-            fstart = f
-            material = mlist[fstart]
+class ObjStream:
+    '''
+    Reads an OBJ file in chunks from a memory map, for files too large for read_obj_file, which holds all the lines of
+    the file as python strings. Iterating over it yields one mesh per usemtl group, as soon as the group ends.
+    Vertices and texture coordinates are shared by all groups, so they are kept in growable arrays until the end,
+    while the faces of each group are dropped once its mesh is created. The peak memory is about twice the arrays
+    read, plus the lines of a single chunk.
+    Each chunk is parsed with the same functions as read_obj_file. Unlike read_obj_file, which drops the texture
+    indices only if the whole file has none, a group without texture indices has no texture coordinates.
+    '''
 
-    # add the last mesh
-    try:
-        meshes.append(create_mesh(varray, tarray, flist, fstart, len(flist), library, material))
-    except:
-        print('(W) could not load mesh!')
-        raise
+    def __init__(self, file_name, chunk_size=1024 * 1024):
+        '''
+        :param chunk_size: the number of bytes parsed at a time, cut at the end of a line. The parsing temporaries
+        take about 12 times this size, larger chunks are not faster.
+        '''
+        self.file_name = file_name
+        self.chunk_size = chunk_size
+
+        # the material library of the file, once its mtllib line was read
+        self.library = None
+
+    def __iter__(self):
+        print('Streaming mesh(es) from Blender file: {}'.format(self.file_name))
+        t0 = time.perf_counter()
+
+        vertices = GrowableArray(3, 'f')
+        textures = GrowableArray(2, 'f')
+        normal_count = 0
+
+        # the (vertex, texture) index of the 3 corners of each triangle of the current group, and its material
+        faces = GrowableArray(6, np.uint32)
+        material = -1
+        meshes = 0
+
+        with open(self.file_name, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for lines in self.chunks(data):
+                    labels = _label_lines(lines)
+
+                    # the elements between two mtllib or usemtl lines are read at once
+                    start = 0
+                    for line_nb in list(np.flatnonzero((labels == 'mt') | (labels == 'us'))) + [len(lines)]:
+                        normal_count = self.read_elements(lines[start:line_nb], labels[start:line_nb], vertices,
+                                                          textures, normal_count, faces)
+                        start = line_nb + 1
+                        if line_nb == len(lines):
+                            break
+
+                        fields = lines[line_nb].split()
+                        if fields[0] == 'mtllib':
+                            self.library = load_material_library(
+                                os.path.join(os.path.dirname(self.file_name), fields[1]))
+                        elif fields[0] == 'usemtl':
+                            # a material starts a new mesh, the previous one is complete
+                            if len(faces) > 0:
+                                meshes += 1
+                                yield self.create_mesh(vertices, textures, faces, material)
+                            material = self.library.names[fields[1]]
+                            print('Loading mesh with material: {}'.format(fields[1]))
+
+        if len(faces) > 0:
+            meshes += 1
+            yield self.create_mesh(vertices, textures, faces, material)
+
+        print('File streamed in {:.3f}s. Found {} vertices, created {} mesh(es).'.format(
+            time.perf_counter() - t0, len(vertices), meshes))
+
+    def chunks(self, data):
+        '''
+        :return: a generator of the lines of each chunk of the file, stripped of their leading whitespace
+        '''
+        start = 0
+        while start < len(data):
+            end = len(data)
+            if start + self.chunk_size < len(data):
+                # cut after the last line which fits, or after the first line if it is longer than a chunk
+                end = data.rfind(b'\n', start, start + self.chunk_size) + 1
+                if end <= start:
+                    end = data.find(b'\n', start + self.chunk_size) + 1 or len(data)
+            yield [line.lstrip() for line in
+                   data[start:end].decode('utf-8', errors='replace').replace('\t', ' ').splitlines()]
+            start = end
+
+    @staticmethod
+    def read_elements(lines, labels, vertices, textures, normal_count, faces):
+        '''
+        Appends the vertices, texture coordinates and faces of a list of lines to the arrays read so far.
+        :return: the number of normals read so far, which are only counted for the relative face indices
+        '''
+        is_vertex = labels == 'v '
+        is_texture = labels == 'vt'
+        is_normal = labels == 'vn'
+        fidx = np.flatnonzero(labels == 'f ')
+
+        # the number of elements read before each face, for negative indices
+        counts = np.stack([np.searchsorted(np.flatnonzero(mask), fidx) + base for mask, base in
+                           ((is_vertex, len(vertices)), (is_texture, len(textures)), (is_normal, normal_count))],
+                          axis=1)
+
+        vertices.extend(_parse_floats([lines[i][2:] for i in np.flatnonzero(is_vertex)], 3))
+        textures.extend(_parse_floats([lines[i][3:] for i in np.flatnonzero(is_texture)], 2))
+        if fidx.shape[0] > 0:
+            corners, _ = _parse_faces([lines[i][2:] for i in fidx], counts)
+            faces.extend(corners[:, :, :2].reshape(-1, 6))
+        return normal_count + int(np.sum(is_normal))
+
+    def create_mesh(self, vertices, textures, faces, material):
+        '''
+        Creates the mesh of the faces of the current group, and clears them.
+        '''
+        corners = faces.array().reshape(-1, 3, 2)
+        if not np.any(corners[:, :, 1]):
+            corners = corners[:, :, :1]
+        print('Creating new mesh, {} faces, with material {}'.format(corners.shape[0], material))
+        mesh = create_mesh(vertices.array(), textures.array(), corners, 0, corners.shape[0], self.library, material)
+        faces.clear()
+        return mesh
+
+
+def create_meshes_from_blender(varray, farray, mlist, tarray, library, mesh_list, lnlist):
+    '''
+    Splits the faces into one mesh per material.
+    :param varray: the (n, 3) array of vertices
+    :param farray: the (m, 3, k) array of triangle corner indices
+    :param mlist: the material index of each triangle
+    :param tarray: the (t, 2) array of texture coordinates
+    :param library: the material library
+    :param mesh_list: the mesh id of each triangle
+    :param lnlist: the line number of each triangle, for easier error locating
+    '''
+    meshes = []
+
+    # a new mesh is denoted by change in material
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(mesh_list)) + 1])
+    ends = np.concatenate([starts[1:], [len(farray)]])
+
+    for fstart, f in zip(starts, ends):
+        print('Creating new mesh %i, faces %i-%i, line %i, with material %i' % (
+            mesh_list[fstart], fstart, f, lnlist[fstart], mlist[fstart]))
+        try:
+            meshes.append(create_mesh(varray, tarray, farray, fstart, f, library, mlist[fstart]))
+        except Exception as e:
+            print('(W) could not load mesh!')
+            print(e)
+            raise
 
     print('--- Created {} mesh(es) from Blender file.'.format(len(meshes)))
     return meshes
@@ -239,44 +488,56 @@ def create_meshes_from_blender(vlist, flist, mlist, tlist, library, mesh_list, l
 
 def create_mesh(varray, tarray, flist, fstart, f, library, material):
     # select faces for this mesh
-    farray = np.array(flist[fstart:f], dtype=np.uint32)
+    farray = np.asarray(flist[fstart:f])
 
-    # and vertices
-    vmax = np.max(farray[:, :, 0].flatten())
-    vmin = np.min(farray[:, :, 0].flatten()) - 1
+    # split vertices which are used with several texture coordinates, so that they can be indexed once
+    vertices, textures, faces, positions = fix_blender_textures(tarray, farray, varray)
 
-    # fix blender texture indexing
-    textures = fix_blender_textures(tarray, farray, varray)
-    if textures is not None:
-        textures = textures[vmin:vmax, :]
+    # normals are computed on the original vertices, so that they stay smooth across texture seams
+    used, split = np.unique(positions, return_inverse=True)
+    position_faces = np.searchsorted(used, farray[:, :, 0].astype(np.int64) - 1)
+    normals = vertex_normals(varray[used], position_faces)[split]
 
-    return Mesh(
-        vertices=varray[vmin:vmax, :],
-        faces=farray[:, :, 0] - vmin - 1,
-        material=library.materials[material],
+    mesh = Mesh(
+        vertices=vertices,
+        faces=faces,
+        normals=normals,
+        material=library.materials[material] if material >= 0 else Material(),
         textureCoords=textures
     )
 
+    # welds duplicate vertices and orders the faces for the vertex cache, the result is kept in the mesh cache
+    return optimize_mesh(mesh)
+
 
 def fix_blender_textures(textures, faces, vertices):
     '''
 	Corrects the indexing of textures in Blender file for OpenGL.
 	Blender allows for multiple indexing of vertices and textures, which is not supported by OpenGL.
-	This function ensures that indexing is consistent.
+	This function finds all unique (vertex, texture) pairs used by the faces and creates one
+	OpenGL vertex for each, so that vertices on texture seams are split instead of losing UVs.
 	:param textures: Original Blender texture UV values
 	:param faces: Blender faces multiple-index
-	:return: a new texture array indexed according to vertices.
+	:param vertices: Original Blender vertex positions
+	:return: the new vertex and texture arrays, the single-index faces, and for each new vertex the
+	(0-based) index of the original vertex it was created from.
 	'''
     # (OpenGL, unlike Blender, does not allow for multiple indexing!)
+    vindex = faces[:, :, 0].ravel().astype(np.int64) - 1
 
-    if faces.shape[2] == 1:
+    if faces.shape[2] == 1 or len(textures) == 0:
         print('(W) No texture indices provided, setting texture coordinate array as None!')
-        return None
+        positions, inverse = np.unique(vindex, return_inverse=True)
+        return vertices[positions], None, inverse.reshape(faces.shape[:2]).astype(np.uint32), positions
 
-    new_textures = np.zeros((vertices.shape[0], 2), dtype='f')
+    # pack each (vertex, texture) pair into a single key, so that the pairs can be sorted at once
+    tindex = faces[:, :, 1].ravel().astype(np.int64) - 1
+    keys, inverse = np.unique(vindex * (len(textures) + 1) + (tindex + 1), return_inverse=True)
+    positions = keys // (len(textures) + 1)
+    uvs = keys % (len(textures) + 1) - 1
 
-    for f in range(faces.shape[0]):
-        for j in range(faces.shape[1]):
-            new_textures[faces[f, j, 0] - 1, :] = textures[faces[f, j, 1] - 1, :]
+    # corners without texture index get the (0, 0) coordinate
+    new_textures = np.zeros((len(keys), 2), dtype='f')
+    new_textures[uvs >= 0] = textures[uvs[uvs >= 0]]
 
-    return new_textures
+    return vertices[positions], new_textures, inverse.reshape(faces.shape[:2]).astype(np.uint32), positions
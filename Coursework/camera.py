@@ -1,6 +1,8 @@
 # import a bunch of useful matrix functions (for translation, scaling etc)
 from matutils import *
 
+from transform import transform_stats
+
 
 class Camera:
     '''
@@ -13,6 +15,8 @@ class Camera:
         self.psi = 0.               # zenith angle
         self.distance = 7.         # distance of the camera to the centre point
         self.center = [0., 0., 0.]  # position of the centre
+        self.version = 0            # incremented every time the view matrix changes
+        self.parameters = None      # the parameters the view matrix was calculated from
         self.update()               # calculate the view matrix
 
     def update(self):
@@ -21,7 +25,16 @@ class Camera:
         first, we set the point we want to look at as centre of the coordinate system,
         then, we rotate the coordinate system according to phi and psi angles
         finally, we move the camera to the set distance from the point.
+        The matrix is only calculated again if one of the parameters changed since the last update.
         '''
+        parameters = (self.phi, self.psi, self.distance, tuple(self.center))
+        if parameters == self.parameters:
+            transform_stats.hits['view'] += 1
+            return
+        transform_stats.misses['view'] += 1
+        self.parameters = parameters
+        self.version += 1
+
         # calculate the translation matrix for the view center (the point we look at)
         T0 = translationMatrix(self.center)
 
@@ -0,0 +1,191 @@
+import numpy as np
+
+'''
+NumPy reference of the fur shell pipeline, which needs no GPU. clip_positions() computes what
+shaders/vertex_shader.glsl outputs in gl_Position for every vertex of every layer at once, and rasterize_shells()
+is a simple rasterizer for the fragment shader, to compare images or benchmark the geometry headlessly.
+
+Matrices are the numpy matrices given to the shaders (scene.P, camera.V and the model matrix), which the shaders
+receive untransposed, so the GLSL expressions are reproduced as they are written, eg. model * view * position.
+'''
+
+# gravity direction in the vertex shader
+GRAVITY = np.array([0., -2., 0., 1.])
+
+
+def shell_positions(vertices, normals, num_of_layers, fur_length, layers=None):
+    '''
+    Extrudes the vertices along their normals, by fur_length / num_of_layers per layer.
+    :param layers: [optional] the layers to compute, all num_of_layers layers by default
+    :return: a (layers, vertices, 3) array
+    '''
+    if layers is None:
+        layers = np.arange(num_of_layers)
+    layers = np.asarray(layers, dtype=vertices.dtype)
+    offset = layers * (fur_length / vertices.dtype.type(num_of_layers))
+    return vertices[np.newaxis, :, :] + normals[np.newaxis, :, :] * offset[:, np.newaxis, np.newaxis]
+
+
+def clip_positions(vertices, normals, M, V, P, num_of_layers, fur_length, furFlowOffset=0., layers=None,
+                   dtype='f'):
+    '''
+    Computes the clip space position (gl_Position) of every vertex of every layer in one batch.
+    :param vertices: (n, 3) vertex positions
+    :param normals: (n, 3) vertex normals
+    :param M: the 4x4 model matrix
+    :param V: the 4x4 view matrix
+    :param P: the 4x4 projection matrix
+    :param furFlowOffset: offset added to all coordinates of the layers above the skin
+    :param layers: [optional] the layers to compute, all num_of_layers layers by default
+    :param dtype: the precision of the computation, float32 like the GPU by default
+    :return: a (layers, vertices, 4) array
+    '''
+    if layers is None:
+        layers = np.arange(num_of_layers)
+    scalar = np.dtype(dtype).type
+    layers = np.asarray(layers, dtype=dtype)
+    M, V, P = [np.asarray(matrix, dtype=dtype) for matrix in (M, V, P)]
+
+    positions = shell_positions(np.asarray(vertices, dtype=dtype), np.asarray(normals, dtype=dtype),
+                                num_of_layers, fur_length, layers)
+    homogeneous = np.concatenate([positions, np.ones(positions.shape[:2] + (1,), dtype=dtype)], axis=2)
+
+    # P = model * view * vec4(Pos, 1.0), applied to row vectors
+    MV = np.matmul(M, V)
+    clip = np.matmul(homogeneous, MV.T)
+
+    # vGravity * model * view multiplies the row vector on the left
+    gravity = np.matmul(np.matmul(GRAVITY.astype(dtype), M), V)
+    # only the tips bend: the layer goes from 0 to 1 but curves more
+    k = (layers / scalar(num_of_layers)) ** 3 * scalar(0.08)
+    clip = clip + gravity[np.newaxis, np.newaxis, :] * k[:, np.newaxis, np.newaxis]
+
+    clip[layers != 0] += scalar(furFlowOffset)
+
+    return np.matmul(clip, P.T)
+
+
+def window_positions(clip, width, height):
+    '''
+    Perspective division and viewport transform.
+    :return: an array of the same shape with (x, y, depth, w) in window coordinates: pixels from the bottom left
+    corner, and depth in [0, 1]
+    '''
+    w = clip[..., 3:4]
+    ndc = clip[..., :3] / w
+    x = (ndc[..., 0] + 1) * 0.5 * width
+    y = (ndc[..., 1] + 1) * 0.5 * height
+    depth = ndc[..., 2] * 0.5 + 0.5
+    return np.stack([x, y, depth, w[..., 0]], axis=-1)
+
+
+def rasterize(window, faces, width, height, cull=True, max_fragments=1 << 22):
+    '''
+    Rasterizes the triangles of one layer, with a depth test.
+    Triangles with a vertex behind the camera are skipped rather than clipped, which is enough for a mesh in front
+    of the camera. The pixel centers inside a triangle or on its edges are covered.
+    :param window: (n, 4) window positions of the vertices, from window_positions()
+    :param faces: (m, 3) vertex indices of the triangles
+    :param cull: if True, back faces are not drawn (counter-clockwise triangles are front faces, as in OpenGL)
+    :param max_fragments: the triangles are rasterized in batches of about this many candidate pixels
+    :return: the pixel index (y * width + x, y from the bottom), triangle index, depth and perspective correct
+    barycentric coordinates of the nearest fragment of each covered pixel
+    '''
+    tri = window[faces]
+    x, y, z, w = tri[..., 0], tri[..., 1], tri[..., 2], tri[..., 3]
+
+    area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+    keep = np.all(w > 0, axis=1) & ((area > 0) if cull else (area != 0))
+    triangles = np.flatnonzero(keep)
+
+    # range of pixel centers in the bounding box of each triangle, clamped to the viewport
+    x_lo = np.clip(np.ceil(x[triangles].min(1) - 0.5), 0, width).astype(np.int64)
+    x_hi = np.clip(np.floor(x[triangles].max(1) - 0.5), -1, width - 1).astype(np.int64)
+    y_lo = np.clip(np.ceil(y[triangles].min(1) - 0.5), 0, height).astype(np.int64)
+    y_hi = np.clip(np.floor(y[triangles].max(1) - 0.5), -1, height - 1).astype(np.int64)
+    box_w = np.maximum(x_hi - x_lo + 1, 0)
+    counts = box_w * np.maximum(y_hi - y_lo + 1, 0)
+
+    results = []
+    batch = np.cumsum(counts) // max_fragments
+    for b in np.unique(batch):
+        sel = np.flatnonzero(batch == b)
+        t = np.repeat(sel, counts[sel])
+        k = np.arange(t.shape[0]) - np.repeat(np.cumsum(counts[sel]) - counts[sel], counts[sel])
+        px = x_lo[t] + k % box_w[t]
+        py = y_lo[t] + k // box_w[t]
+        f = triangles[t]
+
+        # edge functions at the pixel centers give the barycentric coordinates
+        cx, cy = px + 0.5, py + 0.5
+        b0 = (x[f, 1] - cx) * (y[f, 2] - cy) - (x[f, 2] - cx) * (y[f, 1] - cy)
+        b1 = (x[f, 2] - cx) * (y[f, 0] - cy) - (x[f, 0] - cx) * (y[f, 2] - cy)
+        b2 = (x[f, 0] - cx) * (y[f, 1] - cy) - (x[f, 1] - cx) * (y[f, 0] - cy)
+        bary = np.stack([b0, b1, b2], axis=1) / area[f, np.newaxis]
+        inside = np.all(bary >= 0, axis=1)
+
+        f, px, py, bary = f[inside], px[inside], py[inside], bary[inside]
+        depth = np.sum(bary * z[f], axis=1)
+
+        # attributes are interpolated linearly in eye space, as OpenGL does by default
+        perspective = bary / w[f]
+        perspective /= perspective.sum(axis=1, keepdims=True)
+        results.append((py * width + px, depth, f, perspective))
+
+    if not results:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0), np.zeros((0, 3))
+    pixels, depth, triangles, bary = nearest(*[np.concatenate(arrays) for arrays in zip(*results)])
+    return pixels, triangles, depth, bary
+
+
+def nearest(pixels, *values):
+    '''
+    Keeps the fragment with the lowest depth for each pixel. The depth must be the first value.
+    '''
+    order = np.lexsort((values[0], pixels))
+    first = np.ones(order.shape[0], dtype=bool)
+    first[1:] = pixels[order][1:] != pixels[order][:-1]
+    order = order[first]
+    return (pixels[order],) + tuple(value[order] for value in values)
+
+
+def rasterize_shells(clip, faces, width, height, textureCoords=None, fur=None, cull=True):
+    '''
+    Draws all layers in order with a depth test, as BaseModel.draw does, and returns which layer is visible
+    in each pixel. Layers above the skin only cover the pixels where the fur texture has a strand, like the
+    fragment shader which discards the others.
+    :param clip: (layers, n, 4) clip positions, from clip_positions()
+    :param faces: (m, 3) vertex indices of the triangles
+    :param textureCoords: (n, 2) texture coordinates, needed with fur
+    :param fur: [optional] (layers, size, size) array of the fur texture, eg. FurTexture.data reshaped.
+    Without it, every layer is opaque.
+    :return: (height, width) arrays of the visible layer (-1 for the background), triangle and depth, with the
+    top row first like window.read_pixels()
+    '''
+    layer_buffer = np.full(width * height, -1, dtype=np.int64)
+    triangle_buffer = np.full(width * height, -1, dtype=np.int64)
+    depth_buffer = np.ones(width * height)
+
+    for layer in range(clip.shape[0]):
+        window = window_positions(clip[layer], width, height)
+        pixels, triangles, depth, bary = rasterize(window, faces, width, height, cull)
+
+        if layer > 0 and fur is not None:
+            # nearest texel of the interpolated texture coordinates, with repeat wrapping
+            uv = np.sum(bary[:, :, np.newaxis] * textureCoords[faces[triangles]], axis=1)
+            size = fur.shape[1]
+            texel = np.floor(uv * size).astype(np.int64) % size
+            strand = fur[layer, texel[:, 1], texel[:, 0]] > 0.1 * 255
+            pixels, triangles, depth = pixels[strand], triangles[strand], depth[strand]
+
+        # GL_LESS depth test against the layers drawn before
+        passed = depth < depth_buffer[pixels]
+        pixels = pixels[passed]
+        layer_buffer[pixels] = layer
+        triangle_buffer[pixels] = triangles[passed]
+        depth_buffer[pixels] = depth[passed]
+
+    def image(buffer):
+        return buffer.reshape(height, width)[::-1]
+
+    return image(layer_buffer), image(triangle_buffer), image(depth_buffer)
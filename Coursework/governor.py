@@ -0,0 +1,134 @@
+import time
+from collections import deque
+
+import numpy as np
+
+'''
+Quality governor which changes the number of fur shells drawn to hold a frame time budget. The cost of a frame
+grows linearly with the number of shells, so the count is scaled by the ratio of the budget to the measured frame
+time when frames are too slow, and raised a few shells at a time when they are fast enough. The quality is only
+reduced while frames are drawn: once the scene is idle, its last frame is drawn again with all the shells.
+
+The shells are spread over the same fur length whatever their number, and each one samples the fur texture layer
+at the same height (see BaseModel.draw), so the fur looks the same with fewer shells, only coarser.
+'''
+
+
+class ShellGovernor:
+    '''
+    Chooses how many shells to draw from the recent frame times. Nothing changes while the median frame time is
+    between low and high times the budget, and after a change the frames are measured again before the next one.
+    A count which was too slow is not drawn again until the frames have been fast for patience windows in a row,
+    so that the count does not oscillate.
+    '''
+
+    def __init__(self, max_layers, target_ms=1000. / 60, min_layers=4, low=0.7, high=1.1, window=20, step=2,
+                 patience=10):
+        '''
+        :param max_layers: the number of shells of the fur texture, which is never exceeded
+        :param target_ms: the frame time budget, in ms
+        :param min_layers: the fewest shells drawn, however slow the frames are
+        :param low: the shells are raised when the median frame time is below low * target_ms
+        :param high: the shells are reduced when the median frame time is above high * target_ms
+        :param window: the number of frames averaged before a decision
+        :param step: the number of shells added at a time
+        :param patience: the number of fast windows after which a count which was too slow is tried again
+        '''
+        self.max_layers = max_layers
+        self.target_ms = target_ms
+        self.min_layers = min(min_layers, max_layers)
+        self.low = low
+        self.high = high
+        self.step = step
+        self.patience = patience
+        self.times = deque(maxlen=window)
+
+        # the lowest count which was too slow, and the number of fast windows since then
+        self.ceiling = None
+        self.fast_windows = 0
+
+        # the number of shells drawn, starts at full quality
+        self.layers = max_layers
+
+        self.frame_start = None
+
+    def begin_frame(self):
+        self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        '''
+        Measures the frame since begin_frame(), and updates the number of shells.
+        :return: True if the number of shells changed
+        '''
+        if self.frame_start is None:
+            return False
+        ms = (time.perf_counter() - self.frame_start) * 1e3
+        self.frame_start = None
+        return self.update(ms)
+
+    def update(self, ms):
+        '''
+        Adds the time of a frame, and changes the number of shells once enough frames were measured.
+        :param ms: the time of the frame, in ms
+        :return: True if the number of shells changed
+        '''
+        self.times.append(ms)
+        if len(self.times) < self.times.maxlen:
+            return False
+
+        # the median ignores single slow frames, eg. when a shader is compiled or a texture uploaded
+        median = np.median(self.times)
+        if median > self.high * self.target_ms:
+            # the time is about linear in the number of shells, so aim at the middle of the band at once
+            target = self.layers * 0.5 * (self.low + self.high) * self.target_ms / median
+            layers = max(self.min_layers, min(int(target), self.layers - 1))
+            self.ceiling = self.layers
+            self.fast_windows = 0
+        elif median < self.low * self.target_ms:
+            layers = min(self.max_layers, self.layers + self.step)
+            if self.ceiling is not None:
+                self.fast_windows += 1
+                if self.fast_windows < self.patience:
+                    layers = min(layers, self.ceiling - 1)
+                else:
+                    self.ceiling = None
+            self.times.clear()
+        else:
+            self.fast_windows = 0
+            return False
+
+        if layers == self.layers:
+            return False
+        print('(G) Frame time {:.1f} ms for a budget of {:.1f} ms, drawing {} shells instead of {}'.format(
+            median, self.target_ms, layers, self.layers))
+        self.layers = layers
+
+        # the frames drawn with the previous count do not tell anything about the new one
+        self.times.clear()
+        return True
+
+    def idle(self):
+        '''
+        Goes back to full quality when no frames are drawn, so that the frame left on screen has all the shells. The
+        count which was too slow is kept, the frames are measured again once drawing resumes.
+        :return: True if the number of shells changed, the last frame should then be drawn again
+        '''
+        self.times.clear()
+        self.frame_start = None
+        if self.layers == self.max_layers:
+            return False
+        print('(G) Idle, drawing {} shells instead of {}'.format(self.max_layers, self.layers))
+        self.layers = self.max_layers
+        return True
+
+    def reset(self, max_layers=None):
+        '''
+        Goes back to full quality, eg. after the model or the number of layers changed.
+        '''
+        if max_layers is not None:
+            self.max_layers = max_layers
+            self.min_layers = min(self.min_layers, max_layers)
+        self.layers = self.max_layers
+        self.ceiling = None
+        self.fast_windows = 0
+        self.times.clear()
@@ -8,7 +8,8 @@ class Material:
         self.texture = texture
 
 class MaterialLibrary:
-    def __init__(self):
+    def __init__(self, file_name=None):
+        self.file_name = file_name
         self.materials = []
         self.names = {}
 
@@ -1,7 +1,7 @@
 from material import Material
 import numpy as np
 
-from texture import Texture
+from texture import texture_cache
 
 class Mesh:
     '''
@@ -21,9 +21,9 @@ class Mesh:
         self.material = material
         self.colors = None
         self.textureCoords = textureCoords
-        self.textures = []
-        self.tangents = None
-        self.binormals = None
+        self._textures = None
+        self._tangents = None
+        self._binormals = None
 
         if vertices is not None:
             print('Creating mesh')
@@ -41,9 +41,57 @@ class Mesh:
         else:
             self.normals = normals
 
-        if material.texture is not None:
-            self.textures.append(Texture(material.texture))
+    @property
+    def textures(self):
+        '''
+        The list of textures for this mesh. The textures are only loaded the first time they are needed,
+        so that meshes can be created without an OpenGL context.
+        '''
+        if self._textures is None:
+            self._textures = []
+            if self.material.texture is not None:
+                self._textures.append(texture_cache.texture(self.material.texture))
+        return self._textures
+
+    def loaded_textures(self):
+        '''
+        :return: the textures which were already loaded, without loading the others
+        '''
+        return [] if self._textures is None else self._textures
+
+    def release_textures(self):
+        '''
+        Releases the textures which were loaded, they are shared with other meshes through the texture cache.
+        '''
+        for texture in self.loaded_textures():
+            texture_cache.release(texture)
+        self._textures = None
+
+    @property
+    def tangents(self):
+        '''
+        The per-vertex tangents, only calculated the first time they are needed.
+        '''
+        if self._tangents is None and self.textureCoords is not None and self.faces is not None:
+            self.calculate_tangents()
+        return self._tangents
+
+    @tangents.setter
+    def tangents(self, tangents):
+        self._tangents = tangents
+
+    @property
+    def binormals(self):
+        '''
+        The per-vertex binormals, only calculated the first time they are needed.
+        '''
+        if self._binormals is None and self.textureCoords is not None and self.faces is not None:
+            self.calculate_tangents()
+        return self._binormals
 
+    @binormals.setter
+    def binormals(self, binormals):
+        self._binormals = binormals
 
     def calculate_normals(self):
         '''
@@ -51,35 +99,73 @@ class Mesh:
         Use the approach discussed in class:
         1. calculate normal for each face using cross product
         2. set each vertex normal as the average of the normals over all faces it belongs to.
+        All faces are processed at once, and vertices without a valid normal (eg. only part of
+        degenerate faces) are left as zero rather than NaN.
         '''
+        self.normals = vertex_normals(self.vertices, self.faces)
+
+    def calculate_tangents(self):
+        '''
+        method to calculate the tangents and binormals from the mesh faces and texture coordinates,
+        which are accumulated on the vertices in the same way as the normals.
+        '''
+        a, b = self.face_edges()
+        uv = self.textureCoords[self.faces]
+        txa = uv[:, 1] - uv[:, 0]
+        txb = uv[:, 2] - uv[:, 0]
+
+        # the sign of the UV determinant keeps mirrored texture islands consistent
+        sign = np.sign(txa[:, 0] * txb[:, 1] - txb[:, 0] * txa[:, 1])[:, None]
+        face_tangents = sign * (txb[:, 1, None] * a - txa[:, 1, None] * b)
+        face_binormals = sign * (-txb[:, 0, None] * a + txa[:, 0, None] * b)
+
+        n = self.vertices.shape[0]
+        self.tangents = normalise(accumulate(self.faces, face_tangents, n))
+        self.binormals = normalise(accumulate(self.faces, face_binormals, n))
 
-        self.normals = np.zeros((self.vertices.shape[0], 3), dtype='f')
-        if self.textureCoords is not None:
-            self.tangents = np.zeros((self.vertices.shape[0], 3), dtype='f')
-            self.binormals = np.zeros((self.vertices.shape[0], 3), dtype='f')
-
-        for f in range(self.faces.shape[0]):
-            # first calculate the face normal using the cross product of the triangle's sides
-            a = self.vertices[self.faces[f, 1]] - self.vertices[self.faces[f, 0]]
-            b = self.vertices[self.faces[f, 2]] - self.vertices[self.faces[f, 0]]
-            face_normal = np.cross(a, b)
-
-            # tangent
-            if self.textureCoords is not None:
-                txa = self.textureCoords[self.faces[f, 1], :] - self.textureCoords[self.faces[f, 0], :]
-                txb = self.textureCoords[self.faces[f, 2], :] - self.textureCoords[self.faces[f, 2], :]
-                face_tangent = txb[0]*a - txa[0]*b
-                face_binormal = -txb[1]*a + txa[1]*b
-
-            # blend normal on all 3 vertices
-            for j in range(3):
-                self.normals[self.faces[f, j], :] += face_normal
-                if self.textureCoords is not None:
-                    self.tangents[self.faces[f, j], :] += face_tangent
-                    self.binormals[self.faces[f, j], :] += face_binormal
-
-        # finally we need to normalise the vectors
-        self.normals /= np.linalg.norm(self.normals, axis=1, keepdims=True)
-        if self.textureCoords is not None:
-            self.tangents /= np.linalg.norm(self.tangents, axis=1, keepdims=True)
-            self.binormals /= np.linalg.norm(self.binormals, axis=1, keepdims=True)
\ No newline at end of file
+    def face_edges(self):
+        '''
+        :return: the two edge vectors starting from the first vertex of every face
+        '''
+        return face_edges(self.vertices, self.faces)
+
+
+def face_edges(vertices, faces):
+    '''
+    :return: the two edge vectors starting from the first vertex of every face
+    '''
+    corners = vertices[faces[:, :3]].astype(np.float64)
+    return corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]
+
+
+def vertex_normals(vertices, faces):
+    '''
+    Calculates the normal of each vertex as the normalised sum of the normals of the faces it belongs to.
+    '''
+    # first calculate the face normal using the cross product of the triangle's sides
+    a, b = face_edges(vertices, faces)
+    face_normals = np.cross(a, b)
+
+    # blend normal on all vertices of the face
+    return normalise(accumulate(faces, face_normals, vertices.shape[0]))
+
+
+def accumulate(faces, values, n):
+    '''
+    Sums a value per face onto every vertex of the face.
+    :param faces: the (f, k) array of vertex indices
+    :param values: the (f, 3) array of values for each face
+    :param n: the number of vertices
+    :return: the (n, 3) array of summed values
+    '''
+    indices = faces.ravel()
+    values = np.repeat(values, faces.shape[1], axis=0)
+    return np.stack([np.bincount(indices, weights=values[:, i], minlength=n) for i in range(3)], axis=1)
+
+
+def normalise(vectors):
+    '''
+    Normalises each row of an array, leaving zero-length rows as zero.
+    '''
+    norm = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norm, out=np.zeros_like(vectors), where=norm > 0).astype('f')
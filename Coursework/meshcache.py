@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+from material import Material
+from mesh import Mesh
+
+'''
+On-disk cache for the meshes loaded from Blender files.
+Each OBJ file is stored as a directory of .npy files (one per mesh array) which are memory-mapped on load,
+so a repeat load only costs reading the file hash instead of parsing the text and computing normals again.
+'''
+
+# increment this whenever the loader output changes, to invalidate all existing cache entries.
+LOADER_VERSION = 6
+
+MESH_ARRAYS = ['vertices', 'faces', 'normals', 'textureCoords']
+
+
+class MeshCache:
+    '''
+    Cache of processed meshes, keyed by the content of the OBJ file and the loader version.
+    The least recently used entries are evicted when the total size of the cache exceeds max_bytes.
+    '''
+
+    def __init__(self, directory='.meshcache', max_bytes=512 * 1024 * 1024, enabled=True):
+        '''
+        :param directory: the directory where cache entries are stored
+        :param max_bytes: the maximum size of the cache on disk
+        :param enabled: if False, load() always misses and store() does nothing
+        '''
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, file_name):
+        '''
+        Returns the cache key for a file, from its content and the loader version.
+        '''
+        h = hashlib.sha1('v{}'.format(LOADER_VERSION).encode())
+        with open(file_name, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def load(self, file_name, load_material_library):
+        '''
+        Loads the meshes of a file from the cache.
+        :param file_name: the OBJ file name
+        :param load_material_library: function used to reload the material library referenced by the file
+        :return: the list of meshes, or None if the file is not in the cache
+        '''
+        if not self.enabled:
+            return None
+
+        path = os.path.join(self.directory, self.key(file_name))
+        try:
+            with open(os.path.join(path, 'meta.json')) as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            self.misses += 1
+            print('(C) Mesh cache miss for {}'.format(file_name))
+            return None
+
+        self.hits += 1
+        print('(C) Mesh cache hit for {}'.format(file_name))
+
+        # mark the entry as recently used for the eviction policy
+        os.utime(os.path.join(path, 'meta.json'))
+
+        library = None
+        if meta['mtllib'] is not None:
+            library = load_material_library(meta['mtllib'])
+
+        meshes = []
+        for i, entry in enumerate(meta['meshes']):
+            arrays = {
+                name: np.load(os.path.join(path, 'mesh{}_{}.npy'.format(i, name)), mmap_mode='r')
+                if name in entry['arrays'] else None
+                for name in MESH_ARRAYS
+            }
+            if entry['material'] is None or library is None:
+                material = Material()
+            else:
+                material = library.materials[library.names[entry['material']]]
+            meshes.append(Mesh(material=material, **arrays))
+
+        return meshes
+
+    def store(self, file_name, meshes, library=None):
+        '''
+        Saves the meshes of a file in the cache, evicting old entries if the cache grows too large.
+        :param file_name: the OBJ file name
+        :param meshes: the list of meshes created from the file
+        :param library: the material library referenced by the file, if any
+        '''
+        if not self.enabled:
+            return
+
+        key = self.key(file_name)
+        path = os.path.join(self.directory, key)
+        # the asset loader may store from a worker thread while the main thread stores too
+        tmp = '{}.tmp{}_{}'.format(path, os.getpid(), threading.get_ident())
+        os.makedirs(tmp, exist_ok=True)
+
+        meta = {
+            'file': os.path.abspath(file_name),
+            'version': LOADER_VERSION,
+            'mtllib': None if library is None else library.file_name,
+            'meshes': []
+        }
+        for i, mesh in enumerate(meshes):
+            entry = {'material': mesh.material.name, 'arrays': []}
+            for name in MESH_ARRAYS:
+                data = getattr(mesh, name)
+                if data is not None:
+                    np.save(os.path.join(tmp, 'mesh{}_{}.npy'.format(i, name)), np.ascontiguousarray(data))
+                    entry['arrays'].append(name)
+            meta['meshes'].append(entry)
+
+        # meta.json is written last, so that an interrupted store is never seen as a valid entry
+        with open(os.path.join(tmp, 'meta.json'), 'w') as file:
+            json.dump(meta, file)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+
+        self.evict()
+
+    def entries(self):
+        '''
+        Returns the list of (last use time, size, path) for all entries, oldest first.
+        '''
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            meta = os.path.join(path, 'meta.json')
+            if not os.path.isfile(meta):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(meta), size, path))
+
+        return sorted(entries)
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache fits in max_bytes.
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            print('(C) Evicting mesh cache entry {}'.format(path))
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+    def invalidate(self, file_name=None):
+        '''
+        Removes the entry for a file from the cache, or all entries if no file name is given.
+        '''
+        if file_name is None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        else:
+            shutil.rmtree(os.path.join(self.directory, self.key(file_name)), ignore_errors=True)
+
+    def report(self):
+        '''
+        Prints the number of hits and misses since the cache was created.
+        '''
+        total = self.hits + self.misses
+        print('(C) Mesh cache: {} hits, {} misses ({:.0f}% hit rate)'.format(
+            self.hits, self.misses, 100. * self.hits / total if total > 0 else 0.))
+
+
+# cache used by default by blender.load_obj_file
+mesh_cache = MeshCache()
@@ -0,0 +1,64 @@
+from collections import OrderedDict
+
+from texture import texture_cache
+
+
+class ModelRegistry:
+    '''
+    Keeps loaded models resident on the GPU, so that switching back to a model only changes which one
+    is drawn. When the models use more than max_bytes of GPU memory, the least recently shown ones are released.
+    '''
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.models = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, create):
+        '''
+        Returns the model for a key, creating it if it is not resident.
+        :param key: a hashable key, eg. (path, num_of_layers, fur_seed)
+        :param create: function called without arguments to create the model if needed
+        '''
+        if key in self.models:
+            self.hits += 1
+            self.models.move_to_end(key)
+            return self.models[key]
+
+        self.misses += 1
+        model = create()
+        self.models[key] = model
+        self.evict()
+        return model
+
+    def __contains__(self, key):
+        return key in self.models
+
+    def total_bytes(self):
+        '''
+        :return: the bytes of the models, and those of the textures they share, which are only counted once
+        '''
+        return sum(model.total_gpu_bytes() for model in self.models.values()) + texture_cache.nbytes()
+
+    def evict(self):
+        '''
+        Releases the least recently shown models until the total fits in max_bytes.
+        The most recent model is always kept, even if it is larger than the limit on its own.
+        '''
+        total = self.total_bytes()
+        while total > self.max_bytes and len(self.models) > 1:
+            key, model = self.models.popitem(last=False)
+            print('- Releasing model {} from the GPU'.format(key))
+            model.release()
+
+            # shared textures are only freed by their last user
+            total = self.total_bytes()
+
+    def release(self):
+        '''
+        Releases all models.
+        '''
+        for model in self.models.values():
+            model.release()
+        self.models.clear()
@@ -24,10 +24,13 @@ class ComplexModel(BaseModel):
         BaseModel.__init__(self, scene, M=M)
         self.components = []
 
-    def draw(self, Mp):
-        # draw all component primitives
+    def draw(self, *args):
+        # draw all component primitives, they are children of this model in the transform graph,
+        # so their world matrices are only computed again when this model or the component moves.
         for component in self.components:
-            component.draw(np.matmul(Mp, self.M))
+            if component.node.parent is not self.node:
+                self.node.add_child(component.node)
+            component.draw(*args)
 
 class SquareModel(BaseModel):
     def __init__(self, scene, M, color=[1., 1., 1.]):
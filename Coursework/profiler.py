@@ -0,0 +1,266 @@
+import json
+import time
+from collections import defaultdict, deque
+
+import numpy as np
+
+from OpenGL.GL import *
+
+'''
+Per-frame timing of the phases of a frame (events, camera, fur texture, shader binds, draw calls...).
+CPU time is measured with time.perf_counter_ns(). GPU time is measured with GL_TIME_ELAPSED queries, whose results
+are only read once the GPU reports them as available, a few frames later, so the pipeline is never stalled.
+
+Usage:
+    profiler.begin_frame()
+    with profiler.phase('camera'):
+        camera.update()
+    with profiler.phase('draw', gpu=True):
+        model.draw()
+    profiler.end_frame()
+'''
+
+
+class _NoPhase:
+    '''
+    Returned by FrameProfiler.phase() when the profiler is disabled, so that timing costs nothing.
+    '''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_no_phase = _NoPhase()
+
+
+class _Phase:
+    def __init__(self, profiler, name, gpu):
+        self.profiler = profiler
+        self.name = name
+        self.gpu = gpu
+        self.query = None
+
+    def __enter__(self):
+        self.query = self.profiler._begin_query() if self.gpu else None
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *args):
+        end = time.perf_counter_ns()
+        self.profiler._end_phase(self.name, self.start, end, self.query)
+        return False
+
+
+class FrameProfiler:
+    '''
+    Records the time of each phase in every frame, and keeps a rolling window of the last frames for statistics.
+    Phases which run several times in a frame (eg. once per fur layer) are summed over the frame.
+    '''
+
+    def __init__(self, enabled=False, gpu=True, history=240):
+        '''
+        :param enabled: if False, phase() returns a no-op and nothing is recorded
+        :param gpu: if True, phases opened with gpu=True are also timed on the GPU
+        :param history: the number of frames kept for the statistics
+        '''
+        self.enabled = enabled
+        self.gpu = gpu
+        self.history = history
+
+        # rolling window of the per-frame times in ns, for each phase
+        self.cpu_times = defaultdict(lambda: deque(maxlen=self.history))
+        self.gpu_times = defaultdict(lambda: deque(maxlen=self.history))
+
+        self.frame = 0
+        self.frame_start = None
+        self.frame_cpu = defaultdict(int)
+
+        # GL_TIME_ELAPSED queries cannot be nested, only the outermost GPU phase is timed
+        self.query_active = False
+        self.free_queries = []
+        self.pending = deque()
+        self.gpu_frame = None
+        self.gpu_partial = defaultdict(int)
+
+        # chrome trace events, recorded only while tracing
+        self.tracing = False
+        self.events = []
+        self.t0 = time.perf_counter_ns()
+
+        # called with the summary every overlay_interval frames, eg. print
+        self.overlay = None
+        self.overlay_interval = 60
+
+    def phase(self, name, gpu=False):
+        '''
+        :return: a context manager timing a phase of the current frame
+        :param gpu: if True, the GPU time of the commands issued in the phase is measured too
+        '''
+        if not self.enabled:
+            return _no_phase
+        return _Phase(self, name, gpu and self.gpu)
+
+    def begin_frame(self):
+        if not self.enabled:
+            return
+        self.frame_start = time.perf_counter_ns()
+        self.frame_cpu.clear()
+
+    def end_frame(self):
+        '''
+        Stores the times of the frame, collects the GPU results which are ready and updates the overlay.
+        '''
+        if not self.enabled or self.frame_start is None:
+            return
+        end = time.perf_counter_ns()
+        self.frame_cpu['frame'] = end - self.frame_start
+        if self.tracing:
+            self.trace_event('frame', 'cpu', self.frame_start, end - self.frame_start)
+
+        for name, ns in self.frame_cpu.items():
+            self.cpu_times[name].append(ns)
+
+        self.collect()
+        self.frame += 1
+        self.frame_start = None
+
+        if self.overlay is not None and self.frame % self.overlay_interval == 0:
+            self.overlay(self.summary())
+
+    def _begin_query(self):
+        if self.query_active:
+            return None
+        try:
+            query = self.free_queries.pop() if self.free_queries else int(np.ravel(glGenQueries(1))[0])
+            glBeginQuery(GL_TIME_ELAPSED, query)
+        except GLError as error:
+            print('(W) GPU timer queries are not supported, only CPU times are recorded: {}'.format(error))
+            self.gpu = False
+            return None
+        self.query_active = True
+        return query
+
+    def _end_phase(self, name, start, end, query):
+        self.frame_cpu[name] += end - start
+        if self.tracing:
+            self.trace_event(name, 'cpu', start, end - start)
+        if query is not None:
+            glEndQuery(GL_TIME_ELAPSED)
+            self.query_active = False
+            self.pending.append((self.frame, name, query, start))
+
+    def collect(self):
+        '''
+        Reads the GPU queries which have completed, oldest first, without waiting for the others.
+        '''
+        while self.pending:
+            frame, name, query, start = self.pending[0]
+            if not glGetQueryObjectuiv(query, GL_QUERY_RESULT_AVAILABLE):
+                break
+            self.pending.popleft()
+            # the 32 bit result holds up to 4 seconds, PyOpenGL does not wrap the 64 bit one correctly
+            ns = int(glGetQueryObjectuiv(query, GL_QUERY_RESULT))
+            self.free_queries.append(query)
+
+            # all the queries of a frame are summed, and stored once a query of a later frame is ready
+            if frame != self.gpu_frame:
+                self._flush_gpu()
+                self.gpu_frame = frame
+            self.gpu_partial[name] += ns
+            if self.tracing:
+                self.trace_event(name, 'gpu', start, ns)
+
+        # every query issued so far is done, so the last frame is complete
+        if not self.pending:
+            self._flush_gpu()
+
+    def _flush_gpu(self):
+        for name, ns in self.gpu_partial.items():
+            self.gpu_times[name].append(ns)
+        self.gpu_partial.clear()
+
+    def stats(self, name, gpu=False):
+        '''
+        :return: the mean, median, 95th percentile and maximum time of a phase over the window, in ms
+        '''
+        times = (self.gpu_times if gpu else self.cpu_times).get(name)
+        if not times:
+            return None
+        ms = np.array(times) * 1e-6
+        return {'mean': ms.mean(), 'p50': np.percentile(ms, 50), 'p95': np.percentile(ms, 95), 'max': ms.max()}
+
+    def histogram(self, name, bins=10, gpu=False):
+        '''
+        :return: the counts and the bin edges in ms of the times of a phase over the window
+        '''
+        times = (self.gpu_times if gpu else self.cpu_times).get(name, [])
+        return np.histogram(np.array(times) * 1e-6, bins=bins)
+
+    def summary(self):
+        '''
+        :return: a table of the statistics of all phases, one line per phase
+        '''
+        lines = ['{:<16}{:>10}{:>10}{:>10}{:>10}{:>10}'.format('phase', 'cpu mean', 'cpu p95', 'cpu max',
+                                                               'gpu mean', 'gpu p95')]
+        for name in sorted(self.cpu_times, key=lambda n: (n != 'frame', n)):
+            cpu = self.stats(name)
+            gpu = self.stats(name, gpu=True)
+            lines.append('{:<16}{:>10.3f}{:>10.3f}{:>10.3f}{:>10}{:>10}'.format(
+                name, cpu['mean'], cpu['p95'], cpu['max'],
+                '-' if gpu is None else '{:.3f}'.format(gpu['mean']),
+                '-' if gpu is None else '{:.3f}'.format(gpu['p95'])))
+        frame = self.stats('frame')
+        if frame is not None:
+            lines.append('{} frames, {:.1f} FPS (times in ms)'.format(self.frame, 1e3 / frame['mean']))
+        return '\n'.join(lines)
+
+    def start_trace(self):
+        '''
+        Starts recording every phase as an event of a Chrome trace.
+        '''
+        self.events = []
+        self.tracing = True
+
+    def trace_event(self, name, category, start, duration):
+        # GPU phases are shown on their own row, starting when their commands were issued
+        self.events.append({
+            'name': name, 'cat': category, 'ph': 'X', 'pid': 0, 'tid': 1 if category == 'gpu' else 0,
+            'ts': (start - self.t0) / 1e3, 'dur': duration / 1e3
+        })
+
+    def save_trace(self, file_name):
+        '''
+        Stops tracing and saves the events in the Chrome trace format, which can be opened
+        in chrome://tracing or https://ui.perfetto.dev
+        '''
+        self.tracing = False
+        metadata = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': 0, 'args': {'name': 'CPU'}},
+            {'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': 1, 'args': {'name': 'GPU'}},
+        ]
+        with open(file_name, 'w') as file:
+            json.dump({'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}, file)
+        print('Saved {} trace events to {}'.format(len(self.events), file_name))
+
+    def reset(self):
+        self.cpu_times.clear()
+        self.gpu_times.clear()
+        self.gpu_partial.clear()
+        self.frame = 0
+
+    def release(self):
+        '''
+        Deletes the GL query objects, including the ones whose results were not read.
+        '''
+        queries = self.free_queries + [query for _, _, query, _ in self.pending]
+        if queries:
+            glDeleteQueries(len(queries), queries)
+        self.free_queries = []
+        self.pending.clear()
+
+
+# profiler shared by the scene and the models, disabled until it is needed
+profiler = FrameProfiler()
@@ -0,0 +1,118 @@
+import argparse
+import itertools
+import os
+import time
+
+from window import use_headless, save_image
+
+'''
+Renders a sweep of fur settings straight to image files, without opening a window. Run from the Coursework folder:
+    python render_sweep.py --models models/bunny_world.obj models/rock.obj --fur-length 0.1 0.2 --phi 0 90
+All combinations of the given values are rendered in a single GL context, and the frame rate is reported at the end.
+'''
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Renders a sweep of fur settings to image files.')
+    parser.add_argument('--models', nargs='+', default=['models/bunny_world.obj'], help='OBJ files to render')
+    parser.add_argument('--fur-length', nargs='+', type=float, default=[0.1])
+    parser.add_argument('--fur-density', nargs='+', type=int, default=[30000])
+    parser.add_argument('--layers', nargs='+', type=int, default=[30], help='number of fur shells')
+    parser.add_argument('--phi', nargs='+', type=float, default=[0.], help='camera azimuth angles, in degrees')
+    parser.add_argument('--psi', nargs='+', type=float, default=[0.], help='camera zenith angles, in degrees')
+    parser.add_argument('--size', nargs=2, type=int, default=[800, 600], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--frames', type=int, default=1,
+                        help='frames drawn for each setting, the frame rate is measured over all of them')
+    parser.add_argument('--seed', type=int, default=0, help='fur seed, so that renders can be compared')
+    parser.add_argument('--instanced', action='store_true', help='draw all shells in a single instanced call')
+    parser.add_argument('--lod', action='store_true',
+                        help='draw simplified levels of detail of the models when they are small on the screen')
+    parser.add_argument('--out', default='renders', help='directory for the images')
+    parser.add_argument('--format', default='png', help='image file extension, eg. png, bmp or tga')
+    parser.add_argument('--window', action='store_true', help='render in a pygame window instead of headless')
+    parser.add_argument('--profile', action='store_true', help='print the time spent in each phase of the frames')
+    parser.add_argument('--trace', help='saves a Chrome trace of the timed frames to this JSON file')
+    return parser.parse_args(argv)
+
+
+def image_name(args, model, fur_length, fur_density, num_of_layers, phi, psi):
+    name = os.path.splitext(os.path.basename(model))[0]
+    return os.path.join(args.out, '{}_len{:g}_den{}_lay{}_phi{:g}_psi{:g}.{}'.format(
+        name, fur_length, fur_density, num_of_layers, phi, psi, args.format))
+
+
+def sweep(args):
+    '''
+    Renders every combination of the settings, changing models and shell counts as rarely as possible.
+    '''
+    # imported here, after the OpenGL platform has been chosen
+    import numpy as np
+    from FurApp import RabbitScene
+    from profiler import profiler
+    from shaders import shader_cache, uniform_stats
+    from texture import texture_cache
+    from transform import transform_stats
+
+    scene = RabbitScene(args.size[0], args.size[1], headless=not args.window, model=args.models[0],
+                        fur_seed=args.seed, lod=args.lod, async_loading=False)
+    scene.instanced = args.instanced
+    os.makedirs(args.out, exist_ok=True)
+
+    profiler.enabled = args.profile or args.trace is not None
+    if args.trace is not None:
+        profiler.start_trace()
+
+    frames = 0
+    draw_time = 0.
+    t_start = time.perf_counter()
+    settings = itertools.product(args.models, args.layers, args.fur_density, args.fur_length, args.phi, args.psi)
+    for model, num_of_layers, fur_density, fur_length, phi, psi in settings:
+        scene.num_of_layers = num_of_layers
+        scene.fur_density = fur_density
+        scene.fur_length = fur_length
+        scene.camera.phi = np.radians(phi)
+        scene.camera.psi = np.radians(psi)
+        scene.switchModel(model)
+
+        # the first frame of a setting also uploads the changes, so it is left out of the frame rate
+        scene.draw()
+        pixels = scene.read_pixels()
+        for _ in range(args.frames):
+            t0 = time.perf_counter()
+            profiler.begin_frame()
+            scene.draw()
+            with profiler.phase('read_pixels'):
+                pixels = scene.read_pixels()
+            profiler.end_frame()
+            draw_time += time.perf_counter() - t0
+            frames += 1
+
+        file_name = image_name(args, model, fur_length, fur_density, num_of_layers, phi, psi)
+        save_image(pixels, file_name)
+        print('Saved {}'.format(file_name))
+
+    total = time.perf_counter() - t_start
+    print('{} frames drawn at {:.1f} FPS ({:.2f} ms per frame), {:.1f} s in total'.format(
+        frames, frames / draw_time if draw_time > 0 else 0., 1e3 * draw_time / max(frames, 1), total))
+    if profiler.enabled:
+        # the last GPU timings are read once all frames are finished
+        profiler.collect()
+        print(profiler.summary())
+        uniform_stats.report()
+        transform_stats.report()
+        texture_cache.report()
+    if args.trace is not None:
+        profiler.save_trace(args.trace)
+
+    # GL objects are deleted while the context still exists
+    profiler.release()
+    scene.registry.release()
+    shader_cache.release()
+    scene.window.close()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if not args.window:
+        use_headless()
+    sweep(args)
@@ -1,6 +1,8 @@
 # pygame is just used to create a window with the operating system on which to draw.
 import pygame
 
+import time
+
 # import the shader class
 from shaders import *
 
@@ -12,15 +14,23 @@ from matutils import *
 
 from lightSource import LightSource
 
+from window import create_window
+
+from profiler import profiler
+
 
 class Scene:
     """
     This is the main class for a drawing an OpenGL scene using the PyGame library
     """
 
-    def __init__(self, width=800, height=600):
+    def __init__(self, width=800, height=600, headless=False, on_demand=False, max_fps=None, vsync=False):
         """
         Initialises the scene
+        :param headless: if True, renders offscreen without opening a window (see window.use_headless)
+        :param on_demand: if True, run() only draws a frame after an input or a change, and sleeps otherwise
+        :param max_fps: [optional] the maximum number of frames drawn per second by run()
+        :param vsync: if True, waits for the vertical sync of the display to swap the buffers
         """
 
         self.window_size = (width, height)
@@ -28,12 +38,25 @@ class Scene:
         # by default, wireframe mode is off
         self.wireframe = False
 
-        # the first two lines initialise the pygame window. You could use another library for this,
-        # for example GLut or Qt
-        pygame.init()
+        # opens the pygame window, or creates an offscreen framebuffer when there is no display
+        self.window = create_window(width, height, headless, vsync)
+
+        # when drawing on demand, a frame is only drawn when needs_redraw is set, or while animating is True
+        self.on_demand = on_demand
+        self.needs_redraw = True
+        self.animating = False
+
+        # while work runs in the background (see busy()), the loop checks for it this often instead of sleeping
+        self.poll_interval = 0.05
+        self.max_fps = max_fps
+
+        # frames drawn, wall time and process time since the last frame rate report
+        self.report_interval = 5.
+        self.frame_count = 0
+        self.report_start = None
 
-        # THIS NEEDS TO BE HERE.
-        screen = pygame.display.set_mode(self.window_size, pygame.OPENGL | pygame.DOUBLEBUF, 24)
+        # last mouse movement, while dragging
+        self.mouse_mvt = None
 
         # Here we start initialising the window from the OpenGL side
         glViewport(0, 0, self.window_size[0], self.window_size[1])
@@ -77,6 +100,19 @@ class Scene:
         # This class will maintain a list of models to draw in the scene,
         self.models = []
 
+    @property
+    def P(self):
+        return self._P
+
+    @P.setter
+    def P(self, P):
+        """
+        Sets the projection matrix. Assign a new matrix rather than changing it in place, so that
+        the cached matrices which depend on it are computed again.
+        """
+        self._P = P
+        self.projection_version = getattr(self, 'projection_version', 0) + 1
+
     def add_model(self, model):
         """
         This method just adds a model to the scene.
@@ -100,17 +136,25 @@ class Scene:
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
         # ensure that the camera view matrix is up to date
-        self.camera.update()
+        with profiler.phase('camera'):
+            self.camera.update()
 
         # then we loop over all models in the list and draw them
-        for model in self.models:
-            model.draw()
+        with profiler.phase('model_draw'):
+            for model in self.models:
+                model.draw()
 
         # once we are done drawing, we display the scene
         # Note that here we use double buffering to avoid artefacts:
         # we draw on a different buffer than the one we display,
         # and flip the two buffers once we are done drawing.
-        pygame.display.flip()
+        self.window.flip()
+
+    def read_pixels(self):
+        """
+        :return: the last frame drawn as a (height, width, 3) array of bytes
+        """
+        return self.window.read_pixels()
 
     def keyboard(self, event):
         """
@@ -135,31 +179,116 @@ class Scene:
         elif event.key == pygame.K_DOWN:
             self.camera.psi += 0.1
 
+        # shows the time spent in each phase of the frame every second or so
+        elif event.key == pygame.K_p:
+            profiler.enabled = not profiler.enabled
+            profiler.overlay = self.show_profile if profiler.enabled else None
+            if not profiler.enabled:
+                self.window.set_title('')
+            print('Frame profiler: {}'.format(profiler.enabled))
+
+        # records a trace of the frames, saved to trace.json when pressed again
+        elif event.key == pygame.K_t:
+            if profiler.tracing:
+                profiler.save_trace('trace.json')
+            else:
+                profiler.enabled = True
+                profiler.start_trace()
+                print('Recording a trace, press T again to save it')
+
+    def show_profile(self, summary):
+        """
+        Prints the profiler statistics, and shows the frame rate in the window title.
+        """
+        print(summary)
+        self.window.set_title(summary.splitlines()[-1])
+
+    def request_redraw(self):
+        """
+        Asks for a new frame, call this after changing anything which is drawn.
+        """
+        self.needs_redraw = True
+
+    def update(self):
+        """
+        Called on every iteration of the loop before drawing, for changes which do not come from an event, eg. work
+        finished in the background. Call request_redraw() when it changes what is drawn.
+        """
+        pass
+
+    def busy(self):
+        """
+        :return: True while work is running in the background, so that the loop does not sleep until the next event
+        """
+        return False
+
     def pygameEvents(self):
         """
         Method to handle PyGame events for user interaction.
         """
         # check whether the window has been closed
         for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                self.running = False
-
-            # keyboard events
-            elif event.type == pygame.KEYDOWN:
-                self.keyboard(event)
-
-            # controls translation of the camera, using mouse click and drag.F
-            elif event.type == pygame.MOUSEMOTION:
-                if pygame.mouse.get_pressed()[0]:
-                    if self.mouse_mvt is not None:
-                        self.mouse_mvt = pygame.mouse.get_rel()
-                        self.camera.center[0] -= (float(self.mouse_mvt[0]) / self.window_size[0])
-                        self.camera.center[1] -= (float(self.mouse_mvt[1]) / self.window_size[1])
-                    else:
-                        self.mouse_mvt = pygame.mouse.get_rel()
+            self.handle_event(event)
+
+    def handle_event(self, event):
+        """
+        Processes a single PyGame event, and asks for a new frame if it can change what is drawn.
+        """
+        if event.type == pygame.QUIT:
+            self.running = False
 
+        # keyboard events
+        elif event.type == pygame.KEYDOWN:
+            self.keyboard(event)
+            self.request_redraw()
+
+        # controls translation of the camera, using mouse click and drag.F
+        elif event.type == pygame.MOUSEMOTION:
+            if pygame.mouse.get_pressed()[0]:
+                if self.mouse_mvt is not None:
+                    self.mouse_mvt = pygame.mouse.get_rel()
+                    self.camera.center[0] -= (float(self.mouse_mvt[0]) / self.window_size[0])
+                    self.camera.center[1] -= (float(self.mouse_mvt[1]) / self.window_size[1])
+                    self.request_redraw()
                 else:
-                    self.mouse_mvt = None
+                    self.mouse_mvt = pygame.mouse.get_rel()
+
+            else:
+                self.mouse_mvt = None
+
+        # the window was uncovered, restored or resized, so its content must be drawn again
+        elif event.type in (pygame.VIDEOEXPOSE, pygame.VIDEORESIZE, pygame.WINDOWEXPOSED, pygame.WINDOWSHOWN,
+                            pygame.WINDOWRESTORED, pygame.WINDOWSIZECHANGED):
+            self.request_redraw()
+
+    def wait_for_events(self):
+        """
+        Sleeps until an event arrives when there is nothing to draw, so that an idle scene uses no CPU or GPU.
+        The wait is cut at the report interval, so that the frame rate is still reported.
+        """
+        if not self.on_demand or self.needs_redraw or self.animating:
+            return
+        timeout = self.poll_interval if self.busy() else self.report_interval
+        event = pygame.event.wait(int(timeout * 1000))
+        if event.type != pygame.NOEVENT:
+            self.handle_event(event)
+
+    def report_frame_rate(self, force=False):
+        """
+        Prints the frame rate achieved and the share of time the process was idle, every report_interval seconds.
+        """
+        now = time.perf_counter(), time.process_time()
+        if self.report_start is None:
+            self.report_start = now
+            return
+        wall = now[0] - self.report_start[0]
+        if wall < self.report_interval and not force:
+            return
+        busy = (now[1] - self.report_start[1]) / wall if wall > 0 else 0.
+        print('(F) {} frames in {:.1f}s: {:.1f} FPS, CPU {:.0f}% busy, {:.0f}% idle'.format(
+            self.frame_count, wall, self.frame_count / wall if wall > 0 else 0., 100 * busy, 100 * max(1 - busy, 0.)))
+        self.frame_count = 0
+        self.report_start = now
 
     def run(self):
         """
@@ -168,8 +297,31 @@ class Scene:
 
         # We have a classic program loop
         self.running = True
+        clock = pygame.time.Clock()
+        self.report_frame_rate()
         while self.running:
-            self.pygameEvents()
+            # when drawing on demand, sleep until something happens
+            self.wait_for_events()
+
+            profiler.begin_frame()
+            with profiler.phase('events'):
+                self.pygameEvents()
+
+            # eg. uploads the models loaded in the background
+            with profiler.phase('update'):
+                self.update()
 
             # otherwise, continue drawing
-            self.draw()
+            if self.running and (not self.on_demand or self.needs_redraw or self.animating):
+                self.needs_redraw = False
+                self.draw()
+                self.frame_count += 1
+
+                # sleeps for the rest of the frame if it is faster than max_fps
+                if self.max_fps is not None:
+                    clock.tick(self.max_fps)
+            profiler.end_frame()
+
+            self.report_frame_rate()
+
+        self.report_frame_rate(force=True)
@@ -1,15 +1,45 @@
+import ctypes
+import hashlib
+import os
+
 # imports all openGL functions
 from OpenGL.GL import *
 from OpenGL.GL import shaders
+from OpenGL.error import GLError
 from matutils import *
 # we will use numpy to store data in arrays
 import numpy as np
 
 
+class UniformStats:
+    """
+    Counts the uniform uploads which were sent to OpenGL, and the ones which were skipped because
+    the value had not changed since the last upload.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.uploads = 0
+        self.skipped = 0
+        self.buffer_uploads = 0
+        self.buffer_skipped = 0
+
+    def report(self):
+        print('(U) Uniforms: {} uploads, {} skipped. Uniform buffers: {} uploads, {} skipped.'.format(
+            self.uploads, self.skipped, self.buffer_uploads, self.buffer_skipped))
+
+
+# counters shared by all uniforms
+uniform_stats = UniformStats()
+
+
 class Uniform:
     """
     We create a simple class to handle uniforms, this is not necessary,
-    but allow to put all relevant code in one place
+    but allow to put all relevant code in one place.
+    The last value sent to OpenGL is remembered, so that binding the same value again does nothing.
     """
 
     def __init__(self, uniform_name, value=None):
@@ -20,6 +50,8 @@ class Uniform:
         self.name = uniform_name
         self.value = value
         self.location = -1
+        self.uploaded = None
+        self.source = None
 
     def link(self, program):
         """
@@ -31,6 +63,34 @@ class Uniform:
         if self.location == -1:
             print('(E) Warning, no uniform {}'.format(self.name))
 
+        # linking resets all uniforms of the program
+        self.uploaded = None
+        self.source = None
+
+    def changed(self):
+        """
+        Checks whether the current value differs from the last one sent to OpenGL, and if so remembers it.
+        :return: True if the value needs to be uploaded
+        """
+        # read-only matrices are cached by their owner (see transform.frozen), the same object has the same value
+        if isinstance(self.value, np.ndarray) and not self.value.flags.writeable and self.value is self.source:
+            uniform_stats.skipped += 1
+            return False
+
+        if self.uploaded is not None and type(self.uploaded) is type(self.value):
+            if isinstance(self.value, np.ndarray):
+                same = self.uploaded.shape == self.value.shape and np.array_equal(self.uploaded, self.value)
+            else:
+                same = self.uploaded == self.value
+            if same:
+                uniform_stats.skipped += 1
+                return False
+
+        self.uploaded = self.value.copy() if isinstance(self.value, np.ndarray) else self.value
+        self.source = self.value
+        uniform_stats.uploads += 1
+        return True
+
     def bind_matrix(self, M=None, number=1, transpose=True):
         """
         Call this before rendering to bind the Python matrix to the GLSL uniform mat4.
@@ -41,6 +101,8 @@ class Uniform:
         """
         if M is not None:
             self.value = M
+        if not self.changed():
+            return
         if self.value.shape[0] == 4 and self.value.shape[1] == 4:
             glUniformMatrix4fv(self.location, number, transpose, self.value)
         elif self.value.shape[0] == 3 and self.value.shape[1] == 3:
@@ -67,25 +129,29 @@ class Uniform:
     def bind_int(self, value=None):
         if value is not None:
             self.value = value
-        glUniform1i(self.location, self.value)
+        if self.changed():
+            glUniform1i(self.location, self.value)
 
     def bind_float(self, value=None):
         if value is not None:
-            self.value = value
-        glUniform1f(self.location, self.value)
+            self.value = float(value)
+        if self.changed():
+            glUniform1f(self.location, self.value)
 
     def bind_vector(self, value=None):
         if value is not None:
             self.value = value
-        if value.shape[0] == 2:
-            glUniform2fv(self.location, 1, value)
-        elif value.shape[0] == 3:
-            glUniform3fv(self.location, 1, value)
-        elif value.shape[0] == 4:
-            glUniform4fv(self.location, 1, value)
+        if not self.changed():
+            return
+        if self.value.shape[0] == 2:
+            glUniform2fv(self.location, 1, self.value)
+        elif self.value.shape[0] == 3:
+            glUniform3fv(self.location, 1, self.value)
+        elif self.value.shape[0] == 4:
+            glUniform4fv(self.location, 1, self.value)
         else:
             print('(E) Error in Uniform.bind_vector(): Vector should be of dimension 2,3 or 4, found {}'.format(
-                value.shape[0]))
+                self.value.shape[0]))
 
     def set(self, value):
         """
@@ -94,16 +160,87 @@ class Uniform:
         self.value = value
 
 
+class UniformBuffer:
+    """
+    A std140 uniform buffer object, shared by all programs which declare the block. The data is
+    only uploaded when it differs from the previous upload.
+    """
+
+    def __init__(self, block_name, binding, layout):
+        """
+        :param block_name: the name of the uniform block in the GLSL code
+        :param binding: the binding point of the buffer
+        :param layout: list of (name, size in floats) in the order of the block, using the std140 rules
+        (vec3 and scalars followed by a vec4 or matrix must be padded by the caller)
+        """
+        self.block_name = block_name
+        self.binding = binding
+        self.offsets = {}
+        offset = 0
+        for name, size in layout:
+            self.offsets[name] = (offset, size)
+            offset += size
+
+        # std140 blocks are a multiple of a vec4
+        self.data = np.zeros(4 * ((offset + 3) // 4), dtype=np.float32)
+        self.uploaded = None
+        self.buffer = None
+
+    def link(self, program):
+        """
+        Connects the block of a program to the binding point of this buffer.
+        """
+        index = glGetUniformBlockIndex(program, self.block_name)
+        if index == GL_INVALID_INDEX:
+            print('(E) Warning, no uniform block {}'.format(self.block_name))
+            return
+        glUniformBlockBinding(program, index, self.binding)
+
+    def set(self, name, value):
+        offset, size = self.offsets[name]
+        self.data[offset:offset + size] = np.asarray(value, dtype=np.float32).ravel()
+
+    def upload(self):
+        """
+        Sends the data to OpenGL if it changed since the last upload.
+        """
+        if self.buffer is None:
+            self.buffer = glGenBuffers(1)
+            glBindBuffer(GL_UNIFORM_BUFFER, self.buffer)
+            glBufferData(GL_UNIFORM_BUFFER, self.data.nbytes, None, GL_DYNAMIC_DRAW)
+            glBindBufferBase(GL_UNIFORM_BUFFER, self.binding, self.buffer)
+
+        if self.uploaded is not None and np.array_equal(self.uploaded, self.data):
+            uniform_stats.buffer_skipped += 1
+            return
+
+        glBindBuffer(GL_UNIFORM_BUFFER, self.buffer)
+        glBufferSubData(GL_UNIFORM_BUFFER, 0, self.data.nbytes, self.data)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+        self.uploaded = self.data.copy()
+        uniform_stats.buffer_uploads += 1
+
+
+# per-frame data shared by all fur shaders. The matrices are stored row major, as numpy does.
+frame_data = UniformBuffer('FrameData', binding=0, layout=[
+    ('projection', 16),
+    ('view', 16),
+    ('num_of_layers', 1),
+    ('fur_length', 1),
+    ('furFlowOffset', 1),
+])
+
+
 class FurShader:
     """
     This is the base class for loading and compiling the GLSL shaders.
     """
 
-    def __init__(self):
+    def __init__(self, defines=None):
         """
         Initialises the shaders
-        :param vertex_shader: the name of the file containing the vertex shader GLSL code
-        :param fragment_shader: the name of the file containing the fragment shader GLSL code
+        :param defines: [optional] dict of preprocessor macros added to both shaders, eg. {'INSTANCED': 1}
+        to draw all the fur layers in a single instanced draw call.
         """
 
         print('Creating shader program.')
@@ -122,79 +259,273 @@ class FurShader:
         with open(fragment_shader, 'r') as file:
             self.fragment_shader_source = file.read()
 
+        self.defines = {} if defines is None else defines
+        self.vertex_shader_source = add_defines(self.vertex_shader_source, self.defines)
+        self.fragment_shader_source = add_defines(self.fragment_shader_source, self.defines)
+
         # All of the uniforms which are required for the shaders.
         self.uniforms = {
             'UVScale': Uniform('UVScale'),
-            'num_of_layers': Uniform('num_of_layers'),
             'current_layer': Uniform('current_layer'),
-            'projection': Uniform('projection'),
-            'view': Uniform('view'),
             'model': Uniform('model'),
-            'fur_length': Uniform('fur_length'),
-            'furFlowOffset': Uniform('furFlowOffset'),
+            'layer_scale': Uniform('layer_scale'),
             'textureUnit0': Uniform('textureUnit0'),
             'textureUnit1': Uniform('textureUnit1')
         }
 
+        # when drawing instanced, the layer and UVScale are computed in the shader from the instance ID,
+        # starting at first_layer
+        if 'INSTANCED' in self.defines:
+            del self.uniforms['current_layer']
+            del self.uniforms['UVScale']
+            self.uniforms['first_layer'] = Uniform('first_layer')
+
         self.model_program = None
+        self.program = None
+
+    def key(self, attributes):
+        """
+        :return: a hash identifying the linked program, from the sources (including defines) and attribute locations
+        """
+        h = hashlib.sha1()
+        h.update(self.vertex_shader_source.encode())
+        h.update(self.fragment_shader_source.encode())
+        h.update(repr(sorted(attributes.items())).encode())
+        return h.hexdigest()
 
-    def compile(self, attributes):
+    def compile(self, attributes, binaries=None):
         """
         Call this function to compile the GLSL codes for both shaders.
+        :param binaries: [optional] a ProgramBinaryCache, to reuse the program linked by a previous run
         :return:
         """
-        print('Compiling GLSL shaders....')
-        try:
-            self.program = glCreateProgram()
-            glAttachShader(self.program, shaders.compileShader(self.vertex_shader_source, shaders.GL_VERTEX_SHADER))
-            glAttachShader(self.program, shaders.compileShader(self.fragment_shader_source, shaders.GL_FRAGMENT_SHADER))
+        key = self.key(attributes)
+        self.program = glCreateProgram()
+
+        if binaries is None or not binaries.load(key, self.program):
+            if binaries is not None:
+                # start from a new program, in case the driver rejected a binary
+                glDeleteProgram(self.program)
+                self.program = glCreateProgram()
+
+            print('Compiling GLSL shaders....')
+            try:
+                glAttachShader(self.program, shaders.compileShader(self.vertex_shader_source, shaders.GL_VERTEX_SHADER))
+                glAttachShader(self.program,
+                               shaders.compileShader(self.fragment_shader_source, shaders.GL_FRAGMENT_SHADER))
 
-        except RuntimeError as error_message:
-            print('(E) An error occurred while compiling {} shader:\n {}\n... forwarding exception...'.format(self.name,
-                                                                                                              error_message)),
-            raise error_message
+            except RuntimeError as error_message:
+                print('(E) An error occurred while compiling shader:\n {}\n... forwarding exception...'.format(
+                    error_message))
+                raise error_message
 
-        self.bindAttributes(attributes)
+            self.bindAttributes(attributes)
 
-        # Links the program
-        glLinkProgram(self.program)
+            # Links the program
+            if binaries is not None:
+                glProgramParameteri(self.program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+            glLinkProgram(self.program)
+
+            if binaries is not None:
+                binaries.save(key, self.program)
 
         # tell OpenGL to use this shader program for rendering
-        glUseProgram(self.program)
+        use_program(self.program)
 
         # link all uniforms
         for uniform in self.uniforms:
             self.uniforms[uniform].link(self.program)
 
+        # and the per-frame uniform block
+        frame_data.link(self.program)
+
     def bindAttributes(self, attributes):
         # bind all shader attributes to the correct locations in the VAO
         for attrib_name, location in attributes.items():
             glBindAttribLocation(self.program, location, attrib_name)
             print('Binding attribute {} to location {}'.format(attrib_name, location))
 
-    def bind(self, model, M, UVScale, num_of_layers, fur_length, current_layer, furFlowOffset):
+    def bind(self, model, M, UVScale, num_of_layers, fur_length, current_layer, furFlowOffset, layer_scale=1.):
         """
         Call this function to enable this GLSL Program (you can have multiple GLSL programs used during rendering!)
+        When drawing instanced, current_layer is the layer of the first instance.
+        :param layer_scale: the fur texture layer sampled by a shell is its index times layer_scale, to draw fewer
+        shells than the texture has layers
         """
 
         # tell OpenGL to use this shader program for rendering
-        glUseProgram(self.program)
-
-        P = model.scene.P
-        V = model.scene.camera.V
-
-        # set the uniforms
-        self.uniforms['projection'].bind(P)
-        self.uniforms['view'].bind(V)
+        use_program(self.program)
+
+        # the per-frame data is shared by all programs in a uniform buffer, which is only
+        # uploaded again when one of the values changed.
+        frame_data.set('projection', model.scene.P)
+        frame_data.set('view', model.scene.camera.V)
+        frame_data.set('num_of_layers', num_of_layers)
+        frame_data.set('fur_length', fur_length)
+        frame_data.set('furFlowOffset', furFlowOffset)
+        frame_data.upload()
+
+        # set the uniforms, they are only sent to OpenGL if they changed
         self.uniforms['model'].bind(M)
+        self.uniforms['layer_scale'].bind_float(layer_scale)
 
-        self.uniforms['UVScale'].bind_float(UVScale)
-        self.uniforms['num_of_layers'].bind_float(num_of_layers)
-        self.uniforms['fur_length'].bind_float(fur_length)
-        self.uniforms['current_layer'].bind_float(current_layer)
-        self.uniforms['furFlowOffset'].bind_float(furFlowOffset)
+        if 'UVScale' in self.uniforms:
+            self.uniforms['UVScale'].bind_float(UVScale)
+            self.uniforms['current_layer'].bind_float(current_layer)
+        else:
+            self.uniforms['first_layer'].bind_float(current_layer)
         self.uniforms['textureUnit0'].bind(0)
         self.uniforms['textureUnit1'].bind(1)
 
     def unbind(self):
-        glUseProgram(0)
+        use_program(0)
+
+    def release(self):
+        """
+        Deletes the GLSL program.
+        """
+        if self.program is not None:
+            if current_program == self.program:
+                use_program(0)
+            glDeleteProgram(self.program)
+            self.program = None
+
+
+# the program currently in use, to avoid switching to the same program again
+current_program = None
+
+
+def use_program(program):
+    global current_program
+    if program != current_program:
+        glUseProgram(program)
+        current_program = program
+
+
+def add_defines(source, defines):
+    """
+    Adds #define lines to a GLSL source, just after the #version line which must stay first.
+    """
+    lines = source.split('\n')
+    return '\n'.join(lines[:1] + ['#define {} {}'.format(name, value) for name, value in defines.items()] + lines[1:])
+
+
+class ProgramBinaryCache:
+    """
+    On-disk cache of linked programs, saved with glGetProgramBinary and reloaded with glProgramBinary.
+    A binary is only valid for the driver which created it, so the driver strings are part of the file name.
+    If the driver rejects a binary anyway, the program is compiled from the sources again.
+    """
+
+    def __init__(self, directory='.shadercache', enabled=True):
+        self.directory = directory
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        driver = '{} {} {}'.format(glGetString(GL_VENDOR), glGetString(GL_RENDERER), glGetString(GL_VERSION))
+        return os.path.join(self.directory, '{}.bin'.format(hashlib.sha1((key + driver).encode()).hexdigest()))
+
+    def supported(self):
+        return self.enabled and glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS) > 0
+
+    def load(self, key, program):
+        """
+        Loads a program binary, if there is one for this key.
+        :return: True if the program was loaded and linked successfully
+        """
+        if not self.supported():
+            return False
+
+        try:
+            data = np.fromfile(self.path(key), dtype=np.uint8)
+        except OSError:
+            self.misses += 1
+            return False
+
+        # the file holds the binary format as a uint32, followed by the binary. A file cut short, eg. when the disk
+        # was full, is dropped like a binary the driver rejects.
+        if data.shape[0] <= 4:
+            print('(W) Program binary {} is truncated, compiling the shaders instead.'.format(self.path(key)))
+            linked = False
+        else:
+            binary_format = int(data[:4].view(np.uint32)[0])
+            binary = np.ascontiguousarray(data[4:])
+            try:
+                glProgramBinary(program, binary_format, binary.ctypes.data_as(ctypes.c_void_p), binary.shape[0])
+                linked = glGetProgramiv(program, GL_LINK_STATUS) == GL_TRUE
+            except GLError:
+                linked = False
+            if not linked:
+                print('(W) Program binary rejected by the driver, compiling the shaders instead.')
+
+        if not linked:
+            self.misses += 1
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+            return False
+
+        print('Loaded program binary {}'.format(self.path(key)))
+        self.hits += 1
+        return True
+
+    def save(self, key, program):
+        """
+        Saves the binary of a linked program.
+        """
+        if not self.supported():
+            return
+
+        length = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+        binary = np.empty(length, dtype=np.uint8)
+        written = GLsizei(0)
+        binary_format = GLenum(0)
+        glGetProgramBinary(program, length, ctypes.byref(written), ctypes.byref(binary_format),
+                           binary.ctypes.data_as(ctypes.c_void_p))
+
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = '{}.tmp{}'.format(self.path(key), os.getpid())
+        with open(tmp, 'wb') as file:
+            file.write(np.uint32(binary_format.value).tobytes())
+            file.write(binary[:written.value].tobytes())
+        os.replace(tmp, self.path(key))
+
+
+class ShaderCache:
+    """
+    Process-wide cache of compiled fur shaders, so that all models with the same sources, defines and attribute
+    locations share one program (and its uniform state).
+    """
+
+    def __init__(self, binaries=None):
+        """
+        :param binaries: [optional] a ProgramBinaryCache, to also reuse programs linked by previous runs
+        """
+        self.shaders = {}
+        self.binaries = binaries
+
+    def get(self, attributes, defines=None):
+        """
+        Returns the shader for these attributes and defines, compiling it if it is not in the cache yet.
+        """
+        shader = FurShader(defines)
+        key = shader.key(attributes)
+        if key not in self.shaders:
+            shader.compile(attributes, self.binaries)
+            self.shaders[key] = shader
+        return self.shaders[key]
+
+    def release(self):
+        """
+        Deletes all programs.
+        """
+        for shader in self.shaders.values():
+            shader.release()
+        self.shaders.clear()
+
+
+# cache shared by all models
+shader_cache = ShaderCache(ProgramBinaryCache())
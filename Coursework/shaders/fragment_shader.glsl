@@ -1,39 +1,44 @@
-#version 130					// required to use the OpenGL core standard
+#version 140					// required to use the OpenGL core standard
 
 // This code was adapted from a tutorial on how to build Fur Effects, written on the website
 // xbdev.net. (https://xbdev.net/directx3dx/specialX/Fur/)
 
 //=== in attributes are read from the vertex array, one row per instance of the shader
 in vec2 frag_TexCoord;			// the texture coordinates which is coming in from the vertex_shader
+flat in float frag_Material;		// the material of the mesh, which is the layer of its texture
 
 //=== Uniforms
+#ifdef INSTANCED
+flat in float frag_Layer;		// When all layers are drawn at once, the layer and UVScale come from the vertex shader
+flat in float frag_UVScale;
+#define current_layer frag_Layer
+#define UVScale frag_UVScale
+#else
 uniform float UVScale;			// Fur texture alpha coords are stretched/shrunk, UVScale deals with this
-uniform float num_of_layers;	// The number of layers which are to be rendered
 uniform float current_layer;		// The current layer which is being rendered
-uniform sampler2D textureUnit0;	// The texture being generated from the createFurTextures function
-uniform sampler2D textureUnit1;	// The texture which was given for the program.
+#endif
+uniform float layer_scale;		// The fur texture layer of a shell is its layer times this, when fewer shells are drawn
+uniform sampler2DArray textureUnit0;	// The fur layers generated in FurTextureGen, one per shell
+uniform sampler2DArray textureUnit1;	// The textures of the materials which were given for the program.
 
 //=== out attributes
 out vec4 outColor;				// The output of the shader will be the colour of the vertex
 
 vec4 furColor;					// 4D vector as there is a RGBA (alpha)
-vec4 baseColor = texture(textureUnit1, frag_TexCoord);
+vec4 baseColor = texture(textureUnit1, vec3(frag_TexCoord, frag_Material));
 
 //=== main shader code
 void main(void) {
 	if(current_layer > 0)
 	{
-		furColor = texture(textureUnit0, frag_TexCoord);
-		// If the alpha value is less than 0.1, it isn't used, therefore transparent.
-		if(furColor.a < 0.1) discard;
-
-		// If the alpha value is greater than 0.1, then the RGB values are looked at.
-		if(furColor.r < 0.1) discard;
-		else furColor.r = baseColor.r;
-		if(furColor.g < 0.1) discard;
-		else furColor.g = baseColor.g;
-		if(furColor.b < 0.1) discard;
-		else furColor.b = baseColor.b;
+		// The fur texture has a single channel, which is 1 where a strand goes through the current layer.
+		// The nearest texture layer at the height of the shell is used.
+		float strand = texture(textureUnit0, vec3(frag_TexCoord, current_layer * layer_scale)).r;
+		// If the value is less than 0.1, there is no strand here, therefore transparent.
+		if(strand < 0.1) discard;
+
+		// Otherwise the strand takes the colour of the skin texture.
+		furColor.rgb = baseColor.rgb;
 	}
 
 	furColor.w = UVScale;
@@ -1,35 +1,74 @@
-#version 130 					// required to use OpenGL core standard
+#version 140 					// required to use OpenGL core standard (and gl_InstanceID)
 
 // This code was adapted from a tutorial on how to build Fur Effects, written on the website
 // xbdev.net. (https://xbdev.net/directx3dx/specialX/Fur/)
 
 //=== in attributes, read from vertex array
 in  vec3 position;				// the position of the attribute contains the vertex position
+#ifdef OCTAHEDRAL_NORMALS
+in  vec2 normal;				// the vertex normal, projected on an octahedron (see vertexformat.py)
+#else
 in  vec3 normal;				// store the vertex normal
+#endif
 in  vec2 texCoord;				// texture coordinates
 in 	vec3 fur;					// puts the lines on the object
+in  float material;				// index of the material of the mesh, its layer in the skin textures
+
+//=== Per-frame uniforms, shared by all programs in a uniform buffer (see shaders.frame_data)
+layout(std140, row_major) uniform FrameData {
+	mat4 projection;			// projection matrix
+	mat4 view;					// view matrix
+	float num_of_layers;		// number of layers
+	float fur_length;			// fur length
+	float furFlowOffset;		// this is for fur animation and movement
+};
 
 //=== Uniforms
-uniform  float furFlowOffset;	// this is for fur animation and movement
+#ifndef INSTANCED
 uniform  float current_layer;	// current layer
-uniform  float num_of_layers;	// number of layers
-uniform	 float fur_length;		// fur length
+#else
+uniform  float first_layer;		// layer drawn by the first instance
+#endif
 
 //=== View uniforms
 uniform mat4 model;				// model matrix
-uniform mat4 view;				// view matrix
-uniform mat4 projection;		// projection matrix
 
 //=== Out attributes, interpolated on the face, given to fragment shader
 out vec2 frag_TexCoord;	// outputs the texture coordinates
+flat out float frag_Material;	// and the material
+#ifdef INSTANCED
+flat out float frag_Layer;	// the layer drawn by this instance
+flat out float frag_UVScale;	// and its UVScale
+#endif
 
 vec4 vGravity = vec4(0.0f, -2.0f, 0.0f, 1.0f);  // gives curves on the end of the fur, like gravity
 
+// the unit normal of the vertex, decoded from the vertex format
+vec3 vertex_normal() {
+#ifdef OCTAHEDRAL_NORMALS
+	vec3 n = vec3(normal, 1.0 - abs(normal.x) - abs(normal.y));
+	if (n.z < 0.0) {
+		// the lower half of the octahedron is folded over the upper one
+		n.xy = (1.0 - abs(n.yx)) * vec2(n.x >= 0.0 ? 1.0 : -1.0, n.y >= 0.0 ? 1.0 : -1.0);
+	}
+	return normalize(n);
+#else
+	return normal;
+#endif
+}
+
 //=== main shader code
 void main(void) {
+#ifdef INSTANCED
+	// All layers are drawn in a single call, each instance is one layer, from first_layer.
+	float current_layer = first_layer + float(gl_InstanceID);
+	frag_Layer = current_layer;
+	frag_UVScale = clamp(1.0 - (current_layer + 1.0) * floor(1.0 / num_of_layers), 0.0, 1.0);
+#endif
+
 	// This extrudes the surface to the gap, along the normal.
 	// This is the main part, it creates the layers.
-	vec3 Pos = position.xyz + (normal * (current_layer * (fur_length / num_of_layers)));
+	vec3 Pos = position.xyz + (vertex_normal() * (current_layer * (fur_length / num_of_layers)));
 	// This translates the fur strands into the global coordinates
 	vec4 P = (model* view * vec4(Pos,1.0));
 
@@ -49,5 +88,6 @@ void main(void) {
 	}
 
 	frag_TexCoord = texCoord;
+	frag_Material = material;
     gl_Position = projection * P;
 }
\ No newline at end of file
@@ -0,0 +1,201 @@
+import numpy as np
+
+from mesh import Mesh, normalise, face_edges
+
+'''
+Quadric error metric simplification (Garland and Heckbert) for meshes, to build levels of detail.
+
+Edges are collapsed in parallel passes rather than one at a time: in each pass, every vertex picks the cheapest edge
+around it, the edges picked by both of their vertices are kept, and this is repeated on the edges away from the
+kept ones. They are all collapsed together, which needs no priority queue and works on whole arrays.
+The new vertex is placed on the edge where the quadric error is the lowest, and its texture coordinates and normal
+are interpolated at the same place. Vertices on the boundary of the mesh, which includes the texture seams where
+fix_blender_textures split the vertices, are never moved, so that UVs are kept.
+'''
+
+
+def vertex_quadrics(vertices, faces):
+    '''
+    :return: the (n, 4, 4) sum of the quadrics of the planes of the faces around each vertex
+    '''
+    a, b = face_edges(vertices, faces)
+    normals = normalise(np.cross(a, b)).astype(np.float64)
+    planes = np.concatenate([normals, -np.sum(normals * vertices[faces[:, 0]], axis=1, keepdims=True)], axis=1)
+    quadrics = (planes[:, :, np.newaxis] * planes[:, np.newaxis, :]).reshape(-1, 16)
+
+    indices = faces.ravel()
+    values = np.repeat(quadrics, 3, axis=0)
+    return np.stack([np.bincount(indices, weights=values[:, i], minlength=vertices.shape[0]) for i in range(16)],
+                    axis=1).reshape(-1, 4, 4)
+
+
+def unique_edges(faces):
+    '''
+    :return: the (e, 2) sorted vertex pairs of the edges, and the number of faces of each edge
+    '''
+    edges = np.sort(np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]]), axis=1)
+    return np.unique(edges, axis=0, return_counts=True)
+
+
+def edge_costs(vertices, quadrics, edges):
+    '''
+    Finds the point of each edge with the lowest error for the sum of the quadrics of its two vertices.
+    :return: the parameter t of the point along the edge, in [0, 1], and its error
+    '''
+    Q = quadrics[edges[:, 0]] + quadrics[edges[:, 1]]
+    a = np.concatenate([vertices[edges[:, 0]], np.ones((edges.shape[0], 1))], axis=1)
+    d = np.concatenate([vertices[edges[:, 1]] - vertices[edges[:, 0]], np.zeros((edges.shape[0], 1))], axis=1)
+
+    # the error along the edge is a quadratic of t: aQa + 2t dQa + t^2 dQd
+    Qa = np.einsum('eij,ej->ei', Q, a)
+    aQa = np.sum(a * Qa, axis=1)
+    dQa = np.sum(d * Qa, axis=1)
+    dQd = np.einsum('ei,eij,ej->e', d, Q, d)
+
+    t = np.full(edges.shape[0], 0.5)
+    curved = dQd > 1e-12
+    t[curved] = np.clip(-dQa[curved] / dQd[curved], 0., 1.)
+    return t, np.maximum(aQa + 2 * t * dQa + t * t * dQd, 0.)
+
+
+def independent_edges(edges, cost, n, max_edges, rounds=16):
+    '''
+    Picks cheap edges which are far enough apart to be collapsed at the same time: no two picked edges share
+    a vertex or are joined by an edge.
+    In each round, every free vertex picks its cheapest free edge, the edges picked by both of their vertices are
+    kept, and the vertices around them are no longer free.
+    :return: the indices of the picked edges, cheapest first
+    '''
+    free = np.ones(n, dtype=bool)
+    candidates = np.argsort(cost, kind='stable')
+    selected = []
+    count = 0
+    for _ in range(rounds):
+        candidates = candidates[free[edges[candidates]].all(axis=1)]
+        if candidates.shape[0] == 0 or count >= max_edges:
+            break
+
+        # rank of the cheapest candidate edge of each vertex, the candidates being sorted by cost
+        rank = np.arange(candidates.shape[0])
+        best = np.full(n, candidates.shape[0])
+        np.minimum.at(best, edges[candidates].ravel(), np.repeat(rank, 2))
+        picked = candidates[(best[edges[candidates, 0]] == rank) & (best[edges[candidates, 1]] == rank)]
+        picked = picked[:max_edges - count]
+        selected.append(picked)
+        count += picked.shape[0]
+
+        # the vertices of the picked edges and their neighbours are taken
+        taken = np.zeros(n, dtype=bool)
+        taken[edges[picked].ravel()] = True
+        touching = taken[edges].any(axis=1)
+        free[edges[touching].ravel()] = False
+
+    if not selected:
+        return np.zeros(0, dtype=np.int64)
+    selected = np.concatenate(selected)
+    return selected[np.argsort(cost[selected], kind='stable')]
+
+
+def collapse_pass(vertices, normals, textureCoords, faces, quadrics, locked, max_collapses):
+    '''
+    Collapses a set of edges which are not next to each other, and which do not flip any face.
+    :return: the new faces, the number of collapses and the largest error of a collapsed edge.
+    The vertex arrays are modified in place, collapsed vertices stay in them but are not used by the faces anymore.
+    '''
+    edges, counts = unique_edges(faces)
+    edges = edges[~locked[edges].any(axis=1)]
+    if edges.shape[0] == 0:
+        return faces, 0, 0.
+    t, cost = edge_costs(vertices, quadrics, edges)
+
+    selected = independent_edges(edges, cost, vertices.shape[0], max_collapses)
+
+    a_old, b_old = face_edges(vertices, faces)
+    old_normals = np.cross(a_old, b_old)
+
+    # collapses which would flip a face are reverted, until no face flips
+    while selected.shape[0] > 0:
+        a, b = edges[selected, 0], edges[selected, 1]
+        remap = np.arange(vertices.shape[0])
+        remap[b] = a
+        positions = vertices.copy()
+        positions[a] = vertices[a] + t[selected, np.newaxis] * (vertices[b] - vertices[a])
+
+        new_faces = remap[faces]
+        alive = (new_faces[:, 0] != new_faces[:, 1]) & (new_faces[:, 1] != new_faces[:, 2]) & \
+                (new_faces[:, 2] != new_faces[:, 0])
+        e1, e2 = face_edges(positions, new_faces)
+        flipped = alive & (np.sum(np.cross(e1, e2) * old_normals, axis=1) <= 0)
+        if not flipped.any():
+            break
+
+        # the collapses touching a flipped face are reverted
+        bad = np.zeros(vertices.shape[0], dtype=bool)
+        bad[new_faces[flipped].ravel()] = True
+        selected = selected[~bad[a]]
+
+    if selected.shape[0] == 0:
+        return faces, 0, 0.
+
+    s = t[selected, np.newaxis]
+    vertices[a] = vertices[a] + s * (vertices[b] - vertices[a])
+    normals[a] = normalise(normals[a] + s * (normals[b] - normals[a]))
+    if textureCoords is not None:
+        textureCoords[a] = textureCoords[a] + s * (textureCoords[b] - textureCoords[a])
+    quadrics[a] += quadrics[b]
+
+    return new_faces[alive], selected.shape[0], cost[selected].max()
+
+
+def simplify(mesh, target_faces, max_passes=100):
+    '''
+    Simplifies a triangle mesh down to about target_faces faces.
+    :return: the simplified Mesh, and its error: the square root of the largest quadric error of a collapse,
+    which is about the distance of the simplified surface to the original one, in model units
+    '''
+    vertices = mesh.vertices.astype(np.float64)
+    normals = mesh.normals.astype(np.float64)
+    textureCoords = None if mesh.textureCoords is None else mesh.textureCoords.astype(np.float64)
+    faces = mesh.faces.astype(np.int64)
+
+    quadrics = vertex_quadrics(vertices, faces)
+    edges, counts = unique_edges(faces)
+    locked = np.zeros(vertices.shape[0], dtype=bool)
+    locked[edges[counts != 2].ravel()] = True
+
+    error = 0.
+    for _ in range(max_passes):
+        # each collapse removes about two faces
+        needed = (faces.shape[0] - target_faces + 1) // 2
+        if needed <= 0:
+            break
+        faces, collapsed, cost = collapse_pass(vertices, normals, textureCoords, faces, quadrics, locked, needed)
+        if collapsed == 0:
+            break
+        error = max(error, cost)
+
+    # only keeps the vertices which are still used
+    used, faces = np.unique(faces, return_inverse=True)
+    simplified = Mesh(vertices=vertices[used].astype('f'), faces=faces.reshape(-1, 3).astype(np.uint32),
+                      normals=normals[used].astype('f'),
+                      textureCoords=None if textureCoords is None else textureCoords[used].astype('f'),
+                      material=mesh.material)
+    return simplified, float(np.sqrt(error))
+
+
+def build_lods(mesh, ratio=0.5, min_faces=256, max_levels=6):
+    '''
+    Builds a chain of levels of detail, each with about ratio times the faces of the previous one.
+    Each level is simplified from the previous one, and its error includes the error of the previous levels.
+    :return: the list of (mesh, error) from the full resolution mesh (error 0) to the coarsest one
+    '''
+    lods = [(mesh, 0.)]
+    while len(lods) < max_levels and lods[-1][0].faces.shape[0] * ratio >= min_faces:
+        previous, previous_error = lods[-1]
+        simplified, error = simplify(previous, int(previous.faces.shape[0] * ratio))
+
+        # stop when the mesh cannot be simplified any more, eg. when most vertices are on texture seams
+        if simplified.faces.shape[0] > previous.faces.shape[0] * (1 + ratio) / 2:
+            break
+        lods.append((simplified, previous_error + error))
+    return lods
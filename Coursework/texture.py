@@ -1,6 +1,30 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
 import pygame
 from OpenGL.GL import *
 
+'''
+Textures, and the process-wide texture cache. Images are decoded once: the pixels are saved as .npy files in
+IMAGE_CACHE_DIRECTORY, which later loads memory-map instead of decoding the file again. The arrays are passed to
+OpenGL through the buffer protocol, so the pixels go from the page cache to the driver without any copy.
+'''
+
+# the folder of the decoded images, None to always decode them
+IMAGE_CACHE_DIRECTORY = '.texturecache'
+
+
+def min_filter(sample, mipmap):
+    '''
+    :return: the minification filter for a sampling mode, which blends the two closest mipmap levels if there are
+    mipmaps, so that distant textures are not aliased
+    '''
+    if not mipmap:
+        return sample
+    return GL_LINEAR_MIPMAP_LINEAR if sample == GL_LINEAR else GL_NEAREST_MIPMAP_LINEAR
+
 
 class Texture:
     """
@@ -8,7 +32,11 @@ class Texture:
     """
 
     def __init__(self, name, img=None, wrap=GL_REPEAT, sample=GL_NEAREST, format=GL_RGBA, type=GL_UNSIGNED_BYTE,
-                 target=GL_TEXTURE_2D):
+                 target=GL_TEXTURE_2D, mipmap=False):
+        """
+        :param img: [optional] a (height, width, channels) array of pixels, otherwise the image is loaded from file
+        :param mipmap: if True, the mipmap levels are generated on the GPU and used for minification
+        """
         self.name = name
         self.format = format
         self.type = type
@@ -23,21 +51,18 @@ class Texture:
         self.bind()
 
         if img is None:
-            # load the image from file using pyGame - any other image reading function could be used here.
+            # load the image from file, or from the decoded image cache
             print('Loading texture: texture/{}'.format(name))
-            img = pygame.image.load('./textures/{}'.format(name))
-
-            # convert the python image object to a plain byte array for passing to OpenGL
-            data = pygame.image.tostring(img, "RGBA", 1)
+            img = load_image(name)
 
-            self.height = img.get_height()
-            self.width = img.get_width()
+        self.height = img.shape[0]
+        self.width = img.shape[1]
+        self.nbytes = img.nbytes * 4 // 3 if mipmap else img.nbytes
 
-            # load the texture in the buffer
-            glTexImage2D(self.target, 0, format, self.width, self.height, 0, format, type, data)
-        else:
-            # if a data array is provided use this
-            glTexImage2D(self.target, 0, format, img.shape[0], img.shape[1], 0, format, type, img)
+        # the array is read by OpenGL in place, it is not converted to bytes first
+        glTexImage2D(self.target, 0, format, self.width, self.height, 0, format, type, img)
+        if mipmap:
+            glGenerateMipmap(self.target)
 
         # set what happens for texture coordinates outside [0,1]
         glTexParameteri(self.target, GL_TEXTURE_WRAP_S, wrap)
@@ -45,7 +70,7 @@ class Texture:
 
         # set how sampling from the texture is done.
         glTexParameteri(self.target, GL_TEXTURE_MAG_FILTER, sample)
-        glTexParameteri(self.target, GL_TEXTURE_MIN_FILTER, sample)
+        glTexParameteri(self.target, GL_TEXTURE_MIN_FILTER, min_filter(sample, mipmap))
 
         self.unbind()
 
@@ -54,3 +79,196 @@ class Texture:
 
     def unbind(self):
         glBindTexture(self.target, 0)
+
+    def release(self):
+        if self.textureid is not None:
+            glDeleteTextures(1, [self.textureid])
+            self.textureid = None
+
+
+def load_image(name, directory=IMAGE_CACHE_DIRECTORY):
+    """
+    Loads an image of the textures folder. The decoded pixels are saved in directory, keyed by the path, size and
+    modification time of the file, and are memory-mapped by the next loads of the same file.
+    :param directory: the folder of the decoded images, None to always decode the file
+    :return: a (height, width, 4) array of RGBA bytes, bottom row first as OpenGL expects it
+    """
+    file_name = './textures/{}'.format(name)
+
+    cached = None
+    if directory is not None:
+        stat = os.stat(file_name)
+        key = '{}:{}:{}'.format(os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns)
+        cached = os.path.join(directory, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+        try:
+            return np.load(cached, mmap_mode='r')
+        except (OSError, ValueError):
+            pass
+
+    img = pygame.image.load(file_name)
+    data = pygame.image.tostring(img, "RGBA", 1)
+    image = np.frombuffer(data, dtype=np.uint8).reshape(img.get_height(), img.get_width(), 4)
+
+    if cached is not None:
+        # written under another name first, so that an interrupted save is never loaded. The asset loader may save
+        # the same image from a worker thread.
+        os.makedirs(directory, exist_ok=True)
+        tmp = '{}.tmp{}_{}.npy'.format(cached[:-4], os.getpid(), threading.get_ident())
+        np.save(tmp, image)
+        os.replace(tmp, cached)
+    return image
+
+
+def material_image(material, images=None):
+    """
+    :param images: [optional] dict of the images already decoded, by texture name, eg. by the asset loader
+    :return: the texture of a material, or a single pixel of its diffuse colour if it has no texture
+    """
+    if material.texture is not None:
+        if images is not None and material.texture in images:
+            return images[material.texture]
+        return load_image(material.texture)
+    return np.array([[list(np.clip(np.asarray(material.Kd) * 255, 0, 255)) + [255]]], dtype=np.uint8)
+
+
+def material_key(material):
+    """
+    :return: a key of the image of a material, see material_image()
+    """
+    if material.texture is not None:
+        return material.texture
+    return tuple(np.clip(np.asarray(material.Kd, dtype=float) * 255, 0, 255).astype(int).tolist())
+
+
+class TextureArray:
+    """
+    Several images in the layers of a single GL_TEXTURE_2D_ARRAY, eg. the textures of all the materials of a model,
+    so that meshes with different materials can be drawn together and pick their layer in the shader.
+    Images smaller than the largest one are scaled up to its size, with the nearest pixels.
+    """
+
+    def __init__(self, images, wrap=GL_REPEAT, sample=GL_NEAREST, mipmap=False):
+        """
+        :param mipmap: if True, the mipmap levels are generated on the GPU and used for minification
+        """
+        self.height = max(image.shape[0] for image in images)
+        self.width = max(image.shape[1] for image in images)
+        self.layers = len(images)
+
+        # a single image is uploaded as it is, eg. straight from the memory map of the decoded image cache
+        if self.layers == 1:
+            data = images[0][np.newaxis]
+        else:
+            data = np.stack([self.resize(image) for image in images])
+        self.nbytes = data.nbytes * 4 // 3 if mipmap else data.nbytes
+
+        self.textureid = glGenTextures(1)
+        print('* Loading texture array of {} layers of {}x{} at ID {}'.format(
+            self.layers, self.width, self.height, self.textureid))
+
+        self.bind()
+        glTexImage3D(GL_TEXTURE_2D_ARRAY, 0, GL_RGBA, self.width, self.height, self.layers, 0, GL_RGBA,
+                     GL_UNSIGNED_BYTE, data)
+        if mipmap:
+            # the levels are filtered in each layer, the layers are never blended
+            glGenerateMipmap(GL_TEXTURE_2D_ARRAY)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_S, wrap)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_WRAP_T, wrap)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MAG_FILTER, sample)
+        glTexParameteri(GL_TEXTURE_2D_ARRAY, GL_TEXTURE_MIN_FILTER, min_filter(sample, mipmap))
+        self.unbind()
+
+    def resize(self, image):
+        rows = np.arange(self.height) * image.shape[0] // self.height
+        columns = np.arange(self.width) * image.shape[1] // self.width
+        return image[rows[:, np.newaxis], columns[np.newaxis, :]]
+
+    def bind(self):
+        glBindTexture(GL_TEXTURE_2D_ARRAY, self.textureid)
+
+    def unbind(self):
+        glBindTexture(GL_TEXTURE_2D_ARRAY, 0)
+
+    def release(self):
+        if self.textureid is not None:
+            glDeleteTextures(1, [self.textureid])
+            self.textureid = None
+
+
+class TextureCache:
+    """
+    Process-wide cache of the textures on the GPU, keyed by their images and sampler state, so that an image used by
+    several materials or models is only uploaded once. Each get() adds a user to the texture, and release() only
+    deletes it once its last user released it.
+    """
+
+    def __init__(self):
+        # dict of {key: [texture, number of users]}
+        self.textures = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, create):
+        """
+        Returns the texture for a key, creating it if it is not in the cache yet.
+        :param create: function called without arguments to create the texture if needed
+        """
+        if key in self.textures:
+            self.hits += 1
+            self.textures[key][1] += 1
+            return self.textures[key][0]
+
+        self.misses += 1
+        texture = create()
+        self.textures[key] = [texture, 1]
+        return texture
+
+    def texture(self, name, wrap=GL_REPEAT, sample=GL_NEAREST, mipmap=True):
+        """
+        :return: the texture of an image of the textures folder
+        """
+        return self.get(('texture', name, wrap, sample, mipmap),
+                        lambda: Texture(name, wrap=wrap, sample=sample, mipmap=mipmap))
+
+    def material_array(self, materials, wrap=GL_REPEAT, sample=GL_NEAREST, mipmap=True, images=None):
+        """
+        :param images: [optional] dict of the images already decoded, by texture name, see material_image()
+        :return: the texture array of the images of a list of materials, one layer each, see material_image()
+        """
+        return self.get(('materials', tuple(material_key(material) for material in materials), wrap, sample, mipmap),
+                        lambda: TextureArray([material_image(material, images) for material in materials], wrap,
+                                             sample, mipmap))
+
+    def nbytes(self):
+        """
+        :return: the number of bytes used on the GPU by the cached textures
+        """
+        return sum(texture.nbytes for texture, _ in self.textures.values())
+
+    def report(self):
+        """
+        Prints the number of hits and misses since the cache was created.
+        """
+        total = self.hits + self.misses
+        print('(X) Texture cache: {} hits, {} misses ({:.0f}% hit rate), {} textures, {:.1f} MB'.format(
+            self.hits, self.misses, 100. * self.hits / total if total > 0 else 0., len(self.textures),
+            self.nbytes() / 2 ** 20))
+
+    def release(self, texture):
+        """
+        Removes a user of a texture, which is deleted when it has no user left.
+        """
+        for key, entry in self.textures.items():
+            if entry[0] is texture:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.textures[key]
+                    texture.release()
+                return
+
+        # not created by the cache
+        texture.release()
+
+
+# cache shared by all models
+texture_cache = TextureCache()
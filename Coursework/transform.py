@@ -0,0 +1,136 @@
+from collections import defaultdict
+
+import numpy as np
+
+'''
+Transform graph with cached matrices. Each node stores its local matrix and caches its world matrix (the product
+of the local matrices of its ancestors), which is only computed again when the node or one of its ancestors moved.
+'''
+
+
+class TransformStats:
+    '''
+    Counts the cached matrices which were reused (hits), and the ones which had to be computed again (misses),
+    for each kind of matrix: 'world', 'view' and 'pvm'.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+
+    def report(self):
+        print('(T) Cached matrices: ' + ', '.join('{} {} hits, {} misses'.format(
+            kind, self.hits[kind], self.misses[kind]) for kind in sorted(set(self.hits) | set(self.misses))))
+
+
+# counters shared by all nodes and cameras
+transform_stats = TransformStats()
+
+
+def frozen(matrix, dtype='f'):
+    '''
+    :return: a read-only copy of a matrix, so that it can be shared and recognised by identity
+    '''
+    matrix = np.array(matrix, dtype=dtype)
+    matrix.setflags(write=False)
+    return matrix
+
+
+class TransformNode:
+    '''
+    A node of the transform graph. Set M to move the node, which also moves all of its children.
+    The world matrix is recomputed on demand when the node, or one of its ancestors, has a new version.
+    '''
+
+    def __init__(self, M=None, parent=None):
+        self._M = np.identity(4) if M is None else np.asarray(M)
+        self.parent = None
+        self.children = []
+
+        # the cached world matrix, its float32 copy, and the parent version it was computed from
+        self._world = None
+        self._world32 = None
+        self._parent_version = None
+
+        # incremented every time the world matrix changes, so that children and caches can tell
+        self.version = 0
+
+        # (projection version, camera version, world version) of the cached PVM matrix
+        self._pvm = None
+        self._pvm_key = None
+
+        if parent is not None:
+            parent.add_child(self)
+
+    @property
+    def M(self):
+        return self._M
+
+    @M.setter
+    def M(self, M):
+        '''
+        Sets the local matrix. Assign a new matrix, as changing the content of M in place is not detected.
+        '''
+        self._M = np.asarray(M)
+        self._world = None
+
+    def add_child(self, node):
+        if node.parent is not None:
+            node.parent.children.remove(node)
+        node.parent = self
+        node._world = None
+        self.children.append(node)
+
+    def world(self):
+        '''
+        :return: the float64 world matrix, parent world matrix times the local matrix
+        '''
+        if self.parent is None:
+            parent_world, parent_version = None, None
+        else:
+            parent_world = self.parent.world()
+            parent_version = self.parent.version
+
+        if self._world is not None and self._parent_version == parent_version:
+            transform_stats.hits['world'] += 1
+            return self._world
+
+        transform_stats.misses['world'] += 1
+        self._world = self._M if parent_world is None else np.matmul(parent_world, self._M)
+        self._world32 = None
+        self._parent_version = parent_version
+        self.version += 1
+        return self._world
+
+    def world32(self):
+        '''
+        :return: the world matrix as a read-only float32 array, the same object until the node moves,
+        so that uniform uploads can skip it without comparing values
+        '''
+        world = self.world()
+        if self._world32 is None:
+            self._world32 = frozen(world)
+        return self._world32
+
+    def pvm(self, P, projection_version, camera):
+        '''
+        :return: the read-only float32 projection * model * view matrix of this node, in the order the vertex
+        shader applies them
+        :param P: the projection matrix
+        :param projection_version: the version of P, which must change whenever a new P is set
+        :param camera: the camera whose view matrix is used
+        '''
+        camera.update()
+        self.world()
+        key = (projection_version, camera.version, self.version)
+        if self._pvm is not None and self._pvm_key == key:
+            transform_stats.hits['pvm'] += 1
+            return self._pvm
+
+        transform_stats.misses['pvm'] += 1
+        self._pvm = frozen(np.matmul(P, np.matmul(self._world, camera.V)))
+        self._pvm_key = key
+        return self._pvm
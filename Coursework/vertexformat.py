@@ -0,0 +1,181 @@
+import ctypes
+
+import numpy as np
+
+from OpenGL.GL import *
+
+'''
+Vertex formats: how the attributes of the vertices are packed together in a single interleaved buffer, and how
+much each one is quantized. Every fur shell reads all the vertices again, so smaller vertices cut the memory
+traffic of the whole fur, not only of the skin.
+
+With the default format a vertex takes 16 bytes instead of 36 for separate float32 buffers:
+    position   3 half floats                                  6 bytes
+    material   1 unsigned short, in the padding of position   2 bytes
+    normal     octahedral encoding in 2 normalized shorts     4 bytes (or 3 x 10 bits in GL_INT_2_10_10_10_REV)
+    texCoord   2 normalized unsigned shorts                   4 bytes
+Indices are stored as unsigned shorts when there are at most 65536 vertices.
+'''
+
+# half float positions are only used within this range, where they are rounded by less than 0.004. Larger or distant
+# models, eg. scans in millimetres, keep float32 positions.
+HALF_POSITION_RANGE = 16.
+
+
+def encode_octahedral(normals):
+    '''
+    Projects unit vectors on an octahedron, whose lower half is folded over the upper one, so that a direction
+    is stored in two coordinates in [-1, 1]. The vertex shader decodes them when OCTAHEDRAL_NORMALS is defined.
+    :return: a (n, 2) array
+    '''
+    n = normals / np.maximum(np.sum(np.abs(normals), axis=1, keepdims=True), 1e-20)
+    xy = n[:, :2].copy()
+    lower = n[:, 2] < 0
+    xy[lower] = (1 - np.abs(xy[lower][:, ::-1])) * np.where(xy[lower] >= 0, 1., -1.)
+    return xy
+
+
+def decode_octahedral(xy):
+    '''
+    The inverse of encode_octahedral(), as done in the vertex shader.
+    '''
+    n = np.concatenate([xy, 1 - np.sum(np.abs(xy), axis=1, keepdims=True)], axis=1)
+    lower = n[:, 2] < 0
+    n[lower, :2] = (1 - np.abs(n[lower][:, 1::-1])) * np.where(n[lower, :2] >= 0, 1., -1.)
+    return n / np.linalg.norm(n, axis=1, keepdims=True)
+
+
+def snorm(values, dtype):
+    '''
+    :return: values in [-1, 1] as normalized signed integers
+    '''
+    scale = np.iinfo(dtype).max
+    return np.round(np.clip(values, -1., 1.) * scale).astype(dtype)
+
+
+def unorm(values, dtype):
+    '''
+    :return: values in [0, 1] as normalized unsigned integers
+    '''
+    scale = np.iinfo(dtype).max
+    return np.round(np.clip(values, 0., 1.) * scale).astype(dtype)
+
+
+def pack_2_10_10_10(normals):
+    '''
+    :return: (n, 1) int32 of the normals as three normalized signed 10 bits integers, for GL_INT_2_10_10_10_REV
+    '''
+    v = np.round(np.clip(normals, -1., 1.) * 511).astype(np.int32) & 0x3ff
+    return (v[:, 0] | (v[:, 1] << 10) | (v[:, 2] << 20)).astype(np.int32)[:, np.newaxis]
+
+
+class VertexFormat:
+    '''
+    Describes the encoding of each attribute, and packs the vertex arrays in an interleaved buffer.
+    '''
+
+    def __init__(self, position='half', normal='octahedral', texCoord='unorm16'):
+        '''
+        :param position: 'half', which falls back to float outside HALF_POSITION_RANGE, or 'float'
+        :param normal: 'octahedral', 'int_2_10_10_10' or 'float'
+        :param texCoord: 'unorm16', which needs coordinates in [0, 1], 'half' or 'float'
+        '''
+        self.position = position
+        self.normal = normal
+        self.texCoord = texCoord
+
+    def defines(self):
+        '''
+        :return: the shader defines needed to decode this format
+        '''
+        return {'OCTAHEDRAL_NORMALS': 1} if self.normal == 'octahedral' else {}
+
+    def encode(self, name, data):
+        '''
+        :return: the encoded (n, components) array of an attribute, its GL type and whether it is normalized
+        '''
+        encoding = getattr(self, name, 'float')
+        if name == 'texCoord' and encoding == 'unorm16' and (data.min() < 0 or data.max() > 1):
+            # repeated textures go beyond [0, 1], they keep their full coordinates
+            encoding = 'float'
+        if name == 'position' and encoding == 'half' and np.abs(data).max() > HALF_POSITION_RANGE:
+            encoding = 'float'
+
+        if name == 'material':
+            return data.astype(np.uint16), GL_UNSIGNED_SHORT, False
+        if encoding == 'half':
+            return data.astype(np.float16), GL_HALF_FLOAT, False
+        if encoding == 'octahedral':
+            return snorm(encode_octahedral(data), np.int16), GL_SHORT, True
+        if encoding == 'int_2_10_10_10':
+            return pack_2_10_10_10(data), GL_INT_2_10_10_10_REV, True
+        if encoding == 'unorm16':
+            return unorm(data, np.uint16), GL_UNSIGNED_SHORT, True
+        return data.astype(np.float32), GL_FLOAT, False
+
+    def pack(self, arrays):
+        '''
+        Interleaves the attributes, each one aligned on its own size, and vertices aligned on 4 bytes.
+        The material index is put right after the position, where half floats leave 2 bytes of padding.
+        :param arrays: list of (name, (n, k) array or None), in the order of their locations
+        :return: the (n, stride) array of bytes, and the list of (name, components, GL type, normalized, offset)
+        '''
+        names = [name for name, data in arrays if data is not None]
+        order = sorted(names, key=lambda name: 0 if name == 'position' else 1 if name == 'material' else 2)
+
+        encoded = {}
+        for name, data in arrays:
+            if data is not None:
+                encoded[name] = self.encode(name, np.asarray(data).reshape(data.shape[0], -1))
+
+        layout = []
+        offset = 0
+        for name in order:
+            values, gl_type, normalized = encoded[name]
+            size = values.dtype.itemsize
+            offset = (offset + size - 1) // size * size
+            # the packed normals are one integer, which GL reads as four components
+            components = 4 if gl_type == GL_INT_2_10_10_10_REV else values.shape[1]
+            layout.append((name, components, gl_type, normalized, offset))
+            offset += values.shape[1] * size
+        stride = (offset + 3) // 4 * 4
+
+        vertex_count = encoded[order[0]][0].shape[0]
+        data = np.zeros((vertex_count, stride), dtype=np.uint8)
+        for name, components, gl_type, normalized, offset in layout:
+            values = np.ascontiguousarray(encoded[name][0])
+            data[:, offset:offset + values.shape[1] * values.dtype.itemsize] = \
+                values.view(np.uint8).reshape(vertex_count, -1)
+
+        # the attributes keep the order of their locations
+        layout.sort(key=lambda attribute: names.index(attribute[0]))
+        return data, layout
+
+    def __repr__(self):
+        return 'VertexFormat(position={!r}, normal={!r}, texCoord={!r})'.format(self.position, self.normal,
+                                                                               self.texCoord)
+
+
+# the smallest format, and the float32 one which keeps the attributes exact
+COMPACT = VertexFormat()
+FULL_PRECISION = VertexFormat('float', 'float', 'float')
+
+
+def index_type(vertex_count):
+    '''
+    :return: the numpy and GL types of the indices of a mesh with this number of vertices
+    '''
+    if vertex_count <= 1 << 16:
+        return np.uint16, GL_UNSIGNED_SHORT
+    return np.uint32, GL_UNSIGNED_INT
+
+
+def set_attribute_pointers(layout, stride, locations):
+    '''
+    Describes the interleaved buffer bound to GL_ARRAY_BUFFER to the vertex array object which is bound.
+    :param layout: the layout returned by VertexFormat.pack()
+    :param locations: the location of each attribute
+    '''
+    for name, components, gl_type, normalized, offset in layout:
+        glEnableVertexAttribArray(locations[name])
+        glVertexAttribPointer(locations[name], components, gl_type, normalized, stride, ctypes.c_void_p(offset))
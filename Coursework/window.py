@@ -0,0 +1,182 @@
+import ctypes
+import os
+import sys
+
+'''
+Windowing backends for the scene. PygameWindow opens a window on the desktop, HeadlessWindow renders into a
+framebuffer object of an EGL context which does not need a display (eg. on Mesa llvmpipe).
+
+PyOpenGL picks its platform when OpenGL is first imported, so a headless program must call use_headless()
+before importing OpenGL, or any module which does (scene, shaders, BaseModel...).
+'''
+
+
+def use_headless():
+    '''
+    Selects the EGL platform for PyOpenGL, without any display. Must be called before OpenGL is imported.
+    '''
+    if 'OpenGL.platform' in sys.modules and os.environ.get('PYOPENGL_PLATFORM') != 'egl':
+        print('(W) OpenGL was imported before use_headless(), the headless window may not work')
+    os.environ['PYOPENGL_PLATFORM'] = 'egl'
+    os.environ.setdefault('EGL_PLATFORM', 'surfaceless')
+
+
+def create_window(width, height, headless=False, vsync=False):
+    '''
+    Creates the window used by a scene.
+    :param headless: if True, renders offscreen in an EGL context instead of opening a pygame window
+    :param vsync: if True, the window swaps its buffers on the vertical sync of the display (ignored when headless)
+    '''
+    if headless:
+        return HeadlessWindow(width, height)
+    return PygameWindow(width, height, vsync)
+
+
+class PygameWindow:
+    '''
+    A double buffered pygame window.
+    '''
+
+    headless = False
+
+    def __init__(self, width, height, vsync=False):
+        import pygame
+        self.size = (width, height)
+
+        # the first two lines initialise the pygame window. You could use another library for this,
+        # for example GLut or Qt
+        pygame.init()
+
+        # THIS NEEDS TO BE HERE.
+        try:
+            self.screen = pygame.display.set_mode(self.size, pygame.OPENGL | pygame.DOUBLEBUF, 24, vsync=int(vsync))
+        except pygame.error as error:
+            if not vsync:
+                raise
+            print('(W) Vertical sync is not available, the window is opened without it: {}'.format(error))
+            self.screen = pygame.display.set_mode(self.size, pygame.OPENGL | pygame.DOUBLEBUF, 24)
+
+    def flip(self):
+        '''
+        Displays the frame which was just drawn.
+        '''
+        import pygame
+        pygame.display.flip()
+
+    def set_title(self, title):
+        import pygame
+        pygame.display.set_caption(title)
+
+    def read_pixels(self):
+        '''
+        :return: the current frame as a (height, width, 3) array of bytes, top row first
+        '''
+        return read_pixels(*self.size)
+
+    def close(self):
+        import pygame
+        pygame.quit()
+
+
+class HeadlessWindow:
+    '''
+    Offscreen rendering in a surfaceless EGL context. The frame is drawn into a framebuffer object with
+    a colour and a depth renderbuffer, which stays bound, so the scene draws exactly as it does in a window.
+    '''
+
+    headless = True
+
+    def __init__(self, width, height):
+        from OpenGL import EGL
+        from OpenGL.GL import glGenFramebuffers, glBindFramebuffer, glGenRenderbuffers, glBindRenderbuffer, \
+            glRenderbufferStorage, glFramebufferRenderbuffer, glCheckFramebufferStatus, glGetString, \
+            GL_FRAMEBUFFER, GL_RENDERBUFFER, GL_RGBA8, GL_DEPTH_COMPONENT24, GL_COLOR_ATTACHMENT0, \
+            GL_DEPTH_ATTACHMENT, GL_FRAMEBUFFER_COMPLETE, GL_VERSION, GL_RENDERER
+
+        self.size = (width, height)
+        self.egl = EGL
+
+        self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if not EGL.eglInitialize(self.display, ctypes.pointer(major), ctypes.pointer(minor)):
+            raise RuntimeError('Could not initialise EGL, is PYOPENGL_PLATFORM set to egl?')
+
+        # the surface type defaults to windows, which a display-less EGL does not have
+        attributes = (EGL.EGLint * 5)(EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                                      EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE)
+        config = EGL.EGLConfig()
+        count = EGL.EGLint()
+        if not EGL.eglChooseConfig(self.display, attributes, ctypes.pointer(config), 1, ctypes.pointer(count)) \
+                or count.value == 0:
+            raise RuntimeError('No EGL configuration supports desktop OpenGL')
+
+        # desktop OpenGL rather than GL ES, the scene uses compatibility profile calls
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        self.context = EGL.eglCreateContext(self.display, config, EGL.EGL_NO_CONTEXT, None)
+        if not self.context or not EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE,
+                                                      self.context):
+            raise RuntimeError('Could not create a surfaceless EGL context')
+
+        print('(H) Headless {} on {}'.format(glGetString(GL_VERSION).decode(), glGetString(GL_RENDERER).decode()))
+
+        # there is no default framebuffer, so the scene draws into this one
+        self.framebuffer = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+        self.renderbuffers = glGenRenderbuffers(2)
+        for renderbuffer, storage, attachment in zip(self.renderbuffers, [GL_RGBA8, GL_DEPTH_COMPONENT24],
+                                                     [GL_COLOR_ATTACHMENT0, GL_DEPTH_ATTACHMENT]):
+            glBindRenderbuffer(GL_RENDERBUFFER, renderbuffer)
+            glRenderbufferStorage(GL_RENDERBUFFER, storage, width, height)
+            glFramebufferRenderbuffer(GL_FRAMEBUFFER, attachment, GL_RENDERBUFFER, renderbuffer)
+
+        if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError('The offscreen framebuffer is incomplete')
+
+    def flip(self):
+        '''
+        Nothing is displayed, the frame stays in the framebuffer until it is read or cleared.
+        '''
+        pass
+
+    def set_title(self, title):
+        pass
+
+    def read_pixels(self):
+        '''
+        :return: the current frame as a (height, width, 3) array of bytes, top row first
+        '''
+        return read_pixels(*self.size)
+
+    def close(self):
+        from OpenGL.GL import glDeleteFramebuffers, glDeleteRenderbuffers
+        if self.context is None:
+            return
+        glDeleteRenderbuffers(2, self.renderbuffers)
+        glDeleteFramebuffers(1, [self.framebuffer])
+        self.egl.eglMakeCurrent(self.display, self.egl.EGL_NO_SURFACE, self.egl.EGL_NO_SURFACE,
+                                self.egl.EGL_NO_CONTEXT)
+        self.egl.eglDestroyContext(self.display, self.context)
+        self.egl.eglTerminate(self.display)
+        self.context = None
+
+
+def read_pixels(width, height):
+    '''
+    Reads the framebuffer which is currently bound.
+    :return: a (height, width, 3) array of bytes, top row first
+    '''
+    import numpy as np
+    from OpenGL.GL import glFinish, glPixelStorei, glReadPixels, GL_PACK_ALIGNMENT, GL_RGB, GL_UNSIGNED_BYTE
+
+    glFinish()
+    glPixelStorei(GL_PACK_ALIGNMENT, 1)
+    data = glReadPixels(0, 0, width, height, GL_RGB, GL_UNSIGNED_BYTE)
+    return np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)[::-1]
+
+
+def save_image(pixels, file_name):
+    '''
+    Saves a (height, width, 3) array of bytes to an image file, the format is chosen from the extension.
+    '''
+    import pygame
+    pygame.image.save(pygame.surfarray.make_surface(pixels.swapaxes(0, 1)), file_name)